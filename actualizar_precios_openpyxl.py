@@ -1,23 +1,29 @@
 import os
+import io
+import csv
 import json
+import time
+import hashlib
+import secrets
+import threading
 from datetime import datetime
 from typing import Optional, Dict, Any, Tuple
 
-from openpyxl import load_workbook
-from psycopg2.extras import execute_batch
-
 from backend.database import get_connection
+from backend import motor_precios
+from backend.lectores_excel import HojaNoEncontrada, leer_lista
 
 
-SHEET_PRECIOS = "NUEVA LISTA DE PRECIOS"
-ALLOWED_EXCEL_EXTS = {".xlsx", ".xlsm", ".xls"}
+ALLOWED_EXCEL_EXTS = {".xlsx", ".xlsm", ".xls", ".csv"}
 
-TIPO_CAMBIO = float(os.getenv("TIPO_CAMBIO", "6.96"))
+# Solo el valor inicial: el vigente está en precio_parametros (ver backend/motor_precios.py)
+TIPO_CAMBIO = motor_precios.TIPO_CAMBIO_DEFAULT
 
 EXCEL_CANDIDATES = [
     "proveedor.xlsm",
     "proveedor.xlsx",
     "proveedor.xls",
+    "proveedor.csv",
 ]
 
 
@@ -71,32 +77,99 @@ def _find_excel_path(base_dir: str) -> Tuple[Optional[str], list]:
     return None, checked
 
 
-def _calc_margen(costo_bs: float) -> float:
-    if costo_bs < 30:
-        return 0.45
-    elif costo_bs < 80:
-        return 0.35
-    elif costo_bs < 200:
-        return 0.28
-    else:
-        return 0.20
+def _calc_margen(costo_bs: float, config=None) -> float:
+    return (config or motor_precios.CONFIG_DEFAULT).margen(costo_bs)
 
 
-def _calc_prices(usd_unit: float, descuento_proveedor: float) -> Dict[str, float]:
-    costo_bs = usd_unit * TIPO_CAMBIO * (1.0 - float(descuento_proveedor))
-    margen = _calc_margen(costo_bs)
-    bs_web = round(costo_bs * (1.0 + margen), 2)
-    bs_desc25 = round(bs_web * 0.75, 2)
+def _calc_prices(usd_unit: float, descuento_proveedor: float, config=None) -> Dict[str, float]:
+    """Precio de UN producto (referencia). Para el lote completo usar _calc_prices_lote."""
+    return motor_precios.calcular_uno(usd_unit, descuento_proveedor, config or motor_precios.CONFIG_DEFAULT)
 
-    return {
-        "bs_price_proveedor": round(costo_bs, 2),
-        "margen": float(margen),
-        "bs_price_web": float(bs_web),
-        "bs_price_descuento25": float(bs_desc25),
-    }
+
+def _calc_prices_lote(filas: Dict[str, Dict[str, Any]], descuento_proveedor: float, config=None):
+    """
+    Precios de todas las filas en una pasada vectorizada.
+    -> lista de (code, fila, prices) en el orden de filas.
+    Si una fila trae "descuento" (repricing del catálogo) se usa ese en vez del global.
+    """
+    items = list(filas.items())
+    if not items:
+        return []
+    usd = [ex["usd_price_unit"] for _, ex in items]
+    descuentos = [ex.get("descuento", descuento_proveedor) for _, ex in items]
+    res = motor_precios.calcular(usd, descuentos, config or motor_precios.CONFIG_DEFAULT)
+
+    cols = {k: v.tolist() for k, v in res.items()}
+    return [
+        (code, ex, {k: cols[k][i] for k in cols})
+        for i, (code, ex) in enumerate(items)
+    ]
+
+
+def _sin_progreso(**campos):
+    pass
+
+
+# ===== Un solo escritor del catálogo a la vez =====
+# El import y el repricing leen el catálogo, calculan en staging y hacen UPDATE de
+# productos_catalogo: si se pisan, uno escribe precios calculados con datos viejos.
+# Lock de transacción (se suelta con el commit/rollback).
+
+def _bloquear_catalogo(cur, esperar: bool = True) -> bool:
+    if esperar:
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('precios'), hashtext('catalogo'))")
+        return True
+    cur.execute("SELECT pg_try_advisory_xact_lock(hashtext('precios'), hashtext('catalogo')) AS ok")
+    return bool(cur.fetchone()["ok"])
+
+
+# ===== Cache de listas parseadas (vista previa -> aplicar sin volver a leer el Excel) =====
+PREVIEW_TTL_S = int(os.getenv("PREVIEW_PRECIOS_TTL", "1800"))
+PREVIEW_MAX = 3
+
+_parse_lock = threading.Lock()
+_parse_cache: Dict[str, Dict[str, Any]] = {}
 
 
-def actualizar_precios(descuento_proveedor: Optional[float] = None):
+def _firma_archivo(path: str) -> Tuple[str, float, int]:
+    st = os.stat(path)
+    return (path, st.st_mtime, st.st_size)
+
+
+def _guardar_parseo(lista: Dict[str, Any], config: motor_precios.ConfigPrecios) -> str:
+    """Guarda la lista leída y la config (tramos + tipo de cambio) con la que se calculó la vista previa."""
+    preview_id = secrets.token_urlsafe(12)
+    with _parse_lock:
+        ahora = time.monotonic()
+        for k in [k for k, v in _parse_cache.items() if ahora - v["ts"] > PREVIEW_TTL_S]:
+            _parse_cache.pop(k, None)
+        while len(_parse_cache) >= PREVIEW_MAX:
+            _parse_cache.pop(min(_parse_cache, key=lambda k: _parse_cache[k]["ts"]))
+        _parse_cache[preview_id] = {"ts": ahora, "lista": lista, "config": config.a_dict()}
+    return preview_id
+
+
+def _tomar_parseo(preview_id: str) -> Tuple[Optional[Dict[str, Any]], Optional[dict]]:
+    """(lista, config de la vista previa); (None, None) si venció o el Excel cambió en disco."""
+    with _parse_lock:
+        hit = _parse_cache.get(preview_id)
+    if not hit or time.monotonic() - hit["ts"] > PREVIEW_TTL_S:
+        return None, None
+    lista = hit["lista"]
+    try:
+        if _firma_archivo(lista["path"]) != lista["firma"]:
+            return None, None
+    except OSError:
+        return None, None
+    return lista, hit["config"]
+
+
+def parsear_lista(descuento_proveedor: Optional[float] = None, progreso=None) -> Dict[str, Any]:
+    """
+    Busca y lee el Excel del proveedor -> {"ok", "path", "firma", "descuento_proveedor",
+    "excel_by_code", "filas_excel", "t_parse"}. No toca la BD.
+    """
+    progreso = progreso or _sin_progreso
     base_dir = os.path.dirname(os.path.abspath(__file__))
 
     excel_path, checked = _find_excel_path(base_dir)
@@ -107,31 +180,31 @@ def actualizar_precios(descuento_proveedor: Optional[float] = None):
     if ext not in ALLOWED_EXCEL_EXTS:
         return {"ok": False, "error": f"Extensión Excel no soportada: {ext}"}
 
-    wb = load_workbook(excel_path, data_only=True, read_only=True, keep_vba=False)
+    t0 = time.perf_counter()
+    firma = _firma_archivo(excel_path)
+
+    # Lector según extensión (xlsx/xlsm: openpyxl streaming, xls: xlrd, csv)
+    try:
+        descuento_celda, filas = leer_lista(excel_path)
+    except HojaNoEncontrada as e:
+        return {"ok": False, "error": str(e), "sheets": e.sheets}
+    except (ValueError, ImportError) as e:
+        return {"ok": False, "error": f"No se puede leer {os.path.basename(excel_path)}: {e}"}
 
-    ws_header = wb["HOJA PEDIDO"] if "HOJA PEDIDO" in wb.sheetnames else wb.active
-    descuento_excel = _parse_discount_cell(ws_header["G6"].value)
+    descuento_excel = _parse_discount_cell(descuento_celda)
 
     if descuento_proveedor is None:
         descuento_proveedor = descuento_excel if descuento_excel is not None else 0.20
     else:
         descuento_proveedor = _parse_discount_cell(descuento_proveedor) or float(descuento_proveedor)
 
-    if SHEET_PRECIOS not in wb.sheetnames:
-        return {"ok": False, "error": f"No existe la hoja '{SHEET_PRECIOS}'", "sheets": wb.sheetnames}
-
-    ws = wb[SHEET_PRECIOS]
+    progreso(fase="leyendo_excel", filas_leidas=0)
 
     # ===== 1) Leer Excel -> excel_by_code =====
     excel_by_code: Dict[str, Dict[str, Any]] = {}
     filas_excel = 0
 
-    for r in ws.iter_rows(min_row=3, values_only=True):
-        codigo = r[1]
-        descripcion = r[6]
-        usd_unit = r[7]
-        marca = r[9]
-
+    for codigo, descripcion, usd_unit, marca in filas:
         if codigo is None:
             continue
 
@@ -148,6 +221,8 @@ def actualizar_precios(descuento_proveedor: Optional[float] = None):
             continue
 
         filas_excel += 1
+        if filas_excel % 1000 == 0:
+            progreso(filas_leidas=filas_excel)
         excel_by_code[code] = {
             "code": code,
             "description": str(descripcion).strip() if descripcion else "",
@@ -155,9 +230,311 @@ def actualizar_precios(descuento_proveedor: Optional[float] = None):
             "usd_price_unit": usd_u,
         }
 
+    return {
+        "ok": True,
+        "path": excel_path,
+        "firma": firma,
+        "descuento_proveedor": float(descuento_proveedor),
+        "excel_by_code": excel_by_code,
+        "filas_excel": filas_excel,
+        "t_parse": time.perf_counter() - t0,
+    }
+
+
+def _resumen_margenes(margenes) -> list:
+    total = len(margenes) or 1
+    dist: Dict[float, int] = {}
+    for m in margenes:
+        dist[m] = dist.get(m, 0) + 1
+    return [
+        {"margen": m, "productos": n, "pct": round(n * 100.0 / total, 1)}
+        for m, n in sorted(dist.items())
+    ]
+
+
+def previsualizar_precios(descuento_proveedor: Optional[float] = None, top: int = 20,
+                          tipo_cambio: Optional[float] = None):
+    """
+    Dry-run: lee el Excel, calcula precios (tramos/tipo de cambio de la BD, o tipo_cambio
+    de prueba) y los compara con el catálogo SIN escribir nada.
+    Devuelve un resumen + preview_id para aplicar sin re-leer el Excel.
+    """
+    lista = parsear_lista(descuento_proveedor)
+    if not lista.get("ok"):
+        return lista
+
+    t0 = time.perf_counter()
+    descuento = lista["descuento_proveedor"]
+    excel_by_code = lista["excel_by_code"]
+
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        config = motor_precios.cargar_config(cur).con_cambios(tipo_cambio=tipo_cambio)
+        cur.execute("""
+            SELECT code,
+                   CASE WHEN jsonb_typeof(data->'bs_price_web') = 'number'
+                        THEN (data->>'bs_price_web')::float8 END AS bs_price_web,
+                   content_hash
+            FROM productos_catalogo
+        """)
+        actuales = {r["code"]: r for r in (cur.fetchall() or [])}
+    finally:
+        conn.close()
+
+    # cada fila del Excel cae en UNA sola categoría:
+    # nuevos + sin_cambios + precio_cambia + otros_cambios + repetidos = filas_excel_validas
+    # (faltantes es del lado del catálogo: códigos que el Excel ya no trae)
+    cambios = []
+    nuevos = []
+    sin_cambios = 0
+    otros_cambios = 0   # cambia descripción/marca/descuento pero no el precio web
+    margenes = []
+
+    for code, ex, prices in _calc_prices_lote(excel_by_code, descuento, config):
+        margenes.append(prices["margen"])
+
+        act = actuales.get(code)
+        if act is None:
+            nuevos.append({
+                "code": code,
+                "description": ex["description"],
+                "usd_price_unit": ex["usd_price_unit"],
+                "bs_price_web": prices["bs_price_web"],
+            })
+            continue
+
+        if act.get("content_hash") == _hash_fila(ex, prices, descuento):
+            sin_cambios += 1
+            continue
+
+        old_web = act.get("bs_price_web")
+        new_web = prices["bs_price_web"]
+        if old_web == new_web:
+            otros_cambios += 1
+            continue
+        cambios.append({
+            "code": code,
+            "description": ex["description"],
+            "old_bs_web": old_web,
+            "new_bs_web": new_web,
+            "delta_bs_web": round(new_web - old_web, 2) if old_web is not None else None,
+            "delta_pct": round((new_web - old_web) * 100.0 / old_web, 2) if old_web else None,
+        })
+
+    faltantes = sorted(c for c in actuales if c not in excel_by_code)
+    por_pct = sorted((c for c in cambios if c["delta_pct"] is not None), key=lambda c: c["delta_pct"])
+    subidas = [c for c in reversed(por_pct) if c["delta_pct"] > 0][:top]
+    bajadas = [c for c in por_pct if c["delta_pct"] < 0][:top]
+
+    preview_id = _guardar_parseo(lista, config)
+
+    return {
+        "ok": True,
+        "preview_id": preview_id,
+        "archivo": os.path.basename(lista["path"]),
+        "descuento_proveedor": descuento,
+        "tipo_cambio": config.tipo_cambio,
+        "filas_excel_validas": lista["filas_excel"],
+        "resumen": {
+            "filas": lista["filas_excel"],
+            "precio_cambia": len(cambios),
+            "suben": sum(1 for c in cambios if (c["delta_bs_web"] or 0) > 0),
+            "bajan": sum(1 for c in cambios if (c["delta_bs_web"] or 0) < 0),
+            "sin_cambios": sin_cambios,
+            "otros_cambios": otros_cambios,
+            "nuevos": len(nuevos),
+            # mismo código en varias filas del Excel: vale la última
+            "repetidos": lista["filas_excel"] - len(excel_by_code),
+            "faltantes": len(faltantes),
+        },
+        "top_subidas": subidas,
+        "top_bajadas": bajadas,
+        "nuevos_detectados": nuevos,
+        "en_json_no_en_excel": faltantes,
+        "margenes": _resumen_margenes(margenes),
+        "tiempos": {
+            "leer_excel": round(lista["t_parse"], 3),
+            "comparar": round(time.perf_counter() - t0, 3),
+        },
+    }
+
+
+def actualizar_precios(descuento_proveedor: Optional[float] = None, progreso=None, preview_id: Optional[str] = None):
+    """
+    progreso: callback opcional progreso(**campos) (lo usa el job en segundo plano
+    para que el panel vea filas leídas / upserts / nuevos mientras corre).
+    preview_id: aplica la lista ya leída en previsualizar_precios() (mismo descuento),
+    sin volver a parsear el Excel. Si venció o el archivo cambió, se vuelve a leer.
+    Si la vista previa se calculó con otro tipo de cambio/tramos que los vigentes
+    (tipo_cambio de prueba, o la config cambió después) no se aplica nada:
+    los precios aprobados no serían los que se escriben.
+    """
+    progreso = progreso or _sin_progreso
+    tiempos: Dict[str, float] = {}
+    t0 = time.perf_counter()
+
+    lista, config_preview = _tomar_parseo(preview_id) if preview_id else (None, None)
+    reutilizado = lista is not None
+    if lista is None:
+        lista = parsear_lista(descuento_proveedor, progreso)
+        if not lista.get("ok"):
+            return lista
+
+    excel_path = lista["path"]
+    excel_by_code = lista["excel_by_code"]
+    filas_excel = lista["filas_excel"]
+    if reutilizado and descuento_proveedor is not None:
+        # el parseo no depende del descuento: se puede aplicar otro distinto al de la vista previa
+        descuento_proveedor = _parse_discount_cell(descuento_proveedor) or float(descuento_proveedor)
+    else:
+        descuento_proveedor = lista["descuento_proveedor"]
+
+    t_parse = 0.0 if reutilizado else lista["t_parse"]
+    progreso(fase="aplicando", filas_leidas=filas_excel, forzar=True)
+
     # ===== 2) Conectar BD + asegurar tablas/columnas =====
+    # Todo el import corre en UNA transacción: o se aplica completo o nada.
     conn = get_connection()
-    cur = conn.cursor()
+    try:
+        cur = conn.cursor()
+        _bloquear_catalogo(cur)
+        config = motor_precios.cargar_config(cur)
+        if config_preview is not None and config.a_dict() != config_preview:
+            return {
+                "ok": False,
+                "config_cambiada": True,
+                "error": "La vista previa se calculó con otro tipo de cambio o tramos que los vigentes: "
+                         "guarde esa configuración o vuelva a previsualizar",
+                "config_preview": config_preview,
+                "config_vigente": config.a_dict(),
+            }
+        resultado = _aplicar_en_bd(
+            cur, excel_by_code, float(descuento_proveedor), tiempos,
+            archivo=os.path.basename(excel_path), filas=filas_excel, config=config,
+        )
+        t = time.perf_counter()
+        conn.commit()
+        tiempos["commit"] = round(time.perf_counter() - t, 3)
+        progreso(
+            fase="terminado",
+            upserts=resultado["actualizados"] + resultado["nuevos"],
+            nuevos=resultado["nuevos"],
+            forzar=True,
+        )
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    tiempos["leer_excel"] = round(t_parse, 3)
+    tiempos["total"] = round(time.perf_counter() - t0, 3)
+    print("INFO actualizar_precios tiempos:", tiempos)
+
+    resultado.update({
+        "ok": True,
+        "filas_excel_validas": filas_excel,
+        "descuento_proveedor": float(descuento_proveedor),
+        "preview_reutilizado": reutilizado,
+        "tiempos": tiempos,
+    })
+    return resultado
+
+
+STAGING_COLS = (
+    "fila", "code", "description", "brand", "usd_price_unit", "proveedor_descuento",
+    "bs_price_proveedor", "margen", "bs_price_web", "bs_price_descuento25",
+    "content_hash",
+)
+
+
+def _hash_fila(ex: Dict[str, Any], prices: Dict[str, float], descuento_proveedor: float) -> str:
+    """Hash de TODO lo que el import escribe en el JSONB: si no cambia, la fila no se toca."""
+    base = json.dumps([
+        ex["description"], ex["brand"], float(ex["usd_price_unit"]), float(descuento_proveedor),
+        prices["bs_price_proveedor"], prices["margen"],
+        prices["bs_price_web"], prices["bs_price_descuento25"],
+    ], ensure_ascii=False)
+    return hashlib.md5(base.encode("utf-8")).hexdigest()
+
+
+def _copy_staging(cur, excel_by_code: Dict[str, Dict[str, Any]], descuento_proveedor: float, config=None):
+    """Carga el Excel ya parseado (con precios calculados) en una tabla temporal vía COPY."""
+    cur.execute("""
+        CREATE TEMP TABLE precios_staging (
+            fila INTEGER NOT NULL,
+            code TEXT PRIMARY KEY,
+            description TEXT NOT NULL,
+            brand TEXT NOT NULL,
+            usd_price_unit NUMERIC NOT NULL,
+            proveedor_descuento NUMERIC NOT NULL,
+            bs_price_proveedor NUMERIC NOT NULL,
+            margen NUMERIC NOT NULL,
+            bs_price_web NUMERIC NOT NULL,
+            bs_price_descuento25 NUMERIC NOT NULL,
+            content_hash TEXT NOT NULL
+        ) ON COMMIT DROP
+    """)
+
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    for fila, (code, ex, prices) in enumerate(_calc_prices_lote(excel_by_code, descuento_proveedor, config)):
+        descuento = float(ex.get("descuento", descuento_proveedor))
+        # repr(float) es exacto: NUMERIC guarda el mismo valor que tendría el JSON de Python
+        w.writerow((
+            fila, code, ex["description"], ex["brand"], repr(float(ex["usd_price_unit"])), repr(descuento),
+            repr(prices["bs_price_proveedor"]), repr(prices["margen"]),
+            repr(prices["bs_price_web"]), repr(prices["bs_price_descuento25"]),
+            _hash_fila(ex, prices, descuento),
+        ))
+    buf.seek(0)
+
+    cur.copy_expert(
+        f"COPY precios_staging ({', '.join(STAGING_COLS)}) FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (description, brand))",
+        buf,
+    )
+
+
+def _num(campo: str) -> str:
+    """Valor numérico del JSONB del catálogo (NULL si falta o no es número)."""
+    return (
+        f"CASE WHEN jsonb_typeof(c.data->'{campo}') = 'number' "
+        f"THEN (c.data->>'{campo}')::numeric END"
+    )
+
+
+def _registrar_historial(cur, import_id: int) -> int:
+    """
+    Guarda (set-based) precio viejo/nuevo de cada código nuevo o con precio distinto.
+    Debe correr ANTES del merge (lee los precios viejos del catálogo).
+    """
+    cur.execute(f"""
+        INSERT INTO precio_historial (
+            code, import_id,
+            old_usd, new_usd,
+            old_bs_web, new_bs_web,
+            old_bs_proveedor, new_bs_proveedor
+        )
+        SELECT
+            s.code, %s,
+            {_num('usd_price_unit')}, s.usd_price_unit,
+            {_num('bs_price_web')}, s.bs_price_web,
+            {_num('bs_price_proveedor')}, s.bs_price_proveedor
+        FROM precios_staging s
+        LEFT JOIN productos_catalogo c ON c.code = s.code
+        WHERE c.code IS NULL
+           OR {_num('usd_price_unit')} IS DISTINCT FROM s.usd_price_unit
+           OR {_num('bs_price_web')} IS DISTINCT FROM s.bs_price_web
+           OR {_num('bs_price_proveedor')} IS DISTINCT FROM s.bs_price_proveedor
+    """, (import_id,))
+    return cur.rowcount
+
+
+def _aplicar_en_bd(cur, excel_by_code: Dict[str, Dict[str, Any]], descuento_proveedor: float,
+                   tiempos: Dict[str, float], archivo: Optional[str] = None, filas: Optional[int] = None,
+                   config=None):
+    t = time.perf_counter()
 
     # Tabla catálogo persistente
     cur.execute("""
@@ -179,147 +556,236 @@ def actualizar_precios(descuento_proveedor: Optional[float] = None):
     cur.execute("ALTER TABLE producto_overrides ADD COLUMN IF NOT EXISTS destacado BOOLEAN DEFAULT FALSE")
     cur.execute("ALTER TABLE producto_overrides ADD COLUMN IF NOT EXISTS orden INTEGER DEFAULT 0")
     cur.execute("ALTER TABLE producto_overrides ADD COLUMN IF NOT EXISTS promo_label TEXT")
-    conn.commit()
 
-    # ===== 3) Leer catálogo existente desde BD =====
-    cur.execute("SELECT code, data FROM productos_catalogo")
-    rows = cur.fetchall() or []
+    # Hash de contenido por fila (detección de cambios entre imports)
+    cur.execute("ALTER TABLE productos_catalogo ADD COLUMN IF NOT EXISTS content_hash TEXT")
+    cur.execute("ALTER TABLE precio_imports ADD COLUMN IF NOT EXISTS tipo_cambio DOUBLE PRECISION")
 
-    db_by_code = {}
-    for rr in rows:
-        c = str(rr.get("code") or "").strip()
-        if c:
-            db_by_code[c] = rr.get("data") or {}
+    if config is None:
+        config = motor_precios.cargar_config(cur)
 
-    db_codes = set(db_by_code.keys())
-    excel_codes = set(excel_by_code.keys())
-    missing = sorted(list(db_codes - excel_codes))
+    # ===== 3) Excel -> staging (COPY) =====
+    _copy_staging(cur, excel_by_code, descuento_proveedor, config)
+    cur.execute("ANALYZE precios_staging")
+    tiempos["staging_copy"] = round(time.perf_counter() - t, 3)
 
-    actualizados = 0
-    nuevos_codigos = []
-    nuevos_detalle = []
+    # ===== 4) Diferencias contra el catálogo (en SQL, sin traer el catálogo a Python) =====
+    t = time.perf_counter()
+    cur.execute("""
+        SELECT c.code
+        FROM productos_catalogo c
+        WHERE NOT EXISTS (SELECT 1 FROM precios_staging s WHERE s.code = c.code)
+        ORDER BY c.code COLLATE "C"
+    """)
+    missing = [r["code"] for r in (cur.fetchall() or [])]
 
+    cur.execute("""
+        SELECT s.code, s.description, s.brand, s.usd_price_unit::float8 AS usd_price_unit
+        FROM precios_staging s
+        WHERE NOT EXISTS (SELECT 1 FROM productos_catalogo c WHERE c.code = s.code)
+        ORDER BY s.fila
+    """)
+    nuevos_detalle = [dict(r) for r in (cur.fetchall() or [])]
+    nuevos_codigos = [r["code"] for r in nuevos_detalle]
+    tiempos["diff"] = round(time.perf_counter() - t, 3)
+
+    # ===== Historial: registro del import + precios viejo/nuevo =====
+    t = time.perf_counter()
+    cur.execute("""
+        INSERT INTO precio_imports (origen, archivo, descuento_proveedor, tipo_cambio, filas)
+        VALUES ('excel', %s, %s, %s, %s)
+        RETURNING id
+    """, (archivo, float(descuento_proveedor), config.tipo_cambio, filas))
+    import_id = cur.fetchone()["id"]
+    historial_filas = _registrar_historial(cur, import_id)
+    tiempos["historial"] = round(time.perf_counter() - t, 3)
+
+    # ===== 5) Merge set-based en el JSONB =====
+    # - existentes: data || nuevos campos (conserva cualquier otra llave que ya tenga)
+    #   SOLO si cambió el content_hash (sin WAL/bloat ni ETag nuevo por filas iguales)
+    # - nuevos: mismo objeto + es_nuevo
+    t = time.perf_counter()
     now = datetime.utcnow().isoformat()
 
-    # ===== 4) Batch buffers para evitar timeout =====
-    upsert_params = []
-    new_params = []
-    override_params = []
-    BATCH_SIZE = 100
-
-    # ===== 5) Procesar Excel =====
-    for code, ex in excel_by_code.items():
-        prices = _calc_prices(ex["usd_price_unit"], float(descuento_proveedor))
-
-        if code in db_by_code:
-            # ---- EXISTENTE ----
-            p = dict(db_by_code[code])
-            p["code"] = code
-            p["description"] = ex.get("description", p.get("description", ""))
-            p["brand"] = ex.get("brand", p.get("brand", "")).strip().lower()
-            p["usd_price_unit"] = ex["usd_price_unit"]
-            p["proveedor_descuento"] = float(descuento_proveedor)
-            p.update(prices)
-
-            upsert_params.append((code, json.dumps(p, ensure_ascii=False), now))
-            actualizados += 1
-
-        else:
-            
-            nuevos_codigos.append(code)
-            nuevos_detalle.append({
-                "code": code,
-                "description": ex.get("description", ""),
-                "brand": ex.get("brand", ""),
-                "usd_price_unit": ex.get("usd_price_unit"),
-            })
+    # placeholder + etiqueta NUEVO (antes del merge: "nuevo" = no estaba en el catálogo)
+    cur.execute("""
+        INSERT INTO producto_overrides (code, oculto, imagen, destacado, orden, promo_label)
+        SELECT s.code, FALSE, 'img/nuevo.jpg', FALSE, 0, 'NUEVO'
+        FROM precios_staging s
+        WHERE NOT EXISTS (SELECT 1 FROM productos_catalogo c WHERE c.code = s.code)
+        ON CONFLICT (code) DO NOTHING
+    """)
 
-            pnew = {
-                "code": code,
-                "description": ex.get("description", ""),
-                "brand": ex.get("brand", ""),
-                "usd_price_unit": ex.get("usd_price_unit"),
-                "proveedor_descuento": float(descuento_proveedor),
-                "es_nuevo": True,
-            }
-            pnew.update(prices)
-
-            new_params.append((code, json.dumps(pnew, ensure_ascii=False), now))
-
-            # placeholder + etiqueta NUEVO 
-            override_params.append((code, "img/nuevo.jpg", "NUEVO"))
-
-        # ===== flush por lotes =====
-        if len(upsert_params) >= BATCH_SIZE:
-            execute_batch(cur, """
-                INSERT INTO productos_catalogo (code, data, updated_at)
-                VALUES (%s, %s::jsonb, %s)
-                ON CONFLICT (code)
-                DO UPDATE SET
-                    data = EXCLUDED.data,
-                    updated_at = EXCLUDED.updated_at
-            """, upsert_params)
-            upsert_params.clear()
-            conn.commit()
-
-
-        if len(new_params) >= BATCH_SIZE:
-            execute_batch(cur, """
-                INSERT INTO productos_catalogo (code, data, updated_at)
-                VALUES (%s, %s::jsonb, %s)
-                ON CONFLICT (code)
-                DO NOTHING
-            """, new_params)
-            new_params.clear()
-            conn.commit()
-
-
-        if len(override_params) >= BATCH_SIZE:
-            execute_batch(cur, """
-                INSERT INTO producto_overrides (code, oculto, imagen, destacado, orden, promo_label)
-                VALUES (%s, FALSE, %s, FALSE, 0, %s)
-                ON CONFLICT (code) DO NOTHING
-            """, override_params)
-            override_params.clear()
-            conn.commit()
-
-
-    # ===== 6) flush final (UNA sola vez) =====
-    if upsert_params:
-        execute_batch(cur, """
-            INSERT INTO productos_catalogo (code, data, updated_at)
-            VALUES (%s, %s::jsonb, %s)
-            ON CONFLICT (code)
-            DO UPDATE SET
-                data = EXCLUDED.data,
-                updated_at = EXCLUDED.updated_at
-        """, upsert_params)
-
-    if new_params:
-        execute_batch(cur, """
-            INSERT INTO productos_catalogo (code, data, updated_at)
-            VALUES (%s, %s::jsonb, %s)
-            ON CONFLICT (code)
-            DO NOTHING
-        """, new_params)
-
-    if override_params:
-        execute_batch(cur, """
-            INSERT INTO producto_overrides (code, oculto, imagen, destacado, orden, promo_label)
-            VALUES (%s, FALSE, %s, FALSE, 0, %s)
-            ON CONFLICT (code) DO NOTHING
-        """, override_params)
-
-    conn.commit()
-    conn.close()
+    cur.execute("""
+        WITH up AS (
+            INSERT INTO productos_catalogo (code, data, updated_at, content_hash)
+            SELECT
+                s.code,
+                jsonb_build_object(
+                    'code', s.code,
+                    'description', s.description,
+                    'brand', s.brand,
+                    'usd_price_unit', s.usd_price_unit,
+                    'proveedor_descuento', s.proveedor_descuento,
+                    'bs_price_proveedor', s.bs_price_proveedor,
+                    'margen', s.margen,
+                    'bs_price_web', s.bs_price_web,
+                    'bs_price_descuento25', s.bs_price_descuento25,
+                    'es_nuevo', TRUE
+                ),
+                %s,
+                s.content_hash
+            FROM precios_staging s
+            ON CONFLICT (code) DO UPDATE SET
+                data = productos_catalogo.data || (EXCLUDED.data - 'es_nuevo'),
+                updated_at = EXCLUDED.updated_at,
+                content_hash = EXCLUDED.content_hash
+            WHERE productos_catalogo.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+            RETURNING (xmax = 0) AS insertado
+        )
+        SELECT
+            COUNT(*) FILTER (WHERE insertado) AS insertados,
+            COUNT(*) FILTER (WHERE NOT insertado) AS actualizados
+        FROM up
+    """, (now,))
+    cnt = cur.fetchone() or {}
+    tiempos["merge"] = round(time.perf_counter() - t, 3)
+
+    cambiados = int(cnt.get("actualizados") or 0)
+    existentes = len(excel_by_code) - len(nuevos_codigos)
+
+    cur.execute("""
+        UPDATE precio_imports
+        SET cambiados = %s, sin_cambios = %s, nuevos = %s, faltantes = %s, tiempos = %s::jsonb
+        WHERE id = %s
+    """, (cambiados, existentes - cambiados, len(nuevos_codigos), len(missing), json.dumps(tiempos), import_id))
 
     return {
-        "ok": True,
-        "actualizados": actualizados,
-        "filas_excel_validas": filas_excel,
-        "descuento_proveedor": float(descuento_proveedor),
+        "import_id": import_id,
+        "tipo_cambio": config.tipo_cambio,
+        "historial_filas": historial_filas,
+        "actualizados": cambiados,
+        "cambiados": cambiados,
+        "sin_cambios": existentes - cambiados,
+        "faltantes": len(missing),
         "en_json_no_en_excel": missing,
         "nuevos": len(nuevos_codigos),
         "nuevos_codigos": nuevos_codigos,
-        "nuevos_detectados": nuevos_detalle
+        "nuevos_detectados": nuevos_detalle,
+    }
+
+
+# =========================================================
+# Repricing: recalcular TODO el catálogo (nuevo tipo de cambio / tramos) sin Excel
+# =========================================================
+
+def repreciar_catalogo(tipo_cambio: Optional[float] = None, tramos=None, guardar: bool = True):
+    """
+    Recalcula los precios de todo el catálogo con el USD y descuento ya guardados en cada
+    producto. tipo_cambio / tramos: cambios a aplicar (se guardan como config vigente si guardar).
+    Solo se escriben filas cuyo precio cambia; queda registrado en precio_imports (origen 'repricing').
+    Lanza ValueError si la config es inválida. Si hay un import de precios corriendo no
+    espera (es un request): devuelve ok=False, ocupado=True.
+    """
+    tiempos: Dict[str, float] = {}
+    t0 = time.perf_counter()
+
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        if not _bloquear_catalogo(cur, esperar=False):
+            return {
+                "ok": False,
+                "ocupado": True,
+                "error": "Hay un import de precios en curso: reintente cuando termine",
+            }
+        cur.execute("ALTER TABLE productos_catalogo ADD COLUMN IF NOT EXISTS content_hash TEXT")
+        cur.execute("ALTER TABLE precio_imports ADD COLUMN IF NOT EXISTS tipo_cambio DOUBLE PRECISION")
+
+        config = motor_precios.cargar_config(cur).con_cambios(tipo_cambio=tipo_cambio, tramos=tramos)
+        if guardar:
+            motor_precios.guardar_config(cur, config)
+
+        t = time.perf_counter()
+        cur.execute("""
+            SELECT
+                code,
+                COALESCE(data->>'description', '') AS description,
+                COALESCE(data->>'brand', '') AS brand,
+                (data->>'usd_price_unit')::float8 AS usd_price_unit,
+                CASE WHEN jsonb_typeof(data->'proveedor_descuento') = 'number'
+                     THEN (data->>'proveedor_descuento')::float8 ELSE 0 END AS descuento
+            FROM productos_catalogo
+            WHERE jsonb_typeof(data->'usd_price_unit') = 'number'
+            ORDER BY code
+        """)
+        filas = {
+            r["code"]: {
+                "description": r["description"],
+                "brand": r["brand"],
+                "usd_price_unit": r["usd_price_unit"],
+                "descuento": r["descuento"],
+            }
+            for r in (cur.fetchall() or [])
+        }
+        tiempos["leer_catalogo"] = round(time.perf_counter() - t, 3)
+
+        t = time.perf_counter()
+        _copy_staging(cur, filas, 0.0, config)
+        cur.execute("ANALYZE precios_staging")
+        tiempos["calculo_staging"] = round(time.perf_counter() - t, 3)
+
+        t = time.perf_counter()
+        cur.execute("""
+            INSERT INTO precio_imports (origen, descuento_proveedor, tipo_cambio, filas)
+            VALUES ('repricing', NULL, %s, %s)
+            RETURNING id
+        """, (config.tipo_cambio, len(filas)))
+        import_id = cur.fetchone()["id"]
+        historial_filas = _registrar_historial(cur, import_id)
+        tiempos["historial"] = round(time.perf_counter() - t, 3)
+
+        t = time.perf_counter()
+        cur.execute("""
+            UPDATE productos_catalogo c
+            SET data = c.data || jsonb_build_object(
+                    'bs_price_proveedor', s.bs_price_proveedor,
+                    'margen', s.margen,
+                    'bs_price_web', s.bs_price_web,
+                    'bs_price_descuento25', s.bs_price_descuento25
+                ),
+                updated_at = %s,
+                content_hash = s.content_hash
+            FROM precios_staging s
+            WHERE c.code = s.code
+              AND c.content_hash IS DISTINCT FROM s.content_hash
+        """, (datetime.utcnow().isoformat(),))
+        cambiados = cur.rowcount
+        tiempos["merge"] = round(time.perf_counter() - t, 3)
+
+        cur.execute("""
+            UPDATE precio_imports
+            SET cambiados = %s, sin_cambios = %s, nuevos = 0, faltantes = 0, tiempos = %s::jsonb
+            WHERE id = %s
+        """, (cambiados, len(filas) - cambiados, json.dumps(tiempos), import_id))
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    tiempos["total"] = round(time.perf_counter() - t0, 3)
+    print("INFO repreciar_catalogo tiempos:", tiempos)
+
+    return {
+        "ok": True,
+        "import_id": import_id,
+        "config": config.a_dict(),
+        "productos": len(filas),
+        "cambiados": cambiados,
+        "sin_cambios": len(filas) - cambiados,
+        "historial_filas": historial_filas,
+        "tiempos": tiempos,
     }
@@ -1,14 +1,17 @@
 from flask import Flask, send_from_directory, request, jsonify, session, send_file
 from flask_cors import CORS
-import os, json, hashlib, secrets
+import os, json, hashlib, secrets, time, uuid
 from datetime import datetime, timedelta
 from io import BytesIO
 from backend.database import get_connection, create_tables
-from werkzeug.security import generate_password_hash, check_password_hash
+from backend import imagenes, compresion, jobs, motor_precios, truper, espejo_imagenes, correo, http_cliente, sesiones, limites, contrasenas, acceso_pedidos
+from backend.estaticos import AssetsEstaticos
 try:
-    from actualizar_precios_openpyxl import actualizar_precios
+    from actualizar_precios_openpyxl import actualizar_precios, previsualizar_precios, repreciar_catalogo
 except Exception as e:
     actualizar_precios = None
+    previsualizar_precios = None
+    repreciar_catalogo = None
     print("WARN: actualizar_precios_openpyxl no disponible:", e)
 from werkzeug.utils import secure_filename
 import traceback
@@ -17,16 +20,10 @@ import psycopg2
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
 from reportlab.lib import colors
-from urllib.request import urlopen
 from reportlab.lib.utils import ImageReader
 import textwrap
 from zoneinfo import ZoneInfo
 from reportlab.pdfbase import pdfmetrics
-import smtplib
-import ssl
-from email.message import EmailMessage
-from urllib.request import Request
-from urllib.parse import quote
 import re
 
 
@@ -63,7 +60,9 @@ def append_pedido_json(pedido_obj: dict):
 BASE_URL = os.environ.get("FRONTEND_BASE_URL", "https://ferrocentral.com.bo")
   # en local puedes usar "http://127.0.0.1:5000"
 
-app = Flask(__name__, static_folder='.', static_url_path='')
+# sin static_folder: la raíz del proyecto (pedidos.json, app.py, Excel...) NO es pública;
+# los archivos públicos salen por ESTATICOS (lista explícita, ver _estatico)
+app = Flask(__name__, static_folder=None)
 
 # ==== COOKIES / SESSION (PROD) ====
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY")  # Render ENV
@@ -80,6 +79,10 @@ app.config["SESSION_COOKIE_SECURE"] = True
 app.config["SESSION_COOKIE_HTTPONLY"] = True
 app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(days=7)
 
+# Sesiones en el servidor (tabla sesiones + LRU en memoria): la cookie solo lleva
+# un ID opaco y se pueden revocar (admin desactivado, reset de contraseña).
+app.session_interface = sesiones.AlmacenSesiones()
+
 
 
 
@@ -113,24 +116,94 @@ def add_cors_headers(resp):
     origin = request.headers.get("Origin")
     if origin in ALLOWED_ORIGINS:
         resp.headers["Access-Control-Allow-Origin"] = origin
-        resp.headers["Vary"] = "Origin"
+        resp.vary.add("Origin")
         resp.headers["Access-Control-Allow-Credentials"] = "true"
         resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
         resp.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, PATCH, DELETE, OPTIONS"
     return resp
 
 
+# Compresión gzip/br de respuestas JSON grandes (catálogo, pedidos, facturas, ...)
+@app.after_request
+def comprimir_respuestas(resp):
+    return compresion.comprimir_respuesta(resp, request.headers.get("Accept-Encoding", ""))
+
+
+# =======================
+# ESTÁTICOS (huella + precompresión)
+# =======================
+# Lista explícita de lo que se sirve (se precomprime al arrancar, en segundo plano)
+# + la carpeta img/. Nada más de la raíz del proyecto es público.
+ESTATICOS_PRECARGA = [
+    "inicio.html", "index.html", "login.html", "admin.html",
+    "registro_empresa.html", "reset_password.html",
+    "styles.css", "productos_precios.json",
+]
+ESTATICOS = AssetsEstaticos(
+    BASE_DIR, os.path.join(BASE_DIR, ".cache_estaticos"),
+    archivos=ESTATICOS_PRECARGA, carpetas=["img"],
+)
+
+import threading
+threading.Thread(target=ESTATICOS.preparar, args=(ESTATICOS_PRECARGA,), daemon=True).start()
+
+
+def _estatico(rel: str, max_age: int = 0):
+    resp = ESTATICOS.respuesta(rel, max_age=max_age)
+    if resp is None:
+        return ("No encontrado", 404)
+    return resp
+
+
+@app.route("/<archivo>")
+def serve_estatico_raiz(archivo):
+    """/admin.html, /reset_password.html, ...: solo lo que está en ESTATICOS_PRECARGA."""
+    if archivo not in ESTATICOS_PRECARGA:
+        return ("No encontrado", 404)
+    return _estatico(archivo, max_age=600 if archivo.endswith(".json") else 0)
+
+
+@app.route("/assets/<huella>/<path:filename>")
+def serve_asset_versionado(huella, filename):
+    """URL con huella: si coincide con el contenido actual se cachea 1 año (immutable)."""
+    e = ESTATICOS.entrada(filename)
+    if not e:
+        return ("No encontrado", 404)
+    if huella != e["hash"]:
+        # huella vieja: servimos lo actual pero sin cache largo
+        return ESTATICOS.respuesta(filename, max_age=0)
+    return ESTATICOS.respuesta(filename, inmutable=True)
+
+
+@app.route("/api/static-manifest")
+def api_static_manifest():
+    """Mapa archivo -> URL con huella (para que el front use URLs inmutables)."""
+    for rel in ESTATICOS_PRECARGA:
+        ESTATICOS.entrada(rel, precomprimir=False)
+    resp = jsonify({"ok": True, "assets": ESTATICOS.manifest()})
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
 
 
 
-def send_reset_email(to_email, link):
+def send_reset_email(to_email, empresa_id):
     """
-    Envío por RESEND (HTTPS) como primera opción (ideal en Render).
-    Si RESEND no está configurado, intenta SMTP.
-    Si SMTP falla o falta config, hace fallback a print (no rompe nada).
+    Encola el correo de reset (backend/correo.py): el request no espera a RESEND/SMTP.
+    El worker lo envía con reintentos y failover RESEND -> SMTP.
+    En la cola solo queda la empresa: el token y el link se generan al enviar
+    (_correo_reset), así el link nunca se guarda en texto plano.
     """
     subject = "Restablecer contraseña - Ferrocentral"
-    body_text = f"""Hola,
+    try:
+        correo.encolar(to_email, subject, tipo="reset_password", ref=str(empresa_id))
+    except Exception as e:
+        print(f"ERROR: no se pudo encolar correo de reset para {to_email} -> {e}")
+
+
+def _cuerpo_reset(link):
+    return f"""Hola,
 
 Se solicitó restablecer la contraseña de tu cuenta en Ferrocentral.
 
@@ -142,84 +215,22 @@ Si tú no solicitaste este cambio, puedes ignorar este correo.
 Ferrocentral
 """
 
-    # =========================================================
-    # 1) RESEND (HTTPS) - recomendado para Render
-    # =========================================================
-    resend_key = os.environ.get("RESEND_API_KEY", "").strip()
-    email_from = os.environ.get("EMAIL_FROM", "contacto@ferrocentral.com.bo").strip()
 
-    if resend_key:
-        try:
-            import requests
-
-            payload = {
-                "from": email_from,
-                "to": [to_email],
-                "subject": subject,
-                "text": body_text
-            }
-
-            r = requests.post(
-                "https://api.resend.com/emails",
-                headers={
-                    "Authorization": f"Bearer {resend_key}",
-                    "Content-Type": "application/json"
-                },
-                json=payload,
-                timeout=15
-            )
-
-            if 200 <= r.status_code < 300:
-                print(f"INFO: RESEND ok -> enviado a {to_email}")
-                return
-            else:
-                print(f"WARN: RESEND falló ({r.status_code}) -> {r.text}")
-
-        except Exception as e:
-            print(f"ERROR: RESEND exception -> {e}")
-
-    # =========================================================
-    # 2) SMTP (backup)
-    # =========================================================
-    smtp_host = os.environ.get("SMTP_HOST", "").strip()
-    smtp_port = int(os.environ.get("SMTP_PORT", "587"))
-    smtp_user = os.environ.get("SMTP_USER", "").strip()
-    smtp_pass = os.environ.get("SMTP_PASS", "").strip()
-    smtp_from = os.environ.get("SMTP_FROM", smtp_user).strip()
-    smtp_tls = os.environ.get("SMTP_TLS", "1").strip()  # "1" o "0"
-
-    if not smtp_host or not smtp_user or not smtp_pass:
-        print("WARN: SMTP no configurado. Link de reset:")
-        print(f"Enviar este enlace a {to_email}: {link}")
-        return
-
-    msg = EmailMessage()
-    msg["Subject"] = subject
-    msg["From"] = smtp_from
-    msg["To"] = to_email
-    msg.set_content(body_text)
 
-    try:
-        if smtp_port == 465:
-            context = ssl.create_default_context()
-            with smtplib.SMTP_SSL(smtp_host, smtp_port, context=context, timeout=15) as server:
-                server.login(smtp_user, smtp_pass)
-                server.send_message(msg)
-        else:
-            with smtplib.SMTP(smtp_host, smtp_port, timeout=15) as server:
-                server.ehlo()
-                if smtp_tls == "1":
-                    server.starttls(context=ssl.create_default_context())
-                    server.ehlo()
-                server.login(smtp_user, smtp_pass)
-                server.send_message(msg)
+# Logo para PDFs cuando no está en disco: se descarga una vez por hora (cliente HTTP compartido)
+LOGO_EMPRESA_URL = "https://ferrocentral.com.bo/img/logos/logo_empresa.png"
+LOGO_REMOTO_TTL = 3600
+_logo_remoto = {"data": None, "ts": 0.0}
 
-        print(f"INFO: SMTP ok -> enviado a {to_email}")
-
-    except Exception as e:
-        print(f"ERROR: SMTP -> {e}")
-        print("Link de reset (fallback):", link)
 
+def _logo_empresa_remoto() -> bytes:
+    if _logo_remoto["data"] is not None and (time.monotonic() - _logo_remoto["ts"]) < LOGO_REMOTO_TTL:
+        return _logo_remoto["data"]
+    r = http_cliente.get(LOGO_EMPRESA_URL, timeout=(3, 10))
+    r.raise_for_status()
+    _logo_remoto["data"] = r.content
+    _logo_remoto["ts"] = time.monotonic()
+    return r.content
 
 
 BO_TZ = ZoneInfo("America/La_Paz")
@@ -322,7 +333,7 @@ def bootstrap_super_admin():
         cur.execute("""
             INSERT INTO admins (username, password_hash, role, active, created_at)
             VALUES (%s, %s, 'SUPER_ADMIN', true, %s)
-        """, (username, generate_password_hash(password), datetime.utcnow()))
+        """, (username, contrasenas.hashear(password), datetime.utcnow()))
 
         conn.commit()
 
@@ -353,21 +364,41 @@ def require_role(*roles):
         return wrapper
     return deco
 
-#  Verifica que un ADMIN solo acceda a pedidos propios
-def forbid_if_not_owner(cur, pedido_id: int):
-    role = session.get("role")
-    if role != "ADMIN":
-        return None  # SUPER_ADMIN pasa
-
-    admin_id = session.get("admin_id")
-    cur.execute("SELECT admin_id FROM pedidos WHERE id = %s", (pedido_id,))
+#  Un ADMIN solo accede a pedidos propios: el filtro va dentro de la consulta
+#  (backend/acceso_pedidos.py), sin un SELECT previo de admin_id
+def alcance_pedidos():
+    return acceso_pedidos.alcance(session.get("role"), session.get("admin_id"))
 
-    row = cur.fetchone()
 
-    if not row or row["admin_id"] != admin_id:
+def respuesta_acceso_pedido(error: str, row=None):
+    if error == acceso_pedidos.PROHIBIDO:
         return jsonify({"ok": False, "error": "No autorizado"}), 403
+    if error == acceso_pedidos.CONFLICTO:
+        return jsonify({
+            "ok": False,
+            "error": "El pedido fue modificado por otra persona. Recarga y vuelve a intentar.",
+            "version": (row or {}).get("version_actual"),
+        }), 412
+    return jsonify({"ok": False, "error": "Pedido no encontrado"}), 404
 
-    return None
+
+def version_if_match():
+    """
+    Versión esperada del pedido según If-Match (concurrencia optimista).
+    Acepta el ETag del detalle ("<version>-<hash>") o solo "<version>".
+    Devuelve (version | None, respuesta_error | None); sin If-Match (o "*") no se chequea.
+    """
+    raw = (request.headers.get("If-Match") or "").strip()
+    if not raw or raw == "*":
+        return None, None
+    tag = raw.split(",")[0].strip()
+    if tag.startswith("W/"):
+        tag = tag[2:]
+    tag = tag.strip('"').split("-")[0]
+    try:
+        return int(tag), None
+    except ValueError:
+        return None, (jsonify({"ok": False, "error": "If-Match inválido"}), 400)
 
 
 def audit(action: str, entity: str, entity_id=None, payload=None):
@@ -466,12 +497,21 @@ try:
     updated_at TIMESTAMP DEFAULT NOW()
     )
     """)
+    # variantes procesadas (webp / miniaturas) de un asset: {"webp": key, "w320": key, ...}
+    cur.execute("ALTER TABLE app_assets ADD COLUMN IF NOT EXISTS variantes JSONB")
 
     cur.execute("ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS tipo TEXT DEFAULT 'pedido'")
     cur.execute("UPDATE pedidos SET tipo='pedido' WHERE tipo IS NULL")
     conn.commit()
     conn.close()
 
+    # Worker de jobs (imports de precios, etc.): retoma pendientes al arrancar
+    jobs.iniciar_worker()
+    # Worker de correos salientes (reintenta lo que quedó pendiente)
+    correo.iniciar_worker()
+    # Worker de sesiones (last_seen por lotes, revocaciones de otros procesos, limpieza)
+    sesiones.iniciar_worker()
+
 except Exception as e:
     # Importante: no crash del proceso (si no, Render reinicia en bucle)
     print("DB INIT ERROR: la app arrancó sin inicializar DB:", e)
@@ -498,8 +538,7 @@ def crear_admin():
     if role not in ("ADMIN", "SUPER_ADMIN"):
         return jsonify({"ok": False, "error": "Rol inválido"}), 400
 
-    from werkzeug.security import generate_password_hash
-    password_hash = generate_password_hash(password)
+    password_hash = contrasenas.hashear(password)
 
     conn = get_connection()
     cur = conn.cursor()
@@ -551,6 +590,9 @@ def activar_desactivar_admin(admin_id):
     cur.execute("UPDATE admins SET active = %s WHERE id = %s", (active, admin_id))
 
     conn.commit()
+    sesiones.invalidar("ADMIN", admin_id)
+    if not active:
+        sesiones.revocar_principal("ADMIN", admin_id)
     audit("ADMIN_ACTIVE", "admin", admin_id, {"active": active})
 
     conn.close()
@@ -576,17 +618,41 @@ def api_audit():
 
 @app.route('/inicio.html')
 def inicio():
-    return send_from_directory('.', 'inicio.html')
+    return _estatico('inicio.html')
 
 
 @app.route('/tienda')
 def tienda():
-    return send_from_directory('.', 'index.html')
+    return _estatico('index.html')
 
 
 @app.route('/login')
 def login():
-    return send_from_directory('.', 'login.html')
+    return _estatico('login.html')
+
+RESET_TOKEN_HORAS = 2
+
+
+def _hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def _buscar_empresa_login(cur, usuario: str, columnas: str = "*"):
+    """
+    Empresa por correo (sin distinguir mayúsculas) o NIT. Dos búsquedas indexadas
+    (lower(correo) y nit) en vez de un OR; si ambas matchean, gana el correo.
+    """
+    cur.execute(f"""
+        SELECT * FROM (
+            (SELECT {columnas}, 1 AS orden_login FROM empresas WHERE lower(correo) = lower(%s) ORDER BY id LIMIT 1)
+            UNION ALL
+            (SELECT {columnas}, 2 AS orden_login FROM empresas WHERE nit = %s LIMIT 1)
+        ) e
+        ORDER BY orden_login
+        LIMIT 1
+    """, (usuario, usuario))
+    return cur.fetchone()
+
 
 @app.route('/api/password_reset_request', methods=['POST'])
 def api_password_reset_request():
@@ -596,40 +662,53 @@ def api_password_reset_request():
     if not usuario:
         return jsonify({"ok": False, "error": "Falta correo o NIT"}), 400
 
+    try:
+        limites.verificar(limites.ip_cliente(request), "reset", usuario,
+                          cubo_ip=limites.RESET_IP, cubo_usuario=limites.RESET_USUARIO)
+    except limites.Bloqueado as b:
+        return _respuesta_bloqueado(b)
+
     conn = get_connection()
     cur = conn.cursor()
 
     # Buscar por correo o por NIT
-    cur.execute("""
-        SELECT id, correo
-        FROM empresas
-        WHERE correo = %s OR nit = %s
-    """, (usuario, usuario))
-
-    row = cur.fetchone()
+    row = _buscar_empresa_login(cur, usuario, "id, correo")
 
     if row is None:
         # Por seguridad, respondemos ok igual, para no revelar si existe o no
         conn.close()
         return jsonify({"ok": True})
 
-    token = secrets.token_urlsafe(32)
-    expira = (datetime.utcnow() + timedelta(hours=2)).isoformat()
+    conn.close()
 
-    cur.execute("""
-    UPDATE empresas
-    SET reset_token = %s, reset_token_expira = %s
-    WHERE id = %s
-""", (token, expira, row["id"]))
+    send_reset_email(row["correo"], row["id"])
+
+    return jsonify({"ok": True})
 
 
+@correo.plantilla("reset_password")
+def _correo_reset(ref):
+    """Lo llama el worker de correo al enviar: emite el token y arma el link."""
+    token = secrets.token_urlsafe(32)
+
+    conn = get_connection()
+    cur = conn.cursor()
+    # limpieza de vencidos (índice por expira_at) y alta del nuevo, guardado hasheado;
+    # un solo token vivo por cuenta: el nuevo invalida los enlaces enviados antes
+    cur.execute("DELETE FROM password_reset_tokens WHERE expira_at < NOW()")
+    cur.execute("DELETE FROM password_reset_tokens WHERE empresa_id = %s", (int(ref),))
+    cur.execute("""
+        INSERT INTO password_reset_tokens (token_hash, empresa_id, expira_at)
+        SELECT %s, id, NOW() + (%s * INTERVAL '1 hour') FROM empresas WHERE id = %s
+        RETURNING empresa_id
+    """, (_hash_token(token), RESET_TOKEN_HORAS, int(ref)))
+    emitido = cur.fetchone()
     conn.commit()
     conn.close()
 
-    link = f"{BASE_URL}/reset_password.html?token={token}"
-    send_reset_email(row["correo"], link)
-
-    return jsonify({"ok": True})
+    if emitido is None:
+        return None  # la empresa ya no existe
+    return _cuerpo_reset(f"{BASE_URL}/reset_password.html?token={token}")
 
 @app.route('/api/password_reset', methods=['POST'])
 def api_password_reset():
@@ -647,36 +726,32 @@ def api_password_reset():
     cur = conn.cursor()
 
     cur.execute("""
-        SELECT id, reset_token_expira
-        FROM empresas
-        WHERE reset_token = %s
-    """, (token,))
+        SELECT empresa_id AS id, expira_at < NOW() AS vencido
+        FROM password_reset_tokens
+        WHERE token_hash = %s
+    """, (_hash_token(token),))
     row = cur.fetchone()
 
     if row is None:
         conn.close()
         return jsonify({"ok": False, "error": "Enlace inválido"}), 400
 
-    expira_str = row["reset_token_expira"]
-    try:
-        expira = datetime.fromisoformat(expira_str) if expira_str else None
-    except Exception:
-        expira = None
-
-    if not expira or expira < datetime.utcnow():
+    if row["vencido"]:
+        cur.execute("DELETE FROM password_reset_tokens WHERE token_hash = %s", (_hash_token(token),))
+        conn.commit()
         conn.close()
         return jsonify({"ok": False, "error": "Enlace vencido, solicita uno nuevo"}), 400
 
-    # Actualizar contraseña
-    new_hash = hashlib.sha256(new_password.encode()).hexdigest()
-    cur.execute("""
-        UPDATE empresas
-        SET password = %s, reset_token = NULL, reset_token_expira = NULL
-        WHERE id = %s
-    """, (new_hash, row["id"]))
+    # Actualizar contraseña (y los enlaces pendientes de esa empresa dejan de valer)
+    new_hash = contrasenas.hashear(new_password)
+    cur.execute("UPDATE empresas SET password = %s WHERE id = %s", (new_hash, row["id"]))
+    cur.execute("DELETE FROM password_reset_tokens WHERE empresa_id = %s", (row["id"],))
 
     conn.commit()
     conn.close()
+    sesiones.invalidar("EMPRESA", row["id"])
+    # la contraseña cambió: cualquier sesión abierta de la empresa queda revocada
+    sesiones.revocar_principal("EMPRESA", row["id"])
 
     return jsonify({"ok": True})
 
@@ -791,9 +866,21 @@ def api_pedidos():
     role = session.get("role")
     admin_id = session.get("admin_id")
 
+    # punto de partida para /api/pedidos/changes: se calcula ANTES de la lista (lo que
+    # cambie en medio se vuelve a entregar, nunca se pierde) y con el mismo corte del feed
+    cur.execute(f"""
+        SELECT COALESCE(
+            (SELECT MIN(version) - 1 FROM pedidos WHERE {_VERSION_NO_ESTABLE}),
+            (SELECT MAX(version) FROM pedidos),
+            0
+        ) AS v
+    """)
+    version_actual = cur.fetchone()["v"]
+
     if role == "ADMIN":
         cur.execute("""
-            SELECT p.id, p.fecha, p.total, p.estado, e.razon_social, COALESCE(p.tipo, 'pedido') AS tipo
+            SELECT p.id, p.fecha, p.total, p.estado, e.razon_social, COALESCE(p.tipo, 'pedido') AS tipo,
+                   p.version
             FROM pedidos p
             JOIN empresas e ON e.id = p.empresa_id
             WHERE p.estado NOT IN ('facturado', 'cancelado')
@@ -802,7 +889,8 @@ def api_pedidos():
         """, (admin_id,))
     else:
         cur.execute("""
-            SELECT p.id, p.fecha, p.total, p.estado, e.razon_social, COALESCE(p.tipo, 'pedido') AS tipo
+            SELECT p.id, p.fecha, p.total, p.estado, e.razon_social, COALESCE(p.tipo, 'pedido') AS tipo,
+                   p.version
             FROM pedidos p
             JOIN empresas e ON e.id = p.empresa_id
             WHERE p.estado NOT IN ('facturado', 'cancelado')
@@ -820,18 +908,133 @@ def api_pedidos():
             pass
 
 
-    return jsonify({"ok": True, "pedidos": [dict(r) for r in rows]})
+    return jsonify({"ok": True, "pedidos": [dict(r) for r in rows], "version": version_actual})
+
+
+CAMBIOS_LIMITE = 500
+
+# Fila cuya versión todavía no es segura para el cursor: el trigger guarda en version_xid
+# el siguiente xid sin asignar justo DESPUÉS de tomar la versión, así que todo escritor con
+# una versión menor ya tenía un xid < version_xid. Si alguno de esos xids sigue abierto
+# (>= xmin del snapshot), esa versión menor puede aparecer todavía: no se pasa de esta fila.
+_VERSION_NO_ESTABLE = "version_xid > pg_snapshot_xmin(pg_current_snapshot())"
+
+
+@app.route('/api/pedidos/changes')
+@require_role("SUPER_ADMIN", "ADMIN")
+def api_pedidos_cambios():
+    """
+    Feed de cambios para el panel: pedidos con version > since_version (alcance del rol),
+    en orden de versión. Incluye facturados/cancelados para que el panel los saque de la lista.
+    El panel guarda "version" de la respuesta y la manda en el próximo sondeo;
+    si "mas" es true hay más cambios y conviene pedir de nuevo enseguida.
+
+    La versión se toma al escribir pero se ve al hacer commit: una escritura larga (PDF del
+    SIAT) puede tener la versión 10 abierta mientras otra ya commiteó la 11. El feed se corta
+    antes de la primera versión que todavía no es segura (_VERSION_NO_ESTABLE, sin mirar el
+    alcance: el pedido abierto puede estar cambiando de admin): se entrega en un sondeo
+    posterior, nunca se salta. Una transacción larga cualquiera demora el feed, no lo rompe.
+    """
+    try:
+        desde = int(request.args.get("since_version", 0))
+        limite = min(CAMBIOS_LIMITE, max(1, int(request.args.get("limit", CAMBIOS_LIMITE))))
+    except ValueError:
+        return jsonify({"ok": False, "error": "since_version inválido"}), 400
+
+    alcance = alcance_pedidos()
+    conn = get_connection()
+    cur = conn.cursor()
+    # índice por version: si no hubo cambios es un index scan vacío
+    cur.execute(f"""
+        WITH tope AS (
+            SELECT MIN(version) AS version
+            FROM pedidos
+            WHERE version > %s AND {_VERSION_NO_ESTABLE}
+        )
+        SELECT p.id, p.fecha, p.total, p.estado, e.razon_social, COALESCE(p.tipo, 'pedido') AS tipo,
+               p.version
+        FROM pedidos p
+        JOIN empresas e ON e.id = p.empresa_id
+        CROSS JOIN tope t
+        WHERE p.version > %s
+          AND (t.version IS NULL OR p.version < t.version)
+          AND (%s::int IS NULL OR p.admin_id = %s)
+        ORDER BY p.version
+        LIMIT %s
+    """, (desde, desde, alcance, alcance, limite + 1))
+    rows = cur.fetchall()
+    conn.close()
+
+    mas = len(rows) > limite
+    rows = rows[:limite]
+    for r in rows:
+        try:
+            r["fecha"] = fmt_fecha_bo(r.get("fecha"))
+        except Exception:
+            pass
+
+    return jsonify({
+        "ok": True,
+        "pedidos": [dict(r) for r in rows],
+        "version": rows[-1]["version"] if rows else desde,
+        "mas": mas,
+    })
 
 # =========================
 # QR BANCARIO (IMAGEN REAL)
 # =========================
 
+# Assets procesados (clave por contenido => inmutables). Cache pequeño en memoria.
+_ASSET_CACHE = {}
+_ASSET_CACHE_MAX = 64
+
+
+def _leer_asset(key: str):
+    hit = _ASSET_CACHE.get(key)
+    if hit is not None:
+        return hit
+
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT mime, data FROM app_assets WHERE key=%s", (key,))
+    row = cur.fetchone()
+    conn.close()
+    if not row or not row.get("data"):
+        return None
+
+    hit = (row.get("mime") or "application/octet-stream", bytes(row["data"]))
+    if len(_ASSET_CACHE) >= _ASSET_CACHE_MAX:
+        _ASSET_CACHE.pop(next(iter(_ASSET_CACHE)))
+    _ASSET_CACHE[key] = hit
+    return hit
+
+
+@app.route('/api/assets/<key>')
+def api_asset(key):
+    """Sirve un asset procesado por su clave de contenido (cache inmutable)."""
+    hit = _leer_asset(key)
+    if not hit:
+        return ("Asset no encontrado", 404)
+
+    mime, data = hit
+    etag = f"\"{key}\""
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if (request.headers.get("If-None-Match") or "").strip() == etag:
+        return ("", 304, headers)
+    headers["Content-Type"] = mime
+    return (data, 200, headers)
+
+
 @app.route('/api/public/qr-banco')
 def api_public_qr_banco():
-    """Devuelve la imagen del QR bancario actual (solo lectura, público)."""
+    """
+    Devuelve la imagen del QR bancario actual (solo lectura, público).
+    ?w=160|320|640 devuelve la miniatura WebP; sin w, si el navegador acepta WebP
+    se sirve la versión WebP (mucho más liviana que la foto original).
+    """
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute("SELECT mime, data FROM app_assets WHERE key='bank_qr' LIMIT 1")
+    cur.execute("SELECT mime, data, sha256, variantes FROM app_assets WHERE key='bank_qr' LIMIT 1")
     row = cur.fetchone()
     conn.close()
 
@@ -842,14 +1045,37 @@ def api_public_qr_banco():
     if isinstance(row, dict):
         mime = row.get("mime") or "image/png"
         data = row.get("data")
+        sha = row.get("sha256") or ""
+        variantes = row.get("variantes") or {}
     else:
         mime = (row[0] or "image/png")
         data = row[1] if len(row) > 1 else None
+        sha = row[2] if len(row) > 2 else ""
+        variantes = (row[3] if len(row) > 3 else None) or {}
 
     if not data:
         return ("QR no configurado", 404)
 
-    return (data, 200, {"Content-Type": mime, "Cache-Control": "no-store"})
+    variante = None
+    w = (request.args.get("w") or "").strip()
+    if w and f"w{w}" in variantes:
+        variante = f"w{w}"
+    elif "webp" in variantes and "image/webp" in (request.headers.get("Accept") or ""):
+        variante = "webp"
+
+    if variante:
+        hit = _leer_asset(variantes[variante])
+        if hit:
+            mime, data = hit
+
+    # El QR puede cambiar bajo la misma URL: revalidar siempre, pero con 304 si no cambió
+    etag = f"\"{sha}-{variante or 'original'}\""
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept"}
+    if sha and (request.headers.get("If-None-Match") or "").strip() == etag:
+        return ("", 304, headers)
+
+    headers["Content-Type"] = mime
+    return (bytes(data), 200, headers)
 
 
 
@@ -874,68 +1100,151 @@ def api_admin_qr_banco_upload():
     if len(data) > 2_000_000:
         return jsonify({"ok": False, "error": "Imagen muy grande (máx 2MB)."}), 400
 
+    # Normalizar (EXIF, tamaño) + WebP + miniaturas. Si Pillow no está, se guarda tal cual.
+    procesadas = None
+    if imagenes.disponible():
+        try:
+            procesadas = imagenes.procesar_imagen(data)
+        except ValueError as e:
+            return jsonify({"ok": False, "error": str(e)}), 400
+
+    if procesadas:
+        mime, _, data = procesadas["original"]
+
     sha = hashlib.sha256(data).hexdigest()
     now = datetime.utcnow()
 
     conn = get_connection()
     cur = conn.cursor()
+
+    variantes = {}
+    if procesadas:
+        variantes = imagenes.guardar_variantes(cur, {k: v for k, v in procesadas.items() if k != "original"})
+
     cur.execute("""
-        INSERT INTO app_assets (key, mime, data, sha256, updated_at)
-        VALUES ('bank_qr', %s, %s, %s, %s)
+        INSERT INTO app_assets (key, mime, data, sha256, updated_at, variantes)
+        VALUES ('bank_qr', %s, %s, %s, %s, %s::jsonb)
         ON CONFLICT (key)
         DO UPDATE SET mime=EXCLUDED.mime,
                       data=EXCLUDED.data,
                       sha256=EXCLUDED.sha256,
-                      updated_at=EXCLUDED.updated_at
-    """, (mime, psycopg2.Binary(data) if "psycopg2" in globals() else data, sha, now))
+                      updated_at=EXCLUDED.updated_at,
+                      variantes=EXCLUDED.variantes
+    """, (mime, psycopg2.Binary(data), sha, now, json.dumps(variantes)))
 
     conn.commit()
     conn.close()
 
-    return jsonify({"ok": True, "sha256": sha, "updated_at": now.isoformat()})
+    return jsonify({
+        "ok": True,
+        "sha256": sha,
+        "updated_at": now.isoformat(),
+        "bytes": len(data),
+        "variantes": {k: f"/api/assets/{v}" for k, v in variantes.items()},
+    })
 
 
 # =========================================================
 # Teleprompter (aviso giratorio) - settings aislado
 # =========================================================
 
-def _ensure_site_settings_table():
-    conn = get_connection()
-    cur = conn.cursor()
+# Cache de site_settings: se carga TODA la tabla en una sola consulta y se sirve
+# desde memoria hasta que vence el TTL o hay una escritura (_set_settings).
+SITE_SETTINGS_TTL = int(os.environ.get("SITE_SETTINGS_TTL", "60"))
+
+_settings_lock = threading.Lock()
+_settings_cache = {"data": None, "ts": 0.0}
+_settings_table_ok = False
+
+
+def _ensure_site_settings_table(cur=None):
+    """CREATE TABLE una sola vez por proceso (no en cada lectura)."""
+    global _settings_table_ok
+    if _settings_table_ok:
+        return
+
+    own = cur is None
+    if own:
+        conn = get_connection()
+        cur = conn.cursor()
     cur.execute("""
         CREATE TABLE IF NOT EXISTS site_settings (
             key TEXT PRIMARY KEY,
             value TEXT NOT NULL
         )
     """)
-    conn.commit()
-    conn.close()
+    if own:
+        conn.commit()
+        conn.close()
+    _settings_table_ok = True
+
+
+def _invalidate_settings():
+    with _settings_lock:
+        _settings_cache["data"] = None
+        _settings_cache["ts"] = 0.0
+
+
+def _get_settings_all() -> dict:
+    """Todas las settings {key: value}, desde cache si no venció."""
+    data = _settings_cache["data"]
+    if data is not None and (time.monotonic() - _settings_cache["ts"]) < SITE_SETTINGS_TTL:
+        return data
+
+    with _settings_lock:
+        # otro hilo pudo recargar mientras esperábamos el lock
+        data = _settings_cache["data"]
+        if data is not None and (time.monotonic() - _settings_cache["ts"]) < SITE_SETTINGS_TTL:
+            return data
+
+        conn = get_connection()
+        try:
+            cur = conn.cursor()
+            _ensure_site_settings_table(cur)
+            cur.execute("SELECT key, value FROM site_settings")
+            rows = cur.fetchall() or []
+            conn.commit()
+        finally:
+            conn.close()
+
+        data = {}
+        for r in rows:
+            # row puede venir como tuple o dict según cursor
+            if isinstance(r, dict):
+                data[r.get("key")] = r.get("value")
+            else:
+                data[r[0]] = r[1]
+
+        _settings_cache["data"] = data
+        _settings_cache["ts"] = time.monotonic()
+        return data
+
 
 def _get_setting(key: str, default: str = "") -> str:
-    _ensure_site_settings_table()
+    value = _get_settings_all().get(key)
+    return value if value is not None else default
+
+
+def _set_settings(values: dict):
+    """Guarda varias settings en UNA transacción e invalida el cache."""
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT value FROM site_settings WHERE key=%s", (key,))
-    row = cur.fetchone()
-    conn.close()
-    if not row:
-        return default
-    # row puede venir como tuple o dict según cursor
-    if isinstance(row, dict):
-        return row.get("value", default)
-    return row[0] if row[0] is not None else default
+    try:
+        cur = conn.cursor()
+        _ensure_site_settings_table(cur)
+        for key, value in values.items():
+            cur.execute("""
+                INSERT INTO site_settings(key,value)
+                VALUES(%s,%s)
+                ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value
+            """, (key, value))
+        conn.commit()
+    finally:
+        conn.close()
+    _invalidate_settings()
+
 
 def _set_setting(key: str, value: str):
-    _ensure_site_settings_table()
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO site_settings(key,value)
-        VALUES(%s,%s)
-        ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value
-    """, (key, value))
-    conn.commit()
-    conn.close()
+    _set_settings({key: value})
 
 @app.route("/api/public/teleprompter", methods=["GET"])
 def api_public_teleprompter():
@@ -982,8 +1291,10 @@ def api_admin_teleprompter_update():
     if not clean:
         return jsonify({"ok": False, "error": "Escribe al menos 1 frase"}), 400
 
-    _set_setting("teleprompter_active", "1" if active else "0")
-    _set_setting("teleprompter_items", " | ".join(clean))
+    _set_settings({
+        "teleprompter_active": "1" if active else "0",
+        "teleprompter_items": " | ".join(clean),
+    })
 
     return jsonify({"ok": True}), 200
 
@@ -1009,18 +1320,17 @@ def api_pedidos_json():
 @require_role("SUPER_ADMIN", "ADMIN")
 
 def api_pedido_detalle(pedido_id):
+    """
+    Cabecera + empresa + metadatos SIAT + items en UNA consulta (json_agg).
+    ETag = "<version>-<md5 de los xmin de pedido, empresa, SIAT e items>":
+    si el panel manda If-None-Match y nada cambió, responde 304 sin cuerpo.
+    El mismo ETag sirve como If-Match al guardar (concurrencia optimista).
+    """
     conn = get_connection()
     cur = conn.cursor()
 
-    blocked = forbid_if_not_owner(cur, pedido_id)
-    if blocked:
-        conn.close()
-        return blocked
-
-
-    # Cabecera del pedido + empresa
-    cur.execute("""
-        SELECT p.id,
+    header, error = acceso_pedidos.obtener(cur, pedido_id, alcance_pedidos(), columnas="""
+               p.id,
                COALESCE(p.tipo, 'pedido') AS tipo,
                p.fecha,
                p.total,
@@ -1034,47 +1344,71 @@ def api_pedido_detalle(pedido_id):
                e.razon_social,
                e.nit,
                e.contacto,
-               COALESCE(e.descuento, 0) AS descuento
-        FROM pedidos p
+               COALESCE(e.descuento, 0) AS descuento,
+               p.version,
+               fs.pedido_id IS NOT NULL AS siat_existe,
+               fs.factura_nro AS siat_factura_nro,
+               fs.cuf AS siat_cuf,
+               fs.filename AS siat_filename,
+               COALESCE(it.items, '[]'::json) AS items,
+               p.version::text || '-' ||
+                   md5(concat_ws(':', p.id::text, p.xmin::text, e.xmin::text, fs.xmin::text, it.versiones)) AS etag
+    """, joins="""
         JOIN empresas e ON e.id = p.empresa_id
-        WHERE p.id = %s
-    """, (pedido_id,))
-    header = cur.fetchone()
-    
-    cur.execute("SELECT 1 FROM pedido_factura_siat WHERE pedido_id=%s", (pedido_id,))
-    header_has_pdf = cur.fetchone() is not None
+        LEFT JOIN pedido_factura_siat fs ON fs.pedido_id = p.id
+        LEFT JOIN LATERAL (
+            SELECT json_agg(json_build_object(
+                       'producto_id', i.producto_id,
+                       'descripcion', i.descripcion,
+                       'cantidad', i.cantidad,
+                       'precio_unit', i.precio_unit
+                   ) ORDER BY i.id) AS items,
+                   string_agg(i.id::text || '.' || i.xmin::text, ',' ORDER BY i.id) AS versiones
+            FROM pedido_items i
+            WHERE i.pedido_id = p.id
+        ) it ON TRUE
+    """)
+    conn.close()
 
+    if error:
+        if error == acceso_pedidos.NO_EXISTE:
+            return jsonify({
+                "ok": False,
+                "error": "Pedido no encontrado",
+                "factura_siat": {"exists": False}
+            }), 404
+        return respuesta_acceso_pedido(error)
+
+    etag = header.pop("etag")
+    if etag in request.if_none_match:
+        resp = app.response_class(status=304)
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "private, no-cache"
+        return resp
+
+    items = header.pop("items") or []
+    factura_siat = {
+        "exists": bool(header.pop("siat_existe")),
+        "factura_nro": header.pop("siat_factura_nro"),
+        "cuf": header.pop("siat_cuf"),
+        "filename": header.pop("siat_filename"),
+    }
 
-    if header is None:
-        conn.close()
-        return jsonify({
-            "ok": False,
-            "error": "Pedido no encontrado",
-            "factura_siat": {"exists": header_has_pdf}
-        }), 404
-    
-    
     #  Ajustar fecha a hora Bolivia también en el DETALLE
     try:
         header["fecha"] = fmt_fecha_bo(header.get("fecha"))
     except Exception:
         pass
 
-
-    # Items del pedido
-    cur.execute("""
-        SELECT producto_id, descripcion, cantidad, precio_unit
-        FROM pedido_items
-        WHERE pedido_id = %s
-    """, (pedido_id,))
-    items = cur.fetchall()
-    conn.close()
-
-    return jsonify({
+    resp = jsonify({
         "ok": True,
         "pedido": dict(header),
-        "items": [dict(i) for i in items]
+        "items": items,
+        "factura_siat": factura_siat,
     })
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
 
 
 @app.route("/api/pedidos/<int:pedido_id>/cotizacion", methods=["POST"])
@@ -1090,22 +1424,16 @@ def api_pedido_actualizar_cotizacion(pedido_id):
     if not isinstance(items, list):
         return jsonify({"ok": False, "error": "items debe ser una lista"}), 400
 
+    version, error_if_match = version_if_match()
+    if error_if_match:
+        return error_if_match
+
     conn = get_connection()
     try:
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
-        blocked = forbid_if_not_owner(cur, pedido_id)
-        if blocked:
-            conn.close()
-            return blocked
-
-        cur.execute("SELECT id FROM pedidos WHERE id=%s", (pedido_id,))
-        if not cur.fetchone():
-            conn.close()
-            return jsonify({"ok": False, "error": "Pedido no existe"}), 404
-
-        total = 0.0
-
+        # Normalizar el payload (si un código viene repetido, gana la última línea)
+        lineas = {}
         for it in items:
             producto_id = str(it.get("producto_id", "")).strip()
             if not producto_id:
@@ -1141,33 +1469,36 @@ def api_pedido_actualizar_cotizacion(pedido_id):
             if precio_final < 0:
                 precio_final = 0.0
 
-            #  Guardar precio_final SIN pisar el precio web (precio_unit)
-            cur.execute("""
-                UPDATE pedido_items
-                SET cantidad=%s,
-                    precio_final=%s
-                WHERE pedido_id=%s AND producto_id=%s
-            """, (cantidad, precio_final, pedido_id, producto_id))
-
-            if cur.rowcount == 0:
-                # si no existía el item, lo insertamos manteniendo precio_unit=0 (o puedes buscarlo luego)
-                cur.execute("""
-                    INSERT INTO pedido_items (pedido_id, producto_id, descripcion, cantidad, precio_unit, precio_final)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (pedido_id, producto_id) DO UPDATE
-                    SET cantidad=EXCLUDED.cantidad,
-                        precio_final=EXCLUDED.precio_final
-                """, (pedido_id, producto_id, descripcion, cantidad, 0.0, precio_final))
-
-
-            total += cantidad * precio_final
+            lineas.pop(producto_id, None)
+            lineas[producto_id] = (producto_id, descripcion, cantidad, precio_final)
 
+        if not lineas:
+            # la cotización reemplaza las líneas: vacía borraría todo el pedido
+            conn.close()
+            return jsonify({"ok": False, "error": "La cotización no tiene items"}), 400
+
+        #  Una sola sentencia: alcance del admin + upsert de líneas (precio_final SIN pisar
+        #  el precio web precio_unit) + borrado de las quitadas + total calculado en SQL
+        #  Con If-Match, si otro admin guardó antes no se pisa nada (412)
+        res, error = acceso_pedidos.guardar_cotizacion(cur, pedido_id, alcance_pedidos(), list(lineas.values()),
+                                                       version_esperada=version)
+        if error:
+            conn.rollback()
+            conn.close()
+            if error == acceso_pedidos.NO_EXISTE:
+                return jsonify({"ok": False, "error": "Pedido no existe"}), 404
+            return respuesta_acceso_pedido(error, res)
 
-        # Guardar total (opcional)
-        cur.execute("UPDATE pedidos SET total=%s WHERE id=%s", (total, pedido_id))
         conn.commit()
+        total = float(res["total"] or 0)
 
-        return jsonify({"ok": True, "total": total})
+        return jsonify({
+            "ok": True,
+            "total": total,
+            "version": res["version"],
+            "lineas": int(res["lineas"]),
+            "borradas": int(res["borradas"]),
+        })
 
     except Exception as e:
         try:
@@ -1192,24 +1523,15 @@ def proforma_pdf(pedido_id):
     conn = get_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
 
-    blocked = forbid_if_not_owner(cur, pedido_id)
-    if blocked:
-        conn.close()
-        return blocked
-
-    # 1 Traer cabecera pedido + empresa
-    cur.execute("""
-        SELECT p.id, p.fecha, p.total, p.estado, p.notas,
+    # 1 Traer cabecera pedido + empresa (alcance del admin incluido)
+    row, error = acceso_pedidos.obtener(cur, pedido_id, alcance_pedidos(), columnas="""
+               p.id, p.fecha, p.total, p.estado, p.notas,
                e.razon_social, e.nit, e.contacto, e.telefono, e.correo,
                COALESCE(e.descuento, 0) AS descuento
-        FROM pedidos p
-        JOIN empresas e ON p.empresa_id = e.id
-        WHERE p.id = %s
-    """, (pedido_id,))
-    row = cur.fetchone()
-    if not row:
+    """, joins="JOIN empresas e ON p.empresa_id = e.id")
+    if error:
         conn.close()
-        return jsonify({"ok": False, "error": "Pedido no encontrado"}), 404
+        return respuesta_acceso_pedido(error)
 
     p_fecha = row.get("fecha")
     p_notas = row.get("notas") or ""
@@ -1302,9 +1624,7 @@ def proforma_pdf(pedido_id):
         if os.path.exists(logo_path):
             _draw_logo(logo_path)
         else:
-            logo_url = "https://ferrocentral.com.bo/img/logos/logo_empresa.png"
-            with urlopen(logo_url, timeout=10) as resp:
-                data = resp.read()
+            data = _logo_empresa_remoto()
             _draw_logo(ImageReader(BytesIO(data)))
     except Exception as e:
         print("⚠️ Logo proforma no cargado:", e)
@@ -1612,24 +1932,15 @@ def generar_factura_pdf(pedido_id):
     conn = get_connection()
     cur = conn.cursor()
 
-    blocked = forbid_if_not_owner(cur, pedido_id)
-    if blocked:
-        conn.close()
-        return blocked
-
-    cur.execute("""
-        SELECT p.id, p.fecha, p.total, p.estado, p.notas,
+    row, error = acceso_pedidos.obtener(cur, pedido_id, alcance_pedidos(), columnas="""
+               p.id, p.fecha, p.total, p.estado, p.notas,
                e.razon_social, e.nit, e.contacto, e.telefono, e.correo,
                COALESCE(e.descuento, 0) AS descuento
-        FROM pedidos p
-        JOIN empresas e ON p.empresa_id = e.id
-        WHERE p.id = %s
-    """, (pedido_id,))
-    row = cur.fetchone()
+    """, joins="JOIN empresas e ON p.empresa_id = e.id")
 
-    if not row:
+    if error:
         conn.close()
-        return jsonify({"ok": False, "error": "Pedido no encontrado"}), 404
+        return respuesta_acceso_pedido(error)
 
     p_id     = row["id"]
     p_fecha  = row.get("fecha") or ""
@@ -1712,9 +2023,7 @@ def generar_factura_pdf(pedido_id):
         if os.path.exists(logo_path):
             _draw_logo_proforma(logo_path)
         else:
-            logo_url = "https://ferrocentral.com.bo/img/logos/logo_empresa.png"
-            with urlopen(logo_url, timeout=10) as resp:
-                data = resp.read()
+            data = _logo_empresa_remoto()
             _draw_logo_proforma(ImageReader(BytesIO(data)))
     except Exception as e:
         print("⚠️ Logo proforma no cargado:", e)
@@ -1871,9 +2180,7 @@ def reporte_facturados():
                 if os.path.exists(logo_path):
                     _draw_logo(logo_path)
                 else:
-                    logo_url = "https://ferrocentral.com.bo/img/logos/logo_empresa.png"
-                    with urlopen(logo_url, timeout=10) as resp:
-                        data = resp.read()
+                    data = _logo_empresa_remoto()
                     _draw_logo(ImageReader(BytesIO(data)))
             except Exception:
                 pass
@@ -2053,24 +2360,25 @@ def api_pedido_cambiar_estado(pedido_id):
     if not nuevo_estado:
         return jsonify({"ok": False, "error": "Estado vacío"}), 400
 
+    version, error_if_match = version_if_match()
+    if error_if_match:
+        return error_if_match
+
     conn = get_connection()
     cur = conn.cursor()
 
-    blocked = forbid_if_not_owner(cur, pedido_id)
-    if blocked:
-        conn.close()
-        return blocked
-
-    cur.execute("UPDATE pedidos SET estado = %s WHERE id = %s", (nuevo_estado, pedido_id))
-    if cur.rowcount == 0:
+    # chequeo de alcance (+ versión si vino If-Match) + UPDATE en una sola sentencia
+    row, error = acceso_pedidos.actualizar(cur, pedido_id, alcance_pedidos(), "estado = %s", (nuevo_estado,),
+                                           version_esperada=version)
+    if error:
         conn.close()
-        return jsonify({"ok": False, "error": "Pedido no encontrado"}), 404
+        return respuesta_acceso_pedido(error, row)
 
     conn.commit()
     audit("PEDIDO_ESTADO", "pedido", pedido_id, {"estado": nuevo_estado})
     conn.close()
 
-    return jsonify({"ok": True, "estado": nuevo_estado})
+    return jsonify({"ok": True, "estado": nuevo_estado, "version": row["version"]})
 
 @app.route("/api/pedidos/<int:pedido_id>/factura_siat", methods=["POST"])
 @require_role("SUPER_ADMIN", "ADMIN")
@@ -2102,14 +2410,23 @@ def subir_factura_siat(pedido_id):
         # Guardar en BD (coincide con database.py: filename, pdf, cuf, factura_nro, emitida_en, uploaded_at)
         now = datetime.utcnow().isoformat()
 
+        version, error_if_match = version_if_match()
+        if error_if_match:
+            return error_if_match
+
         conn = get_connection()
         cur = conn.cursor()
 
-        # Seguridad: ADMIN solo sus pedidos
-        blocked = forbid_if_not_owner(cur, pedido_id)
-        if blocked:
+        # Marcar pedido como facturado (Seguridad: ADMIN solo sus pedidos, en la misma sentencia)
+        row, error = acceso_pedidos.actualizar(
+            cur, pedido_id, alcance_pedidos(),
+            "estado = 'facturado', facturado_en = %s, factura_nro = %s",
+            (now, factura_nro or None),
+            version_esperada=version,
+        )
+        if error:
             conn.close()
-            return blocked
+            return respuesta_acceso_pedido(error, row)
 
         cur.execute("""
             INSERT INTO pedido_factura_siat (pedido_id, filename, pdf, cuf, factura_nro, emitida_en, uploaded_at)
@@ -2123,19 +2440,12 @@ def subir_factura_siat(pedido_id):
                 uploaded_at= EXCLUDED.uploaded_at
         """, (pedido_id, filename, psycopg2.Binary(pdf_bytes), cuf or None, factura_nro or None, now, now))
 
-        # Marcar pedido como facturado
-        cur.execute("""
-            UPDATE pedidos
-            SET estado='facturado', facturado_en=%s, factura_nro=%s
-            WHERE id=%s
-        """, (now, factura_nro or None, pedido_id))
-
         conn.commit()
         conn.close()
 
         audit("FACTURA_SIAT_SUBIDA", "pedido", pedido_id, {"filename": filename, "cuf": cuf, "factura_nro": factura_nro})
 
-        return jsonify(ok=True, filename=filename)
+        return jsonify(ok=True, filename=filename, version=row["version"])
 
     except Exception as e:
         print("❌ ERROR FACTURA SIAT:", str(e))
@@ -2209,20 +2519,16 @@ def api_descargar_factura_siat(pedido_id):
     conn = get_connection()
     cur = conn.cursor()
 
-    blocked = forbid_if_not_owner(cur, pedido_id)
-    if blocked:
-        conn.close()
-        return blocked
-
-    cur.execute("""
-        SELECT filename, pdf
-        FROM pedido_factura_siat
-        WHERE pedido_id = %s
-    """, (pedido_id,))
-    row = cur.fetchone()
+    row, error = acceso_pedidos.obtener(
+        cur, pedido_id, alcance_pedidos(),
+        columnas="fs.pedido_id AS siat_pedido_id, fs.filename, fs.pdf",
+        joins="LEFT JOIN pedido_factura_siat fs ON fs.pedido_id = p.id",
+    )
     conn.close()
 
-    if not row:
+    if error:
+        return respuesta_acceso_pedido(error)
+    if row["siat_pedido_id"] is None:
         return jsonify({"ok": False, "error": "No hay factura SIAT adjunta para este pedido"}), 404
 
     filename = row[0] if isinstance(row, (list, tuple)) else row.get("filename")
@@ -2378,6 +2684,7 @@ def api_actualizar_descuento(empresa_id):
         return jsonify({"ok": False, "error": "Empresa no encontrada"}), 404
 
     conn.commit()
+    sesiones.invalidar("EMPRESA", empresa_id)
     audit("EMPRESA_DESCUENTO", "empresa", empresa_id, {"descuento": descuento})
     conn.close()
 
@@ -2387,40 +2694,123 @@ def api_actualizar_descuento(empresa_id):
 
 @app.route('/registro_empresa')
 def registro_empresa():
-    return send_from_directory('.', 'registro_empresa.html')
+    return _estatico('registro_empresa.html')
 
 
 @app.route('/admin')
 def admin_panel():
-    return send_from_directory('.', 'admin.html')
+    return _estatico('admin.html')
 
 # --- ESTÁTICOS (CSS e imágenes del admin/tienda) ---
 @app.route('/styles.css')
 def serve_styles():
-    return send_from_directory('.', 'styles.css')
+    return _estatico('styles.css', max_age=3600)
 
 @app.route('/img/<path:filename>')
 def serve_img(filename):
-    return send_from_directory('img', filename)
+    return _estatico(f"img/{filename}", max_age=86400)
 
 
+# --- MINIATURAS WEBP de img/ (grillas de la tienda) ---
+IMG_CACHE_DIR = os.path.join(BASE_DIR, ".cache_img")
+_IMG_HASH_MEMO = {}  # (ruta, mtime, size) -> sha del archivo fuente
 
-# ---------------- RUTAS API ----------------
+@app.route('/api/img/<int:ancho>/<path:filename>')
+def serve_img_miniatura(ancho, filename):
+    """
+    Miniatura WebP de una imagen local de img/ (ancho: 160, 320 o 640).
+    Se genera una vez y se guarda en disco con nombre por contenido.
+    """
+    from werkzeug.security import safe_join
+
+    if ancho not in imagenes.THUMB_SIZES:
+        return jsonify({"ok": False, "error": "Ancho no permitido"}), 400
+
+    src = safe_join(os.path.join(BASE_DIR, "img"), filename)
+    if not src or not os.path.isfile(src):
+        return ("Imagen no encontrada", 404)
+
+    if not imagenes.disponible():
+        return send_from_directory('img', filename)
+
+    st = os.stat(src)
+    memo_key = (src, st.st_mtime, st.st_size)
+    sha = _IMG_HASH_MEMO.get(memo_key)
+    if sha is None:
+        with open(src, "rb") as fh:
+            sha = hashlib.sha256(fh.read()).hexdigest()[:24]
+        _IMG_HASH_MEMO[memo_key] = sha
+
+    nombre = f"{sha}-w{ancho}.webp"
+    destino = os.path.join(IMG_CACHE_DIR, nombre)
+    if not os.path.exists(destino):
+        try:
+            with open(src, "rb") as fh:
+                webp = imagenes.miniatura_webp(fh.read(), ancho)
+            os.makedirs(IMG_CACHE_DIR, exist_ok=True)
+            tmp = f"{destino}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, "wb") as fh:
+                fh.write(webp)
+            os.replace(tmp, destino)
+        except Exception as e:
+            print("WARN miniatura img:", filename, e)
+            return send_from_directory('img', filename)
+
+    return send_file(destino, mimetype="image/webp", max_age=86400, etag=sha)
+
+
+ESPEJO_CACHE_DIR = os.path.join(IMG_CACHE_DIR, "espejo")
+_MIME_ESPEJO = {"webp": "image/webp", "jpg": "image/jpeg", "png": "image/png",
+                "gif": "image/gif", "bin": "application/octet-stream"}
+
+
+@app.route('/api/img-espejo/<key>')
+def serve_img_espejo(key):
+    """
+    Imagen externa espejada (clave por contenido => inmutable).
+    Se lee de app_assets una vez y queda en disco; de ahí en más, send_file.
+    """
+    if not re.fullmatch(r"[0-9a-f]{24}\.(webp|jpg|png|gif|bin)", key or ""):
+        return ("Imagen no encontrada", 404)
+
+    destino = os.path.join(ESPEJO_CACHE_DIR, key)
+    if not os.path.exists(destino):
+        conn = get_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT data FROM app_assets WHERE key=%s", (key,))
+        row = cur.fetchone()
+        conn.close()
+        if not row or not row.get("data"):
+            return ("Imagen no encontrada", 404)
+
+        data = bytes(row["data"])
+        try:
+            os.makedirs(ESPEJO_CACHE_DIR, exist_ok=True)
+            tmp = f"{destino}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp, destino)
+        except Exception as e:
+            print("WARN cache img-espejo:", key, e)
+            resp = send_file(BytesIO(data), mimetype=_MIME_ESPEJO.get(key.rsplit(".", 1)[1]),
+                             etag=key.split(".")[0], max_age=31536000)
+            resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+            return resp
+
+    resp = send_file(destino, conditional=True, etag=key.split(".")[0], max_age=31536000)
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp
 
-from flask import make_response
 
 
+# ---------------- RUTAS API ----------------
+
 @app.route("/api/productos_precios.json", methods=["GET"])
 def api_productos_precios_json():
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    path = os.path.join(base_dir, "productos_precios.json")
-
-    if not os.path.exists(path):
+    # precomprimido (br/gzip) + ETag: el JSON pesa varios MB
+    resp = ESTATICOS.respuesta("productos_precios.json", max_age=600)  # 10 minutos
+    if resp is None:
         return jsonify({"ok": False, "error": "No existe productos_precios.json"}), 404
-
-    resp = make_response(send_file(path, mimetype="application/json"))
-    # importante: evitar caché para que veas cambios rápido
-    resp.headers["Cache-Control"] = "public, max-age=600"  # 10 minutos
     return resp
 
 
@@ -2515,7 +2905,8 @@ def api_catalogo():
     try:
         conn = get_connection()
         cur = conn.cursor()
-        cur.execute("SELECT data FROM productos_catalogo")
+        # ORDER BY: mismo contenido => mismo cuerpo => mismo ETag (aunque se reescriban filas)
+        cur.execute("SELECT data FROM productos_catalogo ORDER BY code")
         rows = cur.fetchall() or []
         conn.close()
 
@@ -2713,7 +3104,7 @@ def api_registro_empresa():
     admin_id = session.get("admin_id")
     if not admin_id:
         return jsonify({"ok": False, "error": "Sesión de admin no válida. Vuelve a iniciar sesión."}), 401
-    password_hash = hashlib.sha256(password.encode()).hexdigest()
+    password_hash = contrasenas.hashear(password)
 
 
     try:
@@ -2736,6 +3127,97 @@ def api_registro_empresa():
 
 
 
+def _principal_admin(row) -> dict:
+    return {
+        "role": row["role"],
+        "admin_id": row["id"],
+        "empresa_id": None,
+        "user": row["username"],
+    }
+
+
+def _principal_empresa(row) -> dict:
+    return {
+        "role": "EMPRESA",
+        "admin_id": None,
+        "empresa_id": row["id"],
+        "user": row["correo"],
+        "empresa": {
+            "id": row["id"],
+            "correo": row["correo"],
+            "nit": row["nit"],
+            "razon_social": row.get("razon_social") or "",
+            "descuento": float(row.get("descuento") or 0)
+        },
+    }
+
+
+def _principal_sesion():
+    """
+    Principal de la sesión actual. Sale del cache de la sesión (sin BD) salvo que
+    se haya invalidado (descuento, reset de contraseña, reinicio): ahí se recarga una vez.
+    """
+    principal = sesiones.leer(session)
+    if principal is not None:
+        return principal
+
+    role = session.get("role")
+    if role != "EMPRESA" or not session.get("empresa_id"):
+        principal = {
+            "role": role,
+            "admin_id": session.get("admin_id"),
+            "empresa_id": session.get("empresa_id"),
+            "user": session.get("user"),
+        }
+        sesiones.guardar(session, principal)
+        return principal
+
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, correo, nit, razon_social,
+            COALESCE(descuento, 0) AS descuento
+        FROM empresas
+        WHERE id = %s
+    """, (session["empresa_id"],))
+    emp = cur.fetchone()
+    conn.close()
+    if not emp:
+        return None
+
+    principal = _principal_empresa(emp)
+    principal["user"] = session.get("user")
+    sesiones.guardar(session, principal)
+    return principal
+
+
+def _respuesta_bloqueado(b):
+    resp = jsonify({"ok": False, "error": b.motivo, "reintentar_en_s": b.reintentar_s})
+    resp.headers["Retry-After"] = str(b.reintentar_s)
+    return resp, 429
+
+
+def _registrar_login(tipo, usuario, ok):
+    """
+    Fallo/éxito del login en una conexión corta: el hash (scrypt) se verifica con la
+    conexión ya devuelta, para no retener una del pool durante el cálculo.
+    """
+    try:
+        conn = get_connection()
+    except Exception as e:
+        print(f"WARN: login {tipo} sin registrar ({'exito' if ok else 'fallo'}) -> {e}")
+        return
+    try:
+        cur = conn.cursor()
+        if ok:
+            limites.registrar_exito(cur, tipo, usuario)
+        else:
+            limites.registrar_fallo(cur, tipo, usuario)
+        conn.commit()
+    finally:
+        conn.close()
+
+
 @app.post("/api/auth/login")
 def auth_login():
     data = request.json or {}
@@ -2746,6 +3228,13 @@ def auth_login():
     if not usuario or not password:
         return jsonify({"ok": False, "error": "Faltan datos"}), 400
 
+    # Throttling en memoria: una ráfaga se corta antes de tocar la BD o calcular hashes
+    tipo_limite = "admin" if tipo == "admin" else "empresa"
+    try:
+        limites.verificar(limites.ip_cliente(request), tipo_limite, usuario)
+    except limites.Bloqueado as b:
+        return _respuesta_bloqueado(b)
+
     # ---- LOGIN ADMIN ----
     if tipo == "admin":
         try:
@@ -2754,19 +3243,30 @@ def auth_login():
             return jsonify({"ok": False, "error": "Servidor sin conexión a la base de datos"}), 503
 
         cur = conn.cursor()
+        try:
+            limites.verificar_compartido(cur, "admin", usuario)
+        except limites.Bloqueado as b:
+            conn.close()
+            return _respuesta_bloqueado(b)
+
         cur.execute("SELECT * FROM admins WHERE username = %s AND active = true", (usuario,))
         row = cur.fetchone()
         conn.close()
-        ...
 
-        if not row or not check_password_hash(row["password_hash"], password):
+        if not row or not contrasenas.verificar(row["password_hash"], password):
+            _registrar_login("admin", usuario, False)
             return jsonify({"ok": False, "error": "Credenciales inválidas"}), 401
 
+        _registrar_login("admin", usuario, True)
+        if contrasenas.necesita_rehash(row["password_hash"]):
+            contrasenas.rehash_en_segundo_plano("admins", row["id"], row["password_hash"], password)
+
         session.clear()
         session["role"] = row["role"]          # SUPER_ADMIN o ADMIN
         session["admin_id"] = row["id"]
         session["user"] = row["username"] 
         session.permanent = True
+        sesiones.guardar(session, _principal_admin(row))
 
         audit("LOGIN", "admin", row["id"], {"role": row["role"]})
 
@@ -2774,8 +3274,6 @@ def auth_login():
         return jsonify({"ok": True, "role": row["role"], "redirect": "/admin.html"})
 
     # ---- LOGIN EMPRESA ----
-    password_hash = hashlib.sha256(password.encode()).hexdigest()
-
     try:
         conn = get_connection()
     except Exception:
@@ -2785,21 +3283,32 @@ def auth_login():
         }), 503
 
     cur = conn.cursor()
-    cur.execute("SELECT * FROM empresas WHERE correo = %s OR nit = %s", (usuario, usuario))
-    row = cur.fetchone()
-    conn.close()
+    try:
+        limites.verificar_compartido(cur, "empresa", usuario)
+    except limites.Bloqueado as b:
+        conn.close()
+        return _respuesta_bloqueado(b)
 
+    row = _buscar_empresa_login(cur, usuario)
+    conn.close()
 
-    if not row:
-        return jsonify({"ok": False, "error": "Empresa no encontrada"}), 404
-    if row["password"] != password_hash:
+    if not row or not contrasenas.verificar(row["password"], password):
+        _registrar_login("empresa", usuario, False)
+        if not row:
+            return jsonify({"ok": False, "error": "Empresa no encontrada"}), 404
         return jsonify({"ok": False, "error": "Contraseña incorrecta"}), 401
 
+    _registrar_login("empresa", usuario, True)
+    if contrasenas.necesita_rehash(row["password"]):
+        # sha256 legado (o costo viejo): se actualiza en segundo plano
+        contrasenas.rehash_en_segundo_plano("empresas", row["id"], row["password"], password)
+
     session.clear()
     session["role"] = "EMPRESA"
     session["empresa_id"] = row["id"]
     session["user"] = row["correo"]
     session.permanent = True
+    sesiones.guardar(session, _principal_empresa(row))
     audit("LOGIN", "empresa", row["id"])
 
 
@@ -2858,36 +3367,20 @@ def auth_me():
         "user": session.get("user"),
     }
 
-    # Si es empresa, devolvemos datos básicos
-    if role == "EMPRESA" and session.get("empresa_id"):
-        try:
-            conn = get_connection()
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT id, correo, nit, razon_social,
-                    COALESCE(descuento, 0) AS descuento
-                FROM empresas
-                WHERE id = %s
-            """, (session["empresa_id"],))
-            emp = cur.fetchone()
-            conn.close()
-            if emp:
-                resp["empresa"] = {
-                    "id": emp["id"],
-                    "correo": emp["correo"],
-                    "nit": emp["nit"],
-                    "razon_social": emp.get("razon_social") or "",
-                    "descuento": float(emp.get("descuento") or 0)
-                }
-        except Exception:
-            pass
+    # Si es empresa, devolvemos datos básicos (desde el principal cacheado en la sesión)
+    try:
+        principal = _principal_sesion()
+        if principal and principal.get("empresa"):
+            resp["empresa"] = principal["empresa"]
+    except Exception:
+        pass
 
     return jsonify(resp)
 
 
 
 
-ALLOWED_EXCEL_EXT = {".xlsx", ".xlsm", ".xls"}
+ALLOWED_EXCEL_EXT = {".xlsx", ".xlsm", ".xls", ".csv"}
 
 def _ext_of(filename: str) -> str:
     return os.path.splitext(filename or "")[1].lower()
@@ -2910,26 +3403,27 @@ def api_upload_excel_precios():
     if ext not in ALLOWED_EXCEL_EXT:
         return jsonify({
             "ok": False,
-            "error": f"Extensión no permitida ({ext}). Usa .xlsx o .xlsm"
+            "error": f"Extensión no permitida ({ext}). Usa .xlsx, .xlsm, .xls o .csv"
         }), 400
 
     # 3) guardar en el mismo directorio del app.py (BASE_DIR)
     base_dir = os.path.dirname(os.path.abspath(__file__))
-    # Guardar SIEMPRE con nombre fijo para evitar que se use un Excel viejo
-    tmp_path = os.path.join(base_dir, "proveedor_upload_tmp.xlsm")
-    final_path = os.path.join(base_dir, "proveedor.xlsm")
+    # Guardar SIEMPRE con nombre fijo (conservando la extensión: el lector depende de ella)
+    tmp_path = os.path.join(base_dir, f"proveedor_upload_tmp{ext}")
+    final_path = os.path.join(base_dir, f"proveedor{ext}")
 
     try:
         f.save(tmp_path)
         os.replace(tmp_path, final_path)
 
         # Limpiar posibles archivos viejos que confunden al sistema
-        old_xlsx = os.path.join(base_dir, "proveedor.xlsx")
-        if os.path.exists(old_xlsx):
-            try:
-                os.remove(old_xlsx)
-            except Exception:
-                pass
+        for other_ext in ALLOWED_EXCEL_EXT - {ext}:
+            old_path = os.path.join(base_dir, f"proveedor{other_ext}")
+            if os.path.exists(old_path):
+                try:
+                    os.remove(old_path)
+                except Exception:
+                    pass
 
     except Exception as e:
         return jsonify({"ok": False, "error": f"No se pudo guardar Excel: {e}"}), 500
@@ -2953,106 +3447,136 @@ def api_upload_excel_precios():
 def api_product_overrides_all():
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute("ALTER TABLE producto_overrides ADD COLUMN IF NOT EXISTS destacado BOOLEAN DEFAULT FALSE")
-    cur.execute("ALTER TABLE producto_overrides ADD COLUMN IF NOT EXISTS orden INTEGER DEFAULT 0")
-    cur.execute("ALTER TABLE producto_overrides ADD COLUMN IF NOT EXISTS promo_label TEXT")
-    conn.commit()
 
+    # imagen efectiva: si la URL externa ya tiene espejo local, se sirve la nuestra
     cur.execute("""
     SELECT
-    code,
-    oculto,
-    imagen,
-    COALESCE(destacado,false) AS destacado,
-    COALESCE(orden,0) AS orden,
-    COALESCE(promo_label,'') AS promo_label
-    FROM producto_overrides
+    o.code,
+    o.oculto,
+    o.imagen,
+    e.variantes AS espejo,
+    COALESCE(o.destacado,false) AS destacado,
+    COALESCE(o.orden,0) AS orden,
+    COALESCE(o.promo_label,'') AS promo_label
+    FROM producto_overrides o
+    LEFT JOIN imagenes_espejo e ON e.url = o.imagen AND e.estado = 'ok'
     """)
-    rows = [dict(r) for r in cur.fetchall()]
+    rows = []
+    for r in cur.fetchall():
+        d = dict(r)
+        local = espejo_imagenes.url_efectiva(d.pop("espejo", None))
+        if local:
+            d["imagen_origen"] = d["imagen"]
+            d["imagen"] = local
+        rows.append(d)
     conn.close()
     return jsonify({"ok": True, "overrides": rows})
 
-import re
-import requests
-from urllib.parse import quote
+PLACEHOLDER_IMG = "img/nuevo.jpg"
+LIKE_NUEVO = "%nuevo%"
 
-def _truper_find_image_by_code(code: str):
+
+def _guardar_imagenes_nuevos(cur, resultados: dict, solo_vacias: bool = False):
     """
-    Busca en Truper por código y devuelve una URL de imagen (si encuentra).
-    En modo 'barato' (sin dependencias extra).
+    Upsert (una sola sentencia) de las imágenes encontradas en producto_overrides:
+    - con imagen: la pone si la actual está vacía / es placeholder
+      (solo_vacias=True: solo si es NULL, como hacía /api/admin/autofill-nuevos)
+    - sin imagen: igual asegura promo_label='NUEVO' si estaba vacío
+    Los códigos cuya búsqueda falló (red) no se tocan: no se sabe si tienen imagen.
     """
-    code = str(code).strip()
-    if not code:
-        return None
-
-    # 1) Buscar resultados
-    q = quote(code)
-    search_url = f"https://www.truper.com/catalogsearch/result/?q={q}"
-    r = requests.get(search_url, timeout=12)
-    if r.status_code != 200:
-        return None
-
-    html = r.text
-
-    # 2) Intentar sacar primera imagen del listado (varía, pero suele haber <img ... src="...">
-    # Buscamos una imagen que parezca de catálogo
-    m = re.search(r'<img[^>]+src="([^"]+)"', html, re.IGNORECASE)
-    if not m:
-        return None
+    codes = [c for c, r in resultados.items() if not r.get("error")]
+    if not codes:
+        return
+    imgs = [resultados[c].get("imagen") for c in codes]
 
-    img = m.group(1).strip()
-    if not img:
-        return None
+    if solo_vacias:
+        reemplazar = "producto_overrides.imagen IS NULL"
+    else:
+        reemplazar = (
+            "producto_overrides.imagen IS NULL OR producto_overrides.imagen='' "
+            "OR producto_overrides.imagen=%s OR producto_overrides.imagen ILIKE %s"
+        )
 
-    # Normalizar //...
-    if img.startswith("//"):
-        img = "https:" + img
+    cur.execute(f"""
+        INSERT INTO producto_overrides (code, oculto, imagen, destacado, orden, promo_label)
+        SELECT c, FALSE, i, FALSE, 0, 'NUEVO'
+        FROM unnest(%s::text[], %s::text[]) AS t(c, i)
+        ON CONFLICT (code) DO UPDATE SET
+          imagen = CASE
+            WHEN EXCLUDED.imagen IS NOT NULL AND ({reemplazar})
+            THEN EXCLUDED.imagen
+            ELSE producto_overrides.imagen
+          END,
+          promo_label = CASE
+            WHEN COALESCE(producto_overrides.promo_label,'') = '' THEN 'NUEVO'
+            ELSE producto_overrides.promo_label
+          END
+    """, (codes, imgs) if solo_vacias else (codes, imgs, PLACEHOLDER_IMG, LIKE_NUEVO))
+
+
+def _codigos_nuevos_sin_imagen(cur, limit: int) -> list:
+    """Overrides 'NUEVO' sin imagen (o con placeholder)."""
+    cur.execute("""
+    SELECT code
+    FROM producto_overrides
+    WHERE
+    COALESCE(promo_label,'') ILIKE 'NUEVO%%'
+    AND (
+        imagen IS NULL OR imagen='' OR imagen=%s OR imagen ILIKE %s
+    )
+    ORDER BY code
+    LIMIT %s
+    """, (PLACEHOLDER_IMG, LIKE_NUEVO, limit))
+    return [r["code"] for r in (cur.fetchall() or []) if r.get("code") is not None]
 
-    return img
 
-def _truper_find_image_by_code(code: str):
+def _autofill_imagenes(codes, limit: int, solo_vacias: bool = False, progreso=None) -> dict:
     """
-    Busca una imagen en Truper por código.
-    Devuelve una URL de imagen o None.
-    No revienta el proceso si Truper está lento o cambia algo.
+    Busca (en paralelo, con cache) y guarda imágenes para codes (o para los NUEVO pendientes).
+    La búsqueda puede tardar minutos: no se retiene ninguna conexión mientras tanto,
+    cada tanda que resuelve truper se guarda en su propia conexión.
     """
-    code = str(code).strip()
-    if not code:
-        return None
-
-    # Buscar por código (Truper)
-    search_url = f"https://www.truper.com/catalogsearch/result/?q={quote(code)}"
-    req = Request(
-        search_url,
-        headers={
-            "User-Agent": "Mozilla/5.0 (compatible; FerroCentralBot/1.0)",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-        },
-    )
-
-    try:
-        with urlopen(req, timeout=12) as resp:
-            html = resp.read().decode("utf-8", errors="ignore")
-    except Exception:
-        return None
+    if not codes:
+        conn = get_connection()
+        try:
+            codes = _codigos_nuevos_sin_imagen(conn.cursor(), limit)
+        finally:
+            conn.close()
+    codes = [str(c).strip() for c in codes if str(c).strip()][:limit]
 
-    # Intento 1: imágenes de catálogo (Magento suele usar media/catalog/product)
-    m = re.search(r'(https?://[^"\']+/media/catalog/product/[^"\']+)', html, re.IGNORECASE)
-    if m:
-        return m.group(1).strip()
+    def guardar_lote(lote):
+        conn = get_connection()
+        try:
+            _guardar_imagenes_nuevos(conn.cursor(), lote, solo_vacias=solo_vacias)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
 
-    # Intento 2: cualquier <img src="...">
-    m2 = re.search(r'<img[^>]+src="([^"]+)"', html, re.IGNORECASE)
-    if not m2:
-        return None
+    resultados = truper.buscar_imagenes(codes, progreso=progreso, al_lote=guardar_lote)
 
-    img = (m2.group(1) or "").strip()
-    if not img:
-        return None
-    if img.startswith("//"):
-        img = "https:" + img
+    results = []
+    for code in codes:
+        r = resultados.get(code) or {}
+        if r.get("error"):
+            results.append({"code": code, "ok": False, "error": r["error"]})
+        else:
+            results.append({
+                "code": code, "ok": True, "imagen": r.get("imagen"),
+                "fuente": r.get("fuente"), "origen": r.get("origen"),
+            })
 
-    return img
+    ok = [r for r in results if r["ok"]]
+    return {
+        "ok": True,
+        "processed": len(results),
+        "updated": len(ok),
+        "with_image": sum(1 for r in ok if r.get("imagen")),
+        "from_cache": sum(1 for r in ok if r.get("fuente") == "cache"),
+        "results": results,
+    }
 
 
 @app.route("/api/admin/nuevos/autofill", methods=["POST"])
@@ -3069,123 +3593,17 @@ def api_admin_nuevos_autofill():
     codes = payload.get("codes")
     limit = int(payload.get("limit") or 10)
 
-    # límites sanos para Render $5/mes
+    # límites sanos para un request síncrono (para listas grandes: el job en segundo plano)
     if limit < 1:
         limit = 1
-    if limit > 20:
-        limit = 20
-
-    PLACEHOLDER_IMG = "img/nuevo.jpg"
-    LIKE_NUEVO = "%nuevo%"
-    NUEVO_PREFIX = "NUEVO%"
-
-
-    conn = get_connection()
-    cur = conn.cursor()
-
-    # Asegurar columna promo_label (por si tu tabla es vieja)
-    cur.execute("ALTER TABLE producto_overrides ADD COLUMN IF NOT EXISTS promo_label TEXT")
-    conn.commit()
-
-    # Si no vienen codes, buscamos los "NUEVO" sin imagen (o con placeholder)
-    if not codes:
-        cur.execute("""
-        SELECT code
-        FROM producto_overrides
-        WHERE
-        COALESCE(promo_label,'') ILIKE %s
-        AND (
-            imagen IS NULL OR imagen='' OR imagen=%s OR imagen ILIKE %s
-        )
-        ORDER BY code
-        LIMIT %s
-        """, (NUEVO_PREFIX, PLACEHOLDER_IMG, LIKE_NUEVO, limit))
-        rows = cur.fetchall() or []
-        codes = []
-        for r in rows:
-            if isinstance(r, (list, tuple)):
-                if r:
-                    codes.append(r[0])
-            elif isinstance(r, dict):
-                if r.get("code") is not None:
-                    codes.append(r.get("code"))
-            else:
-                try:
-                    codes.append(r[0])
-                except Exception:
-                    pass
-
+    if limit > 50:
+        limit = 50
 
     # Normalizar lista
-    if not isinstance(codes, list):
-        conn.close()
+    if codes and not isinstance(codes, list):
         return jsonify({"ok": False, "error": "codes debe ser lista o vacío"}), 400
 
-    codes = [str(c).strip() for c in codes if str(c).strip()]
-    codes = codes[:limit]
-
-    results = []
-    updated = 0
-    with_image = 0
-
-    for code in codes:
-        img = None
-        try:
-            img = _truper_find_image_by_code(code)
-
-            # Upsert en overrides:
-            # - si ya tiene imagen, NO la pisa (solo si está vacía/placeholder)
-            if img:
-                cur.execute(
-                    """
-                    INSERT INTO producto_overrides (code, oculto, imagen, destacado, orden, promo_label)
-                    VALUES (%s, FALSE, %s, FALSE, 0, 'NUEVO')
-                    ON CONFLICT (code) DO UPDATE SET
-                      imagen = CASE
-                        WHEN producto_overrides.imagen IS NULL OR producto_overrides.imagen='' OR producto_overrides.imagen=%s OR producto_overrides.imagen ILIKE %s
-                        THEN EXCLUDED.imagen
-                        ELSE producto_overrides.imagen
-                      END,
-                      promo_label = CASE
-                        WHEN COALESCE(producto_overrides.promo_label,'') = '' THEN 'NUEVO'
-                        ELSE producto_overrides.promo_label
-                      END
-                    """,
-                    (code, img, PLACEHOLDER_IMG, LIKE_NUEVO),
-                )
-                with_image += 1
-            else:
-                # Si no encontró imagen, igual aseguramos promo_label="NUEVO"
-                cur.execute(
-                    """
-                    INSERT INTO producto_overrides (code, oculto, imagen, destacado, orden, promo_label)
-                    VALUES (%s, FALSE, NULL, FALSE, 0, 'NUEVO')
-                    ON CONFLICT (code) DO UPDATE SET
-                      promo_label = CASE
-                        WHEN COALESCE(producto_overrides.promo_label,'') = '' THEN 'NUEVO'
-                        ELSE producto_overrides.promo_label
-                      END
-                    """,
-                    (code,),
-                )
-
-            conn.commit()
-            updated += 1
-            results.append({"code": code, "ok": True, "imagen": img})
-        except Exception as e:
-            conn.rollback()
-            results.append({"code": code, "ok": False, "error": str(e)})
-
-    conn.close()
-    return jsonify(
-        {
-            "ok": True,
-            "processed": len(results),
-            "updated": updated,
-            "with_image": with_image,
-            "results": results,
-        }
-    )
+    return jsonify(_autofill_imagenes(codes, limit))
 
 
 
@@ -3203,54 +3621,163 @@ def api_autofill_nuevos():
     if not isinstance(codes, list):
         return jsonify({"ok": False, "error": "codes debe ser una lista"}), 400
 
-    # Limitar para que Render no muera (muy importante en $5/free)
     codes = [str(c).strip() for c in codes if str(c).strip().isdigit()]
-    codes = codes[:10]
+    if not codes:
+        return jsonify({"ok": True, "processed": 0, "results": []})
 
+    r = _autofill_imagenes(codes, 50, solo_vacias=True)
+    return jsonify({"ok": True, "processed": r["processed"], "results": r["results"]})
+
+
+@app.route("/api/admin/truper/metricas", methods=["GET"])
+@require_role("SUPER_ADMIN")
+def api_truper_metricas():
+    """Tasa de acierto por fuente: en este proceso (bytes/tiempos) y acumulada en el cache."""
+    return jsonify({
+        "ok": True,
+        "proceso": truper.metricas(),
+        "cache": truper.metricas_cache(),
+    })
+
+
+ESPEJO_JOB_MAX = 2000
+
+
+@jobs.registrar("espejar_imagenes")
+def _job_espejar_imagenes(params, progreso):
+    conn = get_connection()
+    try:
+        urls = espejo_imagenes.pendientes(conn.cursor(), int(params.get("limit") or ESPEJO_JOB_MAX))
+    finally:
+        conn.close()
+    # espejar abre una conexión por lote: no se retiene una durante las descargas
+    r = espejo_imagenes.espejar(urls, progreso=progreso)
+    # el resultado guardado no necesita el detalle de cada URL ok
+    r["resultados"] = [x for x in r["resultados"] if not x["ok"]][:200]
+    return r
+
+
+@app.route("/api/admin/jobs/espejar-imagenes", methods=["POST"])
+@require_role("SUPER_ADMIN")
+def api_job_espejar_imagenes():
+    """Descarga y espeja las imágenes externas de producto_overrides (202 + job_id)."""
+    data = request.get_json(silent=True) or {}
+    try:
+        limit = min(max(int(data.get("limit") or ESPEJO_JOB_MAX), 1), ESPEJO_JOB_MAX)
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "limit inválido"}), 400
+
+    try:
+        job_id = jobs.encolar(
+            "espejar_imagenes", {"limit": limit},
+            actor_role=session.get("role"), actor_id=session.get("admin_id"),
+            unico=True,
+        )
+    except jobs.JobEnCurso as e:
+        return respuesta_job_en_curso(e)
+    audit("ESPEJO_JOB_ENCOLADO", "job", job_id, {"limit": limit})
+    return jsonify({"ok": True, "job_id": job_id, "poll": f"/api/admin/jobs/{job_id}"}), 202
+
+
+@app.route("/api/admin/imagenes-espejo", methods=["GET"])
+@require_role("SUPER_ADMIN")
+def api_imagenes_espejo_estado():
+    """Resumen del espejo: espejadas, con error, pendientes y últimos errores."""
     conn = get_connection()
     cur = conn.cursor()
+    cur.execute("""
+        SELECT
+            COUNT(*) FILTER (WHERE e.estado = 'ok') AS espejadas,
+            COUNT(*) FILTER (WHERE e.estado = 'error') AS con_error,
+            COUNT(*) FILTER (WHERE e.url IS NULL) AS pendientes
+        FROM (SELECT DISTINCT imagen FROM producto_overrides WHERE imagen ~* '^(https?:)?//') o
+        LEFT JOIN imagenes_espejo e ON e.url = o.imagen
+    """)
+    resumen = dict(cur.fetchone() or {})
+    cur.execute("""
+        SELECT url, error, intentos, updated_at
+        FROM imagenes_espejo
+        WHERE estado = 'error'
+        ORDER BY updated_at DESC
+        LIMIT 20
+    """)
+    errores = [
+        {**dict(r), "updated_at": r["updated_at"].isoformat() if r.get("updated_at") else None}
+        for r in (cur.fetchall() or [])
+    ]
+    conn.close()
+    return jsonify({"ok": True, **resumen, "ultimos_errores": errores})
 
-    # Asegurar columna promo_label
-    cur.execute("ALTER TABLE producto_overrides ADD COLUMN IF NOT EXISTS promo_label TEXT")
-    conn.commit()
 
-    results = []
-    for code in codes:
+AUTOFILL_JOB_MAX = 1000
+
+
+@jobs.registrar("autofill_imagenes")
+def _job_autofill_imagenes(params, progreso):
+    r = _autofill_imagenes(
+        params.get("codes"),
+        int(params.get("limit") or AUTOFILL_JOB_MAX),
+        solo_vacias=bool(params.get("solo_vacias")),
+        progreso=progreso,
+    )
+    # las URLs nuevas de Truper se espejan a continuación (la tienda no depende de su CDN)
+    if r.get("with_image"):
         try:
-            img = _truper_find_image_by_code(code)
-
-            # Si no encontró imagen, no lo pisa
-            if img:
-                cur.execute("""
-                    INSERT INTO producto_overrides (code, oculto, imagen, destacado, orden, promo_label)
-                    VALUES (%s, FALSE, %s, FALSE, 0, 'NUEVO')
-                    ON CONFLICT (code) DO UPDATE SET
-                        imagen = COALESCE(producto_overrides.imagen, EXCLUDED.imagen),
-                        promo_label = CASE
-                            WHEN COALESCE(producto_overrides.promo_label,'') = '' THEN EXCLUDED.promo_label
-                            ELSE producto_overrides.promo_label
-                        END
-                """, (code, img))
-            else:
-                # Si no hay imagen, igual marca "NUEVO" (solo si estaba vacío)
-                cur.execute("""
-                    INSERT INTO producto_overrides (code, oculto, imagen, destacado, orden, promo_label)
-                    VALUES (%s, FALSE, NULL, FALSE, 0, 'NUEVO')
-                    ON CONFLICT (code) DO UPDATE SET
-                        promo_label = CASE
-                            WHEN COALESCE(producto_overrides.promo_label,'') = '' THEN 'NUEVO'
-                            ELSE producto_overrides.promo_label
-                        END
-                """, (code,))
-
-            results.append({"code": code, "ok": True, "imagen": img})
-        except Exception as e:
-            results.append({"code": code, "ok": False, "error": str(e)})
+            jobs.encolar("espejar_imagenes", {"limit": ESPEJO_JOB_MAX}, actor_role="JOB", unico=True)
+        except jobs.JobEnCurso as e:
+            # ya hay un espejo con otro limit: las URLs nuevas quedan para el próximo
+            print(f"WARN: espejo no encolado, ya corre el job {e.job_id}")
+    return r
 
-    conn.commit()
-    conn.close()
 
-    return jsonify({"ok": True, "processed": len(results), "results": results})
+@app.route("/api/admin/jobs/autofill-imagenes", methods=["POST"])
+@require_role("SUPER_ADMIN")
+def api_job_autofill_imagenes():
+    """
+    Busca imágenes en Truper para muchos códigos en segundo plano (202 + job_id).
+    Body: {codes?: [...], limit?: 300}. Sin codes: todos los NUEVO sin imagen.
+    Progreso en GET /api/admin/jobs/<id> (total, procesados, con_imagen, desde_cache).
+    Si ya corre uno con otros codes/limit responde 409 (con su job_id).
+    """
+    data = request.get_json(silent=True) or {}
+    codes = data.get("codes") or None
+    if codes is not None and not isinstance(codes, list):
+        return jsonify({"ok": False, "error": "codes debe ser una lista"}), 400
+
+    try:
+        limit = min(max(int(data.get("limit") or 300), 1), AUTOFILL_JOB_MAX)
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "limit inválido"}), 400
+
+    params = {"limit": limit}
+    if codes:
+        params["codes"] = [str(c).strip() for c in codes if str(c).strip()][:AUTOFILL_JOB_MAX]
+
+    try:
+        job_id = jobs.encolar(
+            "autofill_imagenes", params,
+            actor_role=session.get("role"), actor_id=session.get("admin_id"),
+            unico=True,
+        )
+    except jobs.JobEnCurso as e:
+        return respuesta_job_en_curso(e)
+    audit("AUTOFILL_JOB_ENCOLADO", "job", job_id, {"limit": limit, "codes": len(params.get("codes") or [])})
+    return jsonify({"ok": True, "job_id": job_id, "poll": f"/api/admin/jobs/{job_id}"}), 202
+
+
+def _compat_resultado_precios(r):
+    """Llaves alternativas que usa el panel (evita "undefined")."""
+    if isinstance(r, dict):
+        r.setdefault("updated", r.get("actualizados"))
+        r.setdefault("missing", r.get("en_json_no_en_excel"))
+        r.setdefault("rows", r.get("filas_excel_validas"))
+        r.setdefault("discount", r.get("descuento_proveedor"))
+
+        r.setdefault("filas_excel", r.get("filas_excel_validas"))
+        r.setdefault("descuento", r.get("descuento_proveedor"))
+        r.setdefault("nuevos", r.get("nuevos") if r.get("nuevos") is not None else len(r.get("nuevos_codigos") or []))
+        r.setdefault("nuevos_codigos", r.get("nuevos_codigos") or [x.get("code") for x in (r.get("nuevos_detectados") or []) if isinstance(x, dict)])
+    return r
 
 
 @app.route("/api/admin/actualizar-precios", methods=["POST"])
@@ -3262,8 +3789,12 @@ def api_actualizar_precios():
             "error": "Módulo actualizar_precios no disponible en el servidor"
         }), 500
 
+    data = request.get_json(silent=True) or {}
     try:
-        r = actualizar_precios()
+        r = actualizar_precios(
+            data.get("descuento_proveedor"),
+            preview_id=(data.get("preview_id") or None),
+        )
     except Exception as e:
         import traceback
         tb = traceback.format_exc()
@@ -3275,38 +3806,379 @@ def api_actualizar_precios():
         }), 500
 
     # Compatibilidad con el panel (evita "undefined")
-    if isinstance(r, dict):
-        r.setdefault("updated", r.get("actualizados"))
-        r.setdefault("missing", r.get("en_json_no_en_excel"))
-        r.setdefault("rows", r.get("filas_excel_validas"))
-        r.setdefault("discount", r.get("descuento_proveedor"))
-
-        r.setdefault("filas_excel", r.get("filas_excel_validas"))
-        r.setdefault("descuento", r.get("descuento_proveedor"))
-        r.setdefault("nuevos", r.get("nuevos") if r.get("nuevos") is not None else len(r.get("nuevos_codigos") or []))
-        r.setdefault("nuevos_codigos", r.get("nuevos_codigos") or [x.get("code") for x in (r.get("nuevos_detectados") or []) if isinstance(x, dict)])
+    _compat_resultado_precios(r)
 
+    if r.get("config_cambiada"):
+        return jsonify(r), 409
     return jsonify(r), (200 if r.get("ok") else 500)
 
 
+@app.route("/api/admin/precios/preview", methods=["POST"])
+@require_role("SUPER_ADMIN")
+def api_precios_preview():
+    """
+    Vista previa (dry-run) del import: NO escribe en la BD.
+    Devuelve el resumen de cambios y un preview_id; mandarlo a
+    /api/admin/actualizar-precios (o al job) aplica sin volver a leer el Excel.
+    """
+    if previsualizar_precios is None:
+        return jsonify({
+            "ok": False,
+            "error": "Módulo actualizar_precios no disponible en el servidor"
+        }), 500
 
+    data = request.get_json(silent=True) or {}
+    try:
+        top = min(max(int(data.get("top") or 20), 1), 200)
+    except (TypeError, ValueError):
+        top = 20
 
+    try:
+        r = previsualizar_precios(data.get("descuento_proveedor"), top=top, tipo_cambio=data.get("tipo_cambio"))
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    except Exception as e:
+        tb = traceback.format_exc()
+        print("ERROR en previsualizar_precios():\n", tb)
+        return jsonify({"ok": False, "error": str(e)}), 500
 
+    return jsonify(r), (200 if r.get("ok") else 400)
 
 
+# =========================================================
+# JOBS EN SEGUNDO PLANO (import de precios sin bloquear la web)
+# =========================================================
 
+@jobs.registrar("actualizar_precios")
+def _job_actualizar_precios(params, progreso):
+    if actualizar_precios is None:
+        return {"ok": False, "error": "Módulo actualizar_precios no disponible en el servidor"}
+    r = actualizar_precios(
+        params.get("descuento_proveedor"),
+        progreso=progreso,
+        preview_id=params.get("preview_id"),
+    )
+    return _compat_resultado_precios(r)
 
-@app.route("/api/product_overrides/<code>", methods=["GET", "POST"])
-def api_product_override(code):
+
+@app.route("/api/admin/jobs/actualizar-precios", methods=["POST"])
+@require_role("SUPER_ADMIN")
+def api_job_actualizar_precios():
+    """
+    Encola el import de precios y responde al toque (202).
+    El panel consulta GET /api/admin/jobs/<id> para ver el progreso.
+    Si ya hay un import pendiente/corriendo con los mismos parámetros devuelve ese
+    mismo job; con otros (descuento/preview_id) responde 409.
+    """
+    data = request.get_json(silent=True) or {}
+    params = {}
+    if data.get("descuento_proveedor") is not None:
+        params["descuento_proveedor"] = data.get("descuento_proveedor")
+    if data.get("preview_id"):
+        params["preview_id"] = str(data.get("preview_id"))
+
+    try:
+        job_id = jobs.encolar(
+            "actualizar_precios", params,
+            actor_role=session.get("role"), actor_id=session.get("admin_id"),
+            unico=True,
+        )
+    except jobs.JobEnCurso as e:
+        return respuesta_job_en_curso(e)
+    audit("PRECIOS_JOB_ENCOLADO", "job", job_id, params)
+    return jsonify({"ok": True, "job_id": job_id, "poll": f"/api/admin/jobs/{job_id}"}), 202
+
+
+@app.route("/api/admin/http/metricas", methods=["GET"])
+@require_role("SUPER_ADMIN")
+def api_http_metricas():
+    """Integraciones externas por host: pedidos, errores, reintentos, circuito y latencias p50/p95."""
+    return jsonify({"ok": True, "hosts": http_cliente.metricas()})
+
+
+@app.route("/api/admin/sesiones/metricas", methods=["GET"])
+@require_role("SUPER_ADMIN")
+def api_sesiones_metricas():
+    """Principal en sesión (hits/recargas) y almacén de sesiones (LRU, escrituras, revocaciones)."""
+    return jsonify({"ok": True, **sesiones.metricas()})
+
+
+@app.route("/api/admin/login/metricas", methods=["GET"])
+@require_role("SUPER_ADMIN")
+def api_login_metricas():
+    """Throttling de login/reset: cubos por IP y usuario, bloqueos y rechazos."""
+    return jsonify({"ok": True, **limites.metricas(), "hash": contrasenas.metricas()})
+
+
+@app.route("/api/admin/sesiones/revocar", methods=["POST"])
+@require_role("SUPER_ADMIN")
+def api_sesiones_revocar():
+    """Cierra todas las sesiones de un admin o una empresa. Body: {"tipo": "ADMIN"|"EMPRESA", "id": N}"""
+    data = request.json or {}
+    tipo = (data.get("tipo") or "").strip().upper()
+    try:
+        principal_id = int(data.get("id"))
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "id inválido"}), 400
+    if tipo not in ("ADMIN", "EMPRESA"):
+        return jsonify({"ok": False, "error": "tipo debe ser ADMIN o EMPRESA"}), 400
+
+    n = sesiones.revocar_principal(tipo, principal_id)
+    audit("SESIONES_REVOCADAS", tipo.lower(), principal_id, {"sesiones": n})
+    return jsonify({"ok": True, "revocadas": n})
+
+
+@app.route("/api/admin/correos", methods=["GET"])
+@require_role("SUPER_ADMIN")
+def api_correos_estado():
+    """Estado de la cola de correos salientes (pendientes, fallidos, proveedor usado, errores)."""
+    return jsonify({"ok": True, **correo.estado()})
+
+
+def respuesta_job_en_curso(e: jobs.JobEnCurso):
+    """409: ya corre un job del mismo tipo con otros parámetros (el panel puede seguir ese)."""
+    return jsonify({
+        "ok": False, "error": str(e),
+        "job_id": e.job_id, "poll": f"/api/admin/jobs/{e.job_id}",
+    }), 409
+
+
+@app.route("/api/admin/jobs", methods=["GET"])
+@require_role("SUPER_ADMIN")
+def api_jobs_listar():
+    tipo = (request.args.get("tipo") or "").strip() or None
+    try:
+        limit = int(request.args.get("limit", 20))
+    except Exception:
+        limit = 20
+    limit = min(max(limit, 1), 100)
+    return jsonify({"ok": True, "jobs": jobs.listar(tipo, limit)})
+
+
+@app.route("/api/admin/jobs/<int:job_id>", methods=["GET"])
+@require_role("SUPER_ADMIN")
+def api_job_estado(job_id):
+    """Estado + progreso (sin el resultado completo, para que el polling sea liviano)."""
+    job = jobs.obtener(job_id)
+    if not job:
+        return jsonify({"ok": False, "error": "Job no encontrado"}), 404
+    return jsonify({"ok": True, "job": job})
+
+
+@app.route("/api/admin/jobs/<int:job_id>/resultado", methods=["GET"])
+@require_role("SUPER_ADMIN")
+def api_job_resultado(job_id):
+    job = jobs.obtener(job_id, con_resultado=True)
+    if not job:
+        return jsonify({"ok": False, "error": "Job no encontrado"}), 404
+    if job["estado"] in ("pendiente", "corriendo"):
+        return jsonify({"ok": False, "error": "El job aún no termina", "estado": job["estado"]}), 409
+    return jsonify({"ok": job["estado"] == "ok", "job": job})
+
+
+# =========================================================
+# HISTORIAL DE PRECIOS (qué cambió en cada lista)
+# =========================================================
+
+def _paginacion(default_per_page=50, max_per_page=500):
+    try:
+        page = max(int(request.args.get("page", 1)), 1)
+    except Exception:
+        page = 1
+    try:
+        per_page = int(request.args.get("per_page", default_per_page))
+    except Exception:
+        per_page = default_per_page
+    per_page = min(max(per_page, 1), max_per_page)
+    return page, per_page, (page - 1) * per_page
+
+
+def _fmt_historial(r):
+    d = dict(r)
+    d.pop("total_filas", None)
+    for k in ("created_at", "import_fecha"):
+        if d.get(k) is not None:
+            d[k] = fmt_fecha_bo(d[k])
+    if "new_bs_web" not in d:
+        return d
+    old_web, new_web = d.get("old_bs_web"), d.get("new_bs_web")
+    d["delta_bs_web"] = round(new_web - old_web, 2) if old_web is not None and new_web is not None else None
+    d["delta_pct"] = round((new_web - old_web) * 100.0 / old_web, 2) if old_web and new_web is not None else None
+    return d
+
+
+@app.route("/api/admin/precios/imports", methods=["GET"])
+@require_role("SUPER_ADMIN")
+def api_precio_imports():
+    """Lista paginada de imports (más reciente primero) con sus conteos."""
+    page, per_page, offset = _paginacion(20, 100)
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, origen, archivo, descuento_proveedor, tipo_cambio, filas, cambiados, sin_cambios,
+               nuevos, faltantes, tiempos, created_at,
+               COUNT(*) OVER() AS total_filas
+        FROM precio_imports
+        ORDER BY id DESC
+        LIMIT %s OFFSET %s
+    """, (per_page, offset))
+    rows = cur.fetchall() or []
+    conn.close()
+
+    total = int(rows[0]["total_filas"]) if rows else 0
+    return jsonify({
+        "ok": True,
+        "page": page,
+        "per_page": per_page,
+        "total": total,
+        "imports": [_fmt_historial(r) for r in rows],
+    })
+
+
+@app.route("/api/admin/precios/imports/<int:import_id>/cambios", methods=["GET"])
+@require_role("SUPER_ADMIN")
+def api_precio_import_cambios(import_id):
+    """
+    Diff de un import: precio viejo/nuevo por código.
+    ?orden=code (default) | subida | bajada  — ?solo=nuevos | cambios
+    """
+    page, per_page, offset = _paginacion()
+    orden = (request.args.get("orden") or "code").strip()
+    solo = (request.args.get("solo") or "").strip()
+
+    order_sql = {
+        "subida": "(h.new_bs_web - h.old_bs_web) DESC NULLS LAST, h.code",
+        "bajada": "(h.new_bs_web - h.old_bs_web) ASC NULLS LAST, h.code",
+    }.get(orden, "h.code")
+
+    filtro = ""
+    if solo == "nuevos":
+        filtro = "AND h.old_usd IS NULL"
+    elif solo == "cambios":
+        filtro = "AND h.old_usd IS NOT NULL"
+
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM precio_imports WHERE id = %s", (import_id,))
+    imp = cur.fetchone()
+    if not imp:
+        conn.close()
+        return jsonify({"ok": False, "error": "Import no encontrado"}), 404
+
+    cur.execute(f"""
+        SELECT h.code, c.data->>'description' AS description,
+               h.old_usd, h.new_usd, h.old_bs_web, h.new_bs_web,
+               h.old_bs_proveedor, h.new_bs_proveedor,
+               COUNT(*) OVER() AS total_filas
+        FROM precio_historial h
+        LEFT JOIN productos_catalogo c ON c.code = h.code
+        WHERE h.import_id = %s {filtro}
+        ORDER BY {order_sql}
+        LIMIT %s OFFSET %s
+    """, (import_id, per_page, offset))
+    rows = cur.fetchall() or []
+    conn.close()
+
+    total = int(rows[0]["total_filas"]) if rows else 0
+    return jsonify({
+        "ok": True,
+        "import": _fmt_historial(imp),
+        "page": page,
+        "per_page": per_page,
+        "total": total,
+        "cambios": [_fmt_historial(r) for r in rows],
+    })
+
+
+@app.route("/api/admin/precios/historial/<code>", methods=["GET"])
+@require_role("SUPER_ADMIN")
+def api_precio_historial_producto(code):
+    """Serie de precios de un producto (import más reciente primero)."""
     code = str(code).strip()
+    page, per_page, offset = _paginacion(50, 200)
+
     conn = get_connection()
     cur = conn.cursor()
+    cur.execute("""
+        SELECT h.import_id, i.origen, i.created_at AS import_fecha,
+               h.old_usd, h.new_usd, h.old_bs_web, h.new_bs_web,
+               h.old_bs_proveedor, h.new_bs_proveedor,
+               COUNT(*) OVER() AS total_filas
+        FROM precio_historial h
+        JOIN precio_imports i ON i.id = h.import_id
+        WHERE h.code = %s
+        ORDER BY h.import_id DESC
+        LIMIT %s OFFSET %s
+    """, (code, per_page, offset))
+    rows = cur.fetchall() or []
+    conn.close()
 
-    cur.execute("ALTER TABLE producto_overrides ADD COLUMN IF NOT EXISTS destacado BOOLEAN DEFAULT FALSE")
-    cur.execute("ALTER TABLE producto_overrides ADD COLUMN IF NOT EXISTS orden INTEGER DEFAULT 0")
-    conn.commit()
+    total = int(rows[0]["total_filas"]) if rows else 0
+    return jsonify({
+        "ok": True,
+        "code": code,
+        "page": page,
+        "per_page": per_page,
+        "total": total,
+        "serie": [_fmt_historial(r) for r in rows],
+    })
+
+
+# =========================================================
+# CONFIG DE PRECIOS (tramos de margen + tipo de cambio) y REPRICING
+# =========================================================
+
+@app.route("/api/admin/precios/config", methods=["GET"])
+@require_role("SUPER_ADMIN")
+def api_precios_config():
+    conn = get_connection()
+    cur = conn.cursor()
+    cfg = motor_precios.cargar_config(cur)
+    conn.close()
+    return jsonify({"ok": True, **cfg.a_dict()})
 
 
+@app.route("/api/admin/precios/repreciar", methods=["POST"])
+@require_role("SUPER_ADMIN")
+def api_precios_repreciar():
+    """
+    Recalcula todo el catálogo sin subir Excel.
+    Body: {"tipo_cambio": 6.96, "tramos": [{"hasta_bs": 30, "margen": 0.45}, ..., {"hasta_bs": null, "margen": 0.2}]}
+    (ambos opcionales; lo que venga queda como config vigente).
+    """
+    if repreciar_catalogo is None:
+        return jsonify({
+            "ok": False,
+            "error": "Módulo actualizar_precios no disponible en el servidor"
+        }), 500
+
+    data = request.get_json(silent=True) or {}
+    try:
+        tramos = motor_precios.tramos_desde_json(data["tramos"]) if data.get("tramos") is not None else None
+        tipo_cambio = float(data["tipo_cambio"]) if data.get("tipo_cambio") is not None else None
+        r = repreciar_catalogo(tipo_cambio=tipo_cambio, tramos=tramos)
+    except (TypeError, ValueError) as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    except Exception as e:
+        tb = traceback.format_exc()
+        print("ERROR en repreciar_catalogo():\n", tb)
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+    if r.get("ocupado"):
+        return jsonify(r), 409
+
+    audit("PRECIOS_REPRICING", "precio_imports", r.get("import_id"), {
+        "config": r.get("config"), "cambiados": r.get("cambiados"),
+    })
+    return jsonify(r)
+
+
+@app.route("/api/product_overrides/<code>", methods=["GET", "POST"])
+def api_product_override(code):
+    code = str(code).strip()
+    conn = get_connection()
+    cur = conn.cursor()
+
     if request.method == "GET":
         cur.execute(
             "SELECT code, oculto, imagen, COALESCE(destacado,false) AS destacado, COALESCE(orden,0) AS orden FROM producto_overrides WHERE code = %s",
@@ -0,0 +1,136 @@
+from typing import Optional, Tuple
+
+# Acceso a un pedido con el alcance del rol metido en la MISMA consulta que trae los datos.
+#
+# alcance = admin_id para ADMIN (solo sus pedidos) o None para SUPER_ADMIN (todos).
+# En vez de "SELECT admin_id" + la consulta real, se trae la fila por id y una
+# columna permitido_alcance: sin fila = 404, fila con permitido_alcance falso = 403.
+#
+# Las escrituras aceptan version_esperada (If-Match): pedidos.version la sube un
+# trigger en cada INSERT/UPDATE; si no coincide no se escribe nada (412).
+
+NO_EXISTE = "no_existe"
+PROHIBIDO = "prohibido"
+CONFLICTO = "conflicto"
+
+_PERMITIDO = "(%s::int IS NULL OR p.admin_id = %s) AS permitido_alcance"
+_VERSION_OK = "p.version AS version_actual, (%s::bigint IS NULL OR p.version = %s) AS version_ok"
+
+
+def _resultado(row) -> Tuple[Optional[dict], Optional[str]]:
+    if row is None:
+        return None, NO_EXISTE
+    if not row.pop("permitido_alcance"):
+        return None, PROHIBIDO
+    if not row.pop("version_ok", True):
+        return row, CONFLICTO
+    return row, None
+
+
+def alcance(role: Optional[str], admin_id) -> Optional[int]:
+    """admin_id con el que se filtra; None = sin filtro. Un ADMIN sin id no ve nada (0)."""
+    if role == "ADMIN":
+        return int(admin_id or 0)
+    return None
+
+
+def obtener(cur, pedido_id: int, alcance_admin: Optional[int], columnas: str = "p.id",
+            joins: str = "") -> Tuple[Optional[dict], Optional[str]]:
+    """
+    (fila, None) si existe y está en el alcance; (None, NO_EXISTE | PROHIBIDO) si no.
+    columnas/joins son SQL fijo del llamador (alias p = pedidos), nunca datos del request.
+    """
+    cur.execute(f"""
+        SELECT {_PERMITIDO}, {columnas}
+        FROM pedidos p
+        {joins}
+        WHERE p.id = %s
+    """, (alcance_admin, alcance_admin, pedido_id))
+    return _resultado(cur.fetchone())
+
+
+def actualizar(cur, pedido_id: int, alcance_admin: Optional[int], set_sql: str, params=(),
+               returning: str = "p.id, p.version", version_esperada: Optional[int] = None
+               ) -> Tuple[Optional[dict], Optional[str]]:
+    """
+    UPDATE pedidos p SET <set_sql> con el chequeo de alcance (y de versión) en la misma sentencia.
+    Devuelve (fila RETURNING, None), ({version_actual}, CONFLICTO) o (None, NO_EXISTE | PROHIBIDO).
+    No hace commit.
+    """
+    cur.execute(f"""
+        WITH objetivo AS (
+            SELECT p.id, {_PERMITIDO}, {_VERSION_OK}
+            FROM pedidos p
+            WHERE p.id = %s
+            FOR UPDATE
+        ), actualizado AS (
+            UPDATE pedidos p
+            SET {set_sql}
+            FROM objetivo o
+            WHERE p.id = o.id AND o.permitido_alcance AND o.version_ok
+            RETURNING {returning}
+        )
+        SELECT o.permitido_alcance, o.version_ok, o.version_actual, a.*
+        FROM objetivo o
+        LEFT JOIN actualizado a ON TRUE
+    """, (alcance_admin, alcance_admin, version_esperada, version_esperada, pedido_id, *params))
+    return _resultado(cur.fetchone())
+
+
+def guardar_cotizacion(cur, pedido_id: int, alcance_admin: Optional[int], lineas,
+                       version_esperada: Optional[int] = None) -> Tuple[Optional[dict], Optional[str]]:
+    """
+    Aplica la cotización completa en UNA sentencia:
+    upsert de las líneas (unnest), borrado de las que ya no vienen y total calculado en SQL.
+    lineas: [(producto_id, descripcion, cantidad, precio_final)] sin producto_id repetido.
+    Devuelve ({total, version, lineas, borradas}, None), ({version_actual}, CONFLICTO)
+    o (None, NO_EXISTE | PROHIBIDO). No hace commit.
+    """
+    codigos = [l[0] for l in lineas]
+    cur.execute(f"""
+        WITH objetivo AS (
+            SELECT p.id, {_PERMITIDO}, {_VERSION_OK}
+            FROM pedidos p
+            WHERE p.id = %s
+            FOR UPDATE
+        ), entrada AS (
+            SELECT *
+            FROM unnest(%s::text[], %s::text[], %s::int[], %s::float8[])
+                 AS x(producto_id, descripcion, cantidad, precio_final)
+        ), upsert AS (
+            INSERT INTO pedido_items (pedido_id, producto_id, descripcion, cantidad, precio_unit, precio_final)
+            SELECT o.id, x.producto_id, x.descripcion, x.cantidad, 0.0, x.precio_final
+            FROM entrada x
+            JOIN objetivo o ON o.permitido_alcance AND o.version_ok
+            ON CONFLICT (pedido_id, producto_id) DO UPDATE
+            SET cantidad = EXCLUDED.cantidad,
+                precio_final = EXCLUDED.precio_final
+            RETURNING cantidad, precio_final
+        ), borradas AS (
+            DELETE FROM pedido_items i
+            USING objetivo o
+            WHERE i.pedido_id = o.id AND o.permitido_alcance AND o.version_ok
+              AND i.producto_id <> ALL(%s::text[])
+            RETURNING i.id
+        ), suma AS (
+            SELECT COALESCE(SUM(cantidad * precio_final), 0) AS total, COUNT(*) AS lineas
+            FROM upsert
+        ), actualizado AS (
+            UPDATE pedidos p
+            SET total = s.total
+            FROM objetivo o, suma s
+            WHERE p.id = o.id AND o.permitido_alcance AND o.version_ok
+            RETURNING p.total, p.version
+        )
+        SELECT o.permitido_alcance, o.version_ok, o.version_actual,
+               (SELECT total FROM actualizado) AS total,
+               (SELECT version FROM actualizado) AS version,
+               (SELECT lineas FROM suma) AS lineas,
+               (SELECT COUNT(*) FROM borradas) AS borradas
+        FROM objetivo o
+    """, (
+        alcance_admin, alcance_admin, version_esperada, version_esperada, pedido_id,
+        codigos, [l[1] for l in lineas], [l[2] for l in lineas], [l[3] for l in lineas],
+        codigos,
+    ))
+    return _resultado(cur.fetchone())
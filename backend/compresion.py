@@ -0,0 +1,157 @@
+import gzip
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+try:
+    import brotli
+except Exception:
+    try:
+        import brotlicffi as brotli
+    except Exception:
+        brotli = None
+
+
+GZIP_NIVEL = 6
+
+# Estáticos se comprimen UNA vez (al arrancar): vale la pena el nivel máximo
+BROTLI_NIVEL_ESTATICO = 11
+BROTLI_NIVEL_DINAMICO = 5
+
+EXT_ENCODING = {"br": ".br", "gzip": ".gz"}
+
+
+def encodings_soportados():
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def elegir_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    Elige el mejor encoding que acepta el cliente (br > gzip).
+    Respeta q=0 ("gzip;q=0" => no gzip) y el comodín "*".
+    """
+    if not accept_encoding:
+        return None
+
+    pesos = {}
+    for parte in accept_encoding.split(","):
+        token, _, params = parte.strip().partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        pesos[token] = q
+
+    for enc in encodings_soportados():
+        q = pesos.get(enc, pesos.get("*", 0.0))
+        if q > 0:
+            return enc
+    return None
+
+
+def comprimir(data: bytes, encoding: str, estatico: bool = False) -> bytes:
+    if encoding == "br":
+        nivel = BROTLI_NIVEL_ESTATICO if estatico else BROTLI_NIVEL_DINAMICO
+        return brotli.compress(data, quality=nivel)
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=9 if estatico else GZIP_NIVEL, mtime=0)
+    raise ValueError(f"Encoding no soportado: {encoding}")
+
+
+# =========================================================
+# Compresión de respuestas dinámicas (after_request)
+# =========================================================
+
+MIN_BYTES_RESPUESTA = 1024
+
+TIPOS_COMPRIMIBLES = (
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+    "text/",
+)
+
+# Cache de cuerpos comprimidos para respuestas con ETag (ej. snapshot del catálogo):
+# (etag, encoding) -> bytes. Acotado por bytes totales.
+CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+_cache_lock = threading.Lock()
+_cache = OrderedDict()
+_cache_bytes = 0
+
+
+def _cache_get(key):
+    with _cache_lock:
+        data = _cache.get(key)
+        if data is not None:
+            _cache.move_to_end(key)
+        return data
+
+
+def _cache_put(key, data: bytes):
+    global _cache_bytes
+    if len(data) > CACHE_MAX_BYTES // 4:
+        return
+    with _cache_lock:
+        if key in _cache:
+            return
+        _cache[key] = data
+        _cache_bytes += len(data)
+        while _cache_bytes > CACHE_MAX_BYTES and _cache:
+            _, viejo = _cache.popitem(last=False)
+            _cache_bytes -= len(viejo)
+
+
+def _es_comprimible(mimetype: str) -> bool:
+    mimetype = (mimetype or "").lower()
+    return any(mimetype.startswith(t) for t in TIPOS_COMPRIMIBLES)
+
+
+def comprimir_respuesta(resp, accept_encoding: str):
+    """
+    Comprime en gzip/br una respuesta ya armada si:
+    - es 200, no es streaming ni send_file (direct_passthrough)
+    - el tipo es texto/JSON (PDF, imágenes, zip quedan como están)
+    - supera MIN_BYTES_RESPUESTA
+    Si la respuesta trae ETag y no es no-store, el cuerpo comprimido se cachea.
+    """
+    if resp.status_code != 200 or resp.direct_passthrough or resp.is_streamed:
+        return resp
+    if resp.headers.get("Content-Encoding"):
+        return resp
+    if not _es_comprimible(resp.mimetype):
+        return resp
+
+    data = resp.get_data()
+    if len(data) < MIN_BYTES_RESPUESTA:
+        return resp
+
+    # la respuesta depende de Accept-Encoding aunque este cliente no comprima
+    resp.vary.add("Accept-Encoding")
+
+    enc = elegir_encoding(accept_encoding)
+    if not enc:
+        return resp
+
+    etag = resp.headers.get("ETag")
+    cacheable = bool(etag) and "no-store" not in (resp.headers.get("Cache-Control") or "")
+
+    comprimido = _cache_get((etag, enc)) if cacheable else None
+    if comprimido is None:
+        comprimido = comprimir(data, enc)
+        if cacheable:
+            _cache_put((etag, enc), comprimido)
+
+    if len(comprimido) >= len(data):
+        return resp
+
+    resp.set_data(comprimido)
+    resp.headers["Content-Encoding"] = enc
+    return resp
@@ -0,0 +1,173 @@
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from werkzeug.security import check_password_hash
+
+from backend.database import get_connection
+
+try:
+    from argon2 import PasswordHasher
+    from argon2.exceptions import VerificationError, InvalidHashError
+except Exception:
+    PasswordHasher = None
+
+# Hash de contraseñas (empresas y admins) con costo configurable.
+#
+# Formatos reconocidos (el prefijo dice cómo verificar):
+#   scrypt$<log2 N>$<r>$<p>$<sal b64>$<hash b64>   -> actual (hashlib, sin dependencias)
+#   $argon2id$...                                  -> si PASSWORD_ALGO=argon2 y argon2-cffi instalado
+#   pbkdf2:... / scrypt:...                        -> werkzeug (admins viejos)
+#   64 hex                                         -> sha256 sin sal (empresas viejas)
+#
+# Todo lo que no esté en el formato/costo actual se re-hashea al loguearse bien,
+# en un hilo aparte (la respuesta del login no espera ese segundo hash).
+# Los parámetros se eligen con bench_contrasenas.py.
+
+ALGO = os.getenv("PASSWORD_ALGO", "scrypt").strip().lower()
+SCRYPT_LOG2_N = int(os.getenv("PASSWORD_SCRYPT_LOG2_N", "14"))   # 2^14 ≈ 50 ms, 16 MB
+SCRYPT_R = int(os.getenv("PASSWORD_SCRYPT_R", "8"))
+SCRYPT_P = int(os.getenv("PASSWORD_SCRYPT_P", "1"))
+ARGON2_TIME = int(os.getenv("PASSWORD_ARGON2_TIME", "2"))
+ARGON2_MEMORIA_KB = int(os.getenv("PASSWORD_ARGON2_MEMORIA_KB", "32768"))
+
+SAL_BYTES = 16
+DKLEN = 32
+
+# hashes simultáneos como máximo (cada scrypt usa 128*N*r bytes de RAM)
+CONCURRENCIA = int(os.getenv("PASSWORD_CONCURRENCIA", "2"))
+_slots = threading.BoundedSemaphore(CONCURRENCIA)
+
+_rehash_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rehash")
+
+# tabla -> columna con el hash (lo único que puede tocar el rehash)
+COLUMNAS = {"empresas": "password", "admins": "password_hash"}
+
+_stats = {"verificados": 0, "rehash_pendientes": 0, "rehash_ok": 0, "rehash_perdidos": 0, "rehash_errores": 0}
+
+if ALGO == "argon2" and PasswordHasher is None:
+    print("WARN: PASSWORD_ALGO=argon2 pero argon2-cffi no está instalado; se usa scrypt")
+    ALGO = "scrypt"
+
+_argon2 = PasswordHasher(time_cost=ARGON2_TIME, memory_cost=ARGON2_MEMORIA_KB) if PasswordHasher else None
+
+
+def _b64(b: bytes) -> str:
+    return base64.b64encode(b).decode("ascii").rstrip("=")
+
+
+def _unb64(s: str) -> bytes:
+    return base64.b64decode(s + "=" * (-len(s) % 4))
+
+
+def _scrypt(password: str, sal: bytes, log2_n: int, r: int, p: int) -> bytes:
+    n = 1 << log2_n
+    return hashlib.scrypt(
+        password.encode("utf-8"), salt=sal, n=n, r=r, p=p,
+        maxmem=256 * n * r + 1024 * 1024, dklen=DKLEN,
+    )
+
+
+def hashear(password: str) -> str:
+    with _slots:
+        if ALGO == "argon2":
+            return _argon2.hash(password)
+        sal = secrets.token_bytes(SAL_BYTES)
+        h = _scrypt(password, sal, SCRYPT_LOG2_N, SCRYPT_R, SCRYPT_P)
+    return f"scrypt${SCRYPT_LOG2_N}${SCRYPT_R}${SCRYPT_P}${_b64(sal)}${_b64(h)}"
+
+
+def verificar(guardado: Optional[str], password: str) -> bool:
+    guardado = guardado or ""
+    _stats["verificados"] += 1
+
+    if guardado.startswith("scrypt$"):
+        try:
+            _, log2_n, r, p, sal, h = guardado.split("$")
+            with _slots:
+                calc = _scrypt(password, _unb64(sal), int(log2_n), int(r), int(p))
+            return hmac.compare_digest(calc, _unb64(h))
+        except (ValueError, TypeError):
+            return False
+
+    if guardado.startswith("$argon2"):
+        if _argon2 is None:
+            print("WARN: hay un hash argon2 pero argon2-cffi no está instalado")
+            return False
+        try:
+            with _slots:
+                return _argon2.verify(guardado, password)
+        except (VerificationError, InvalidHashError):
+            return False
+
+    if guardado.startswith("pbkdf2:") or guardado.startswith("scrypt:"):
+        with _slots:
+            return check_password_hash(guardado, password)
+
+    if len(guardado) == 64:
+        # legado: sha256 sin sal
+        calc = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(calc, guardado)
+
+    return False
+
+
+def necesita_rehash(guardado: Optional[str]) -> bool:
+    guardado = guardado or ""
+    if ALGO == "argon2":
+        if not guardado.startswith("$argon2"):
+            return True
+        return _argon2.check_needs_rehash(guardado)
+    if not guardado.startswith("scrypt$"):
+        return True
+    try:
+        _, log2_n, r, p, _, _ = guardado.split("$")
+        return (int(log2_n), int(r), int(p)) != (SCRYPT_LOG2_N, SCRYPT_R, SCRYPT_P)
+    except ValueError:
+        return True
+
+
+def _rehash(tabla: str, fila_id: int, viejo: str, password: str):
+    try:
+        nuevo = hashear(password)
+        conn = get_connection()
+        cur = conn.cursor()
+        # solo si nadie cambió la contraseña mientras tanto (reset en paralelo)
+        cur.execute(
+            f"UPDATE {tabla} SET {COLUMNAS[tabla]} = %s WHERE id = %s AND {COLUMNAS[tabla]} = %s",
+            (nuevo, fila_id, viejo),
+        )
+        ok = cur.rowcount == 1
+        conn.commit()
+        conn.close()
+        _stats["rehash_ok" if ok else "rehash_perdidos"] += 1
+    except Exception as e:
+        _stats["rehash_errores"] += 1
+        print(f"WARN: rehash de {tabla} {fila_id} falló -> {e}")
+    finally:
+        _stats["rehash_pendientes"] -= 1
+
+
+def rehash_en_segundo_plano(tabla: str, fila_id: int, viejo: str, password: str):
+    """Actualiza el hash al formato/costo actual sin demorar la respuesta."""
+    if tabla not in COLUMNAS:
+        raise ValueError(f"Tabla no permitida: {tabla}")
+    _stats["rehash_pendientes"] += 1
+    _rehash_pool.submit(_rehash, tabla, fila_id, viejo, password)
+
+
+def metricas() -> dict:
+    return {
+        "algoritmo": ALGO,
+        "parametros": (
+            {"time_cost": ARGON2_TIME, "memoria_kb": ARGON2_MEMORIA_KB} if ALGO == "argon2"
+            else {"log2_n": SCRYPT_LOG2_N, "r": SCRYPT_R, "p": SCRYPT_P}
+        ),
+        "concurrencia": CONCURRENCIA,
+        **_stats,
+    }
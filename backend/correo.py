@@ -0,0 +1,318 @@
+import os
+import random
+import smtplib
+import ssl
+import threading
+import time
+import traceback
+from email.message import EmailMessage
+from typing import Callable, Dict, List, Optional, Tuple
+
+from backend import http_cliente
+from backend.database import get_connection
+
+# Cola de correos salientes (tabla correos_salientes + hilo worker).
+# El request solo inserta y responde; el worker envía con reintentos, backoff
+# exponencial y failover entre proveedores (RESEND -> SMTP).
+
+MAX_INTENTOS = int(os.getenv("CORREO_MAX_INTENTOS", "5"))
+BACKOFF_BASE_S = 30
+BACKOFF_MAX_S = 3600
+TIMEOUT_S = 15
+LOTE = 10
+
+# "enviando" sin terminar por más de esto = el proceso murió a mitad: se reintenta
+ENVIANDO_VENCIDO_MIN = 10
+
+# tipo -> fn(ref) que arma el cuerpo al momento de enviar (ver plantilla())
+_plantillas: Dict[str, Callable[[str], Optional[str]]] = {}
+
+_despertar = threading.Event()
+_worker: Optional[threading.Thread] = None
+_worker_lock = threading.Lock()
+
+
+class NoConfigurado(Exception):
+    """El proveedor no tiene credenciales: se pasa al siguiente sin contar como falla."""
+
+
+# ---------------- proveedores ----------------
+
+def _enviar_resend(destinatario: str, asunto: str, cuerpo: str):
+    resend_key = os.environ.get("RESEND_API_KEY", "").strip()
+    if not resend_key:
+        raise NoConfigurado("RESEND_API_KEY no configurado")
+    email_from = os.environ.get("EMAIL_FROM", "contacto@ferrocentral.com.bo").strip()
+
+    r = http_cliente.post(
+        "https://api.resend.com/emails",
+        headers={
+            "Authorization": f"Bearer {resend_key}",
+            "Content-Type": "application/json"
+        },
+        json={"from": email_from, "to": [destinatario], "subject": asunto, "text": cuerpo},
+        timeout=(5, TIMEOUT_S),
+    )
+    if not (200 <= r.status_code < 300):
+        raise RuntimeError(f"RESEND {r.status_code}: {r.text[:300]}")
+
+
+def _enviar_smtp(destinatario: str, asunto: str, cuerpo: str):
+    smtp_host = os.environ.get("SMTP_HOST", "").strip()
+    smtp_port = int(os.environ.get("SMTP_PORT", "587"))
+    smtp_user = os.environ.get("SMTP_USER", "").strip()
+    smtp_pass = os.environ.get("SMTP_PASS", "").strip()
+    smtp_from = os.environ.get("SMTP_FROM", smtp_user).strip()
+    smtp_tls = os.environ.get("SMTP_TLS", "1").strip()  # "1" o "0"
+
+    if not smtp_host or not smtp_user or not smtp_pass:
+        raise NoConfigurado("SMTP no configurado")
+
+    msg = EmailMessage()
+    msg["Subject"] = asunto
+    msg["From"] = smtp_from
+    msg["To"] = destinatario
+    msg.set_content(cuerpo)
+
+    if smtp_port == 465:
+        context = ssl.create_default_context()
+        with smtplib.SMTP_SSL(smtp_host, smtp_port, context=context, timeout=TIMEOUT_S) as server:
+            server.login(smtp_user, smtp_pass)
+            server.send_message(msg)
+    else:
+        with smtplib.SMTP(smtp_host, smtp_port, timeout=TIMEOUT_S) as server:
+            server.ehlo()
+            if smtp_tls == "1":
+                server.starttls(context=ssl.create_default_context())
+                server.ehlo()
+            server.login(smtp_user, smtp_pass)
+            server.send_message(msg)
+
+
+# orden = prioridad (failover)
+PROVEEDORES: List[Tuple[str, Callable]] = [
+    ("resend", _enviar_resend),
+    ("smtp", _enviar_smtp),
+]
+
+
+def _enviar(destinatario: str, asunto: str, cuerpo: str) -> str:
+    """Prueba los proveedores en orden. Devuelve el que envió; si ninguno, lanza."""
+    errores = []
+    configurado = False
+    for nombre, fn in PROVEEDORES:
+        try:
+            fn(destinatario, asunto, cuerpo)
+            return nombre
+        except NoConfigurado:
+            continue
+        except Exception as e:
+            configurado = True
+            errores.append(f"{nombre}: {e}")
+            print(f"WARN: correo {nombre} falló -> {e}")
+    if not configurado:
+        raise NoConfigurado("Ningún proveedor de correo configurado")
+    raise RuntimeError(" | ".join(errores))
+
+
+# ---------------- cola ----------------
+
+def plantilla(tipo: str):
+    """
+    Decorador: registra cómo armar el cuerpo de un tipo de correo al enviarlo.
+    La fn recibe la ref encolada y devuelve el cuerpo (None = ya no corresponde
+    enviarlo). Sirve para no guardar secretos (links con token) en la cola.
+    """
+    def deco(fn):
+        _plantillas[tipo] = fn
+        return fn
+    return deco
+
+
+def encolar(destinatario: str, asunto: str, cuerpo: Optional[str] = None,
+            tipo: str = "general", ref: Optional[str] = None) -> int:
+    """Encola un correo: con cuerpo literal, o con ref si el tipo tiene plantilla()."""
+    if cuerpo is None and tipo not in _plantillas:
+        raise ValueError(f"Correo '{tipo}' sin cuerpo ni plantilla")
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO correos_salientes (tipo, destinatario, asunto, cuerpo, ref, max_intentos)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        RETURNING id
+    """, (tipo, destinatario, asunto, cuerpo, ref, MAX_INTENTOS))
+    correo_id = cur.fetchone()["id"]
+    conn.commit()
+    conn.close()
+
+    iniciar_worker()
+    _despertar.set()
+    return correo_id
+
+
+def _backoff(intentos: int) -> float:
+    base = min(BACKOFF_MAX_S, BACKOFF_BASE_S * (2 ** max(0, intentos - 1)))
+    return base * random.uniform(0.8, 1.2)
+
+
+def _tomar_lote():
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE correos_salientes
+        SET estado = 'pendiente'
+        WHERE estado = 'enviando'
+          AND tomado_at < NOW() - (%s * INTERVAL '1 minute')
+    """, (ENVIANDO_VENCIDO_MIN,))
+    cur.execute("""
+        UPDATE correos_salientes
+        SET estado = 'enviando', tomado_at = NOW()
+        WHERE id IN (
+            SELECT id FROM correos_salientes
+            WHERE estado = 'pendiente' AND proximo_intento_at <= NOW()
+            ORDER BY proximo_intento_at, id
+            FOR UPDATE SKIP LOCKED
+            LIMIT %s
+        )
+        RETURNING id, tipo, destinatario, asunto, cuerpo, ref, intentos, max_intentos
+    """, (LOTE,))
+    rows = cur.fetchall() or []
+    conn.commit()
+    conn.close()
+    return rows
+
+
+def _resultado(correo_id: int, estado: str, proveedor=None, error=None, reintento_s: Optional[float] = None):
+    conn = get_connection()
+    cur = conn.cursor()
+    if estado == "pendiente":
+        cur.execute("""
+            UPDATE correos_salientes
+            SET estado = 'pendiente', intentos = intentos + 1, ultimo_error = %s,
+                proximo_intento_at = NOW() + (%s * INTERVAL '1 second')
+            WHERE id = %s
+        """, (error, reintento_s, correo_id))
+    else:
+        # enviado / fallido: el cuerpo (puede traer links con token) ya no hace falta
+        cur.execute("""
+            UPDATE correos_salientes
+            SET estado = %s, intentos = intentos + 1, proveedor = %s, ultimo_error = %s,
+                cuerpo = NULL, terminado_at = NOW()
+            WHERE id = %s
+        """, (estado, proveedor, error, correo_id))
+    conn.commit()
+    conn.close()
+
+
+def _procesar(c):
+    cuerpo = c["cuerpo"]
+    try:
+        if cuerpo is None and c["tipo"] in _plantillas:
+            cuerpo = _plantillas[c["tipo"]](c["ref"])
+            if cuerpo is None:
+                _resultado(c["id"], "fallido", error="La referencia ya no es válida")
+                return
+        proveedor = _enviar(c["destinatario"], c["asunto"], cuerpo or "")
+    except NoConfigurado as e:
+        # sin proveedor no tiene sentido reintentar; queda en el log como antes
+        print(f"WARN: {e}. Correo para {c['destinatario']}:\n{cuerpo}")
+        _resultado(c["id"], "fallido", error=str(e))
+        return
+    except Exception as e:
+        intentos = int(c["intentos"]) + 1
+        if intentos >= int(c["max_intentos"]):
+            print(f"ERROR: correo {c['id']} a {c['destinatario']} descartado tras {intentos} intentos -> {e}")
+            _resultado(c["id"], "fallido", error=str(e)[:1000])
+        else:
+            _resultado(c["id"], "pendiente", error=str(e)[:1000], reintento_s=_backoff(intentos))
+        return
+
+    print(f"INFO: correo {c['id']} enviado por {proveedor} a {c['destinatario']}")
+    _resultado(c["id"], "enviado", proveedor=proveedor)
+
+
+def _loop():
+    while True:
+        try:
+            lote = _tomar_lote()
+        except Exception as e:
+            print("CORREO WARN: no se pudo leer la cola:", e)
+            lote = []
+            time.sleep(5)
+
+        for c in lote:
+            try:
+                _procesar(c)
+            except Exception:
+                print("CORREO ERROR:\n", traceback.format_exc())
+
+        if len(lote) < LOTE:
+            # sin trabajo inmediato: esperar aviso de encolar() o revisar reintentos cada 15s
+            _despertar.wait(timeout=15)
+            _despertar.clear()
+
+
+def iniciar_worker():
+    """Arranca (una vez por proceso) el hilo que envía la cola."""
+    global _worker
+    with _worker_lock:
+        if _worker is not None and _worker.is_alive():
+            return
+        _worker = threading.Thread(target=_loop, name="correo-worker", daemon=True)
+        _worker.start()
+
+
+# ---------------- estado (panel admin) ----------------
+
+def estado() -> dict:
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT estado, COUNT(*) AS n
+        FROM correos_salientes
+        GROUP BY estado
+    """)
+    por_estado = {r["estado"]: int(r["n"]) for r in (cur.fetchall() or [])}
+
+    cur.execute("""
+        SELECT
+            EXTRACT(EPOCH FROM NOW() - MIN(created_at)) FILTER (WHERE estado IN ('pendiente', 'enviando')) AS pendiente_mas_viejo_s,
+            COUNT(*) FILTER (WHERE estado = 'enviado' AND terminado_at > NOW() - INTERVAL '24 hours') AS enviados_24h,
+            COUNT(*) FILTER (WHERE estado = 'fallido' AND terminado_at > NOW() - INTERVAL '24 hours') AS fallidos_24h
+        FROM correos_salientes
+    """)
+    resumen = cur.fetchone() or {}
+
+    cur.execute("""
+        SELECT proveedor, COUNT(*) AS n
+        FROM correos_salientes
+        WHERE estado = 'enviado' AND terminado_at > NOW() - INTERVAL '7 days'
+        GROUP BY proveedor
+    """)
+    por_proveedor = {r["proveedor"]: int(r["n"]) for r in (cur.fetchall() or [])}
+
+    cur.execute("""
+        SELECT id, tipo, destinatario, estado, intentos, ultimo_error, proximo_intento_at, created_at
+        FROM correos_salientes
+        WHERE ultimo_error IS NOT NULL
+        ORDER BY id DESC
+        LIMIT 20
+    """)
+    errores = []
+    for r in (cur.fetchall() or []):
+        d = dict(r)
+        for k in ("proximo_intento_at", "created_at"):
+            d[k] = d[k].isoformat() if d.get(k) else None
+        errores.append(d)
+    conn.close()
+
+    viejo = resumen.get("pendiente_mas_viejo_s")
+    return {
+        "por_estado": por_estado,
+        "pendiente_mas_viejo_s": round(float(viejo), 1) if viejo is not None else None,
+        "enviados_24h": int(resumen.get("enviados_24h") or 0),
+        "fallidos_24h": int(resumen.get("fallidos_24h") or 0),
+        "enviados_7d_por_proveedor": por_proveedor,
+        "ultimos_errores": errores,
+        "worker_vivo": bool(_worker is not None and _worker.is_alive()),
+    }
@@ -35,8 +35,6 @@ def create_tables():
         direccion TEXT NOT NULL,
         password TEXT NOT NULL,
         descuento DOUBLE PRECISION DEFAULT 0,
-        reset_token TEXT,
-        reset_token_expira TEXT,
         admin_id INTEGER
     );
     """)
@@ -98,15 +96,22 @@ def create_tables():
         promo_label TEXT
     );
     """)
+    # tablas viejas: columnas agregadas después (aquí y no en cada request, que
+    # un ALTER por request hace esperar a todos los lectores de overrides)
+    cur.execute("ALTER TABLE producto_overrides ADD COLUMN IF NOT EXISTS destacado BOOLEAN DEFAULT FALSE")
+    cur.execute("ALTER TABLE producto_overrides ADD COLUMN IF NOT EXISTS orden INTEGER DEFAULT 0")
+    cur.execute("ALTER TABLE producto_overrides ADD COLUMN IF NOT EXISTS promo_label TEXT")
 
         # ===== CATALOGO (FUENTE DE VERDAD) =====
     cur.execute("""
     CREATE TABLE IF NOT EXISTS productos_catalogo (
         code TEXT PRIMARY KEY,
         data JSONB NOT NULL,
-        updated_at TEXT NOT NULL
+        updated_at TEXT NOT NULL,
+        content_hash TEXT
     );
     """)
+    cur.execute("ALTER TABLE productos_catalogo ADD COLUMN IF NOT EXISTS content_hash TEXT")
     
 
 
@@ -137,6 +142,232 @@ def create_tables():
     );
     """)
 
+    # ===== JOBS (tareas en segundo plano: import de precios, etc.) =====
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        id SERIAL PRIMARY KEY,
+        tipo TEXT NOT NULL,
+        estado TEXT NOT NULL DEFAULT 'pendiente'
+            CHECK(estado IN ('pendiente','corriendo','ok','error')),
+        params JSONB NOT NULL DEFAULT '{}'::jsonb,
+        progreso JSONB NOT NULL DEFAULT '{}'::jsonb,
+        resultado JSONB,
+        error TEXT,
+        actor_role TEXT,
+        actor_id INTEGER,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        started_at TIMESTAMP,
+        heartbeat_at TIMESTAMP,
+        finished_at TIMESTAMP
+    );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_pendientes ON jobs (id) WHERE estado = 'pendiente'")
+
+    # ===== COLA DE CORREOS SALIENTES (backend/correo.py) =====
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS correos_salientes (
+        id BIGSERIAL PRIMARY KEY,
+        tipo TEXT NOT NULL DEFAULT 'general',
+        destinatario TEXT NOT NULL,
+        asunto TEXT NOT NULL,
+        cuerpo TEXT,
+        estado TEXT NOT NULL DEFAULT 'pendiente'
+            CHECK (estado IN ('pendiente', 'enviando', 'enviado', 'fallido')),
+        intentos INTEGER NOT NULL DEFAULT 0,
+        max_intentos INTEGER NOT NULL DEFAULT 5,
+        proximo_intento_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        tomado_at TIMESTAMP,
+        proveedor TEXT,
+        ultimo_error TEXT,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        terminado_at TIMESTAMP
+    );
+    """)
+    # ref: dato para armar el cuerpo al enviar (correo.plantilla); cuerpo queda NULL
+    cur.execute("ALTER TABLE correos_salientes ADD COLUMN IF NOT EXISTS ref TEXT")
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_correos_pendientes
+    ON correos_salientes (proximo_intento_at, id) WHERE estado = 'pendiente'
+    """)
+
+    # ===== SESIONES DEL LADO DEL SERVIDOR (backend/sesiones.py) =====
+    # id_hash = sha256 del ID opaco de la cookie (la cookie en sí no se guarda)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS sesiones (
+        id_hash TEXT PRIMARY KEY,
+        principal_tipo TEXT,
+        principal_id INTEGER,
+        datos JSONB NOT NULL DEFAULT '{}'::jsonb,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        last_seen_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        expira_at TIMESTAMP NOT NULL,
+        revocada_at TIMESTAMP
+    );
+    """)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_sesiones_principal
+    ON sesiones (principal_tipo, principal_id) WHERE revocada_at IS NULL
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sesiones_revocada ON sesiones (revocada_at) WHERE revocada_at IS NOT NULL")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sesiones_expira ON sesiones (expira_at)")
+
+    # ===== VERSIÓN DE PEDIDOS (concurrencia optimista + feed de cambios) =====
+    # Secuencia global: cada INSERT/UPDATE de un pedido toma el siguiente número,
+    # así "version > N" son los pedidos que cambiaron desde N.
+    cur.execute("CREATE SEQUENCE IF NOT EXISTS pedidos_version_seq")
+    cur.execute("ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS version BIGINT")
+    cur.execute("UPDATE pedidos SET version = nextval('pedidos_version_seq') WHERE version IS NULL")
+    cur.execute("ALTER TABLE pedidos ALTER COLUMN version SET DEFAULT nextval('pedidos_version_seq')")
+    cur.execute("ALTER TABLE pedidos ALTER COLUMN version SET NOT NULL")
+    # siguiente xid sin asignar al momento de tomar la versión (NULL = filas viejas, seguras)
+    cur.execute("ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS version_xid xid8")
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION pedidos_subir_version() RETURNS trigger AS $$
+    BEGIN
+        -- xid propio antes que la versión, y después de la versión el siguiente xid sin
+        -- asignar (cada sentencia de una función volátil toma snapshot nuevo en READ
+        -- COMMITTED): quien tenga una versión menor ya tenía un xid < version_xid.
+        -- El feed de cambios no pasa de una fila con version_xid > xmin del snapshot.
+        PERFORM pg_current_xact_id();
+        NEW.version := nextval('pedidos_version_seq');
+        NEW.version_xid := pg_snapshot_xmax(pg_current_snapshot());
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS trg_pedidos_version ON pedidos")
+    cur.execute("""
+    CREATE TRIGGER trg_pedidos_version
+    BEFORE INSERT OR UPDATE ON pedidos
+    FOR EACH ROW EXECUTE FUNCTION pedidos_subir_version()
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_pedidos_version ON pedidos (version)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_pedidos_version_xid ON pedidos (version_xid)")
+
+    # ===== LOGIN DE EMPRESAS =====
+    # el login busca por correo (sin distinguir mayúsculas) o por NIT: índice funcional
+    # para lower(correo); nit ya tiene el índice de su UNIQUE
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_empresas_correo_lower ON empresas (lower(correo))")
+
+    # Tokens de reset de contraseña: solo se guarda el sha256 (el token viaja por correo)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS password_reset_tokens (
+        token_hash TEXT PRIMARY KEY,
+        empresa_id INTEGER NOT NULL REFERENCES empresas(id) ON DELETE CASCADE,
+        expira_at TIMESTAMP NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reset_tokens_empresa ON password_reset_tokens (empresa_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reset_tokens_expira ON password_reset_tokens (expira_at)")
+    # migración única: los tokens viejos en texto plano dejan de valer (se van con sus columnas)
+    cur.execute("""
+    SELECT 1 FROM information_schema.columns
+    WHERE table_schema = current_schema() AND table_name = 'empresas' AND column_name = 'reset_token'
+    """)
+    if cur.fetchone():
+        cur.execute("ALTER TABLE empresas DROP COLUMN IF EXISTS reset_token, DROP COLUMN IF EXISTS reset_token_expira")
+
+    # ===== FALLOS DE LOGIN (bloqueo compartido entre workers, backend/limites.py) =====
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS login_fallos (
+        clave TEXT PRIMARY KEY,
+        fallos INTEGER NOT NULL DEFAULT 0,
+        desde TIMESTAMP NOT NULL DEFAULT NOW(),
+        bloqueos INTEGER NOT NULL DEFAULT 0,
+        bloqueado_hasta TIMESTAMP,
+        updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+    """)
+
+    # ===== HISTORIAL DE PRECIOS (append-only, un registro por import) =====
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS precio_imports (
+        id SERIAL PRIMARY KEY,
+        origen TEXT NOT NULL DEFAULT 'excel',
+        archivo TEXT,
+        descuento_proveedor DOUBLE PRECISION,
+        tipo_cambio DOUBLE PRECISION,
+        filas INTEGER,
+        cambiados INTEGER,
+        sin_cambios INTEGER,
+        nuevos INTEGER,
+        faltantes INTEGER,
+        tiempos JSONB,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+    """)
+    cur.execute("ALTER TABLE precio_imports ADD COLUMN IF NOT EXISTS tipo_cambio DOUBLE PRECISION")
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS precio_historial (
+        id BIGSERIAL PRIMARY KEY,
+        code TEXT NOT NULL,
+        import_id INTEGER NOT NULL,
+        old_usd DOUBLE PRECISION,
+        new_usd DOUBLE PRECISION,
+        old_bs_web DOUBLE PRECISION,
+        new_bs_web DOUBLE PRECISION,
+        old_bs_proveedor DOUBLE PRECISION,
+        new_bs_proveedor DOUBLE PRECISION,
+        created_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_precio_historial_code ON precio_historial (code, import_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_precio_historial_import ON precio_historial (import_id, code)")
+
+    # ===== CACHE DE IMÁGENES TRUPER (código -> imagen; imagen NULL = no encontrado) =====
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS truper_imagen_cache (
+        code TEXT PRIMARY KEY,
+        imagen TEXT,
+        consultado_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+    """)
+    cur.execute("ALTER TABLE truper_imagen_cache ADD COLUMN IF NOT EXISTS fuente TEXT")
+
+    # ===== ESPEJO LOCAL DE IMÁGENES EXTERNAS (url -> variantes en app_assets) =====
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS imagenes_espejo (
+        url TEXT PRIMARY KEY,
+        estado TEXT NOT NULL CHECK (estado IN ('ok', 'error')),
+        sha256_origen TEXT,
+        bytes_origen INTEGER,
+        variantes JSONB,
+        error TEXT,
+        intentos INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_imagenes_espejo_sha ON imagenes_espejo (sha256_origen) WHERE estado = 'ok'")
+
+    # ===== CONFIGURACIÓN DE PRECIOS (tramos de margen + tipo de cambio) =====
+    # hasta_bs NULL = último tramo (sin tope). margen se aplica si costo_bs < hasta_bs.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS precio_tramos (
+        orden INTEGER PRIMARY KEY,
+        hasta_bs DOUBLE PRECISION,
+        margen DOUBLE PRECISION NOT NULL CHECK (margen >= 0)
+    );
+    """)
+    cur.execute("""
+    INSERT INTO precio_tramos (orden, hasta_bs, margen)
+    SELECT * FROM (VALUES (1, 30.0, 0.45), (2, 80.0, 0.35), (3, 200.0, 0.28), (4, NULL::float8, 0.20)) v
+    WHERE NOT EXISTS (SELECT 1 FROM precio_tramos)
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS precio_parametros (
+        clave TEXT PRIMARY KEY,
+        valor DOUBLE PRECISION NOT NULL,
+        updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+    """)
+    cur.execute(
+        "INSERT INTO precio_parametros (clave, valor) VALUES ('tipo_cambio', %s) ON CONFLICT (clave) DO NOTHING",
+        (float(os.getenv("TIPO_CAMBIO", "6.96")),),
+    )
+
 
     conn.commit()
     conn.close()
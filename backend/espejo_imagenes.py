@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+from backend import http_cliente, imagenes
+from backend.database import get_connection
+from backend.truper import USER_AGENT, LimitadorHost
+
+# Espejo local de imágenes externas (producto_overrides.imagen con URLs de Truper, etc.):
+# se descargan UNA vez, se deduplican por hash del contenido, se normalizan/reducen
+# (backend/imagenes.py) y se sirven desde /api/img-espejo/<key> con cache inmutable.
+
+MAX_WORKERS = int(os.getenv("ESPEJO_WORKERS", "4"))
+TIMEOUT_S = 15
+MAX_BYTES = 8 * 1024 * 1024
+MAX_INTENTOS = 3
+# URLs por lote: se descargan sin conexión a BD y luego se guardan con una conexión corta
+LOTE = int(os.getenv("ESPEJO_LOTE", "16"))
+
+# variante que se usa como "imagen" efectiva en la tienda (tarjetas de producto)
+VARIANTE_TIENDA = os.getenv("ESPEJO_VARIANTE", "w640")
+
+_limitador = LimitadorHost(float(os.getenv("ESPEJO_RPS", "4")))
+
+
+def es_externa(url: Optional[str]) -> bool:
+    u = (url or "").strip().lower()
+    return u.startswith("http://") or u.startswith("https://") or u.startswith("//")
+
+
+def url_efectiva(variantes: Optional[dict]) -> Optional[str]:
+    """URL local para la tienda a partir de {variante: key} (None si no hay espejo)."""
+    if not variantes:
+        return None
+    key = variantes.get(VARIANTE_TIENDA) or variantes.get("webp") or variantes.get("original")
+    return f"/api/img-espejo/{key}" if key else None
+
+
+def _descargar(url: str):
+    if url.startswith("//"):
+        url = "https:" + url
+    _limitador.esperar(urlparse(url).netloc)
+    resp = http_cliente.get(
+        url, stream=True, timeout=(5, TIMEOUT_S),
+        headers={"User-Agent": USER_AGENT, "Accept": "image/*"},
+    )
+    try:
+        if resp.status_code != 200:
+            raise ValueError(f"HTTP {resp.status_code}")
+        mime = (resp.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+        if mime and not mime.startswith("image/"):
+            raise ValueError(f"No es imagen ({mime})")
+        data = bytearray()
+        for bloque in resp.iter_content(chunk_size=64 * 1024):
+            data.extend(bloque)
+            if len(data) > MAX_BYTES:
+                raise ValueError("Imagen demasiado grande")
+    finally:
+        http_cliente.liberar(resp)
+    if not data:
+        raise ValueError("Respuesta vacía")
+    return mime or "application/octet-stream", bytes(data)
+
+
+def pendientes(cur, limit: int) -> List[str]:
+    """URLs externas usadas en overrides que aún no tienen espejo (o fallaron < MAX_INTENTOS veces)."""
+    cur.execute("""
+        SELECT DISTINCT o.imagen AS url
+        FROM producto_overrides o
+        LEFT JOIN imagenes_espejo e ON e.url = o.imagen
+        WHERE o.imagen ~* '^(https?:)?//'
+          AND (e.url IS NULL OR (e.estado = 'error' AND e.intentos < %s))
+        ORDER BY 1
+        LIMIT %s
+    """, (MAX_INTENTOS, limit))
+    return [r["url"] for r in (cur.fetchall() or [])]
+
+
+def _guardar(cur, url: str, mime: str, data: bytes, por_hash: Dict[str, dict]) -> dict:
+    """Procesa (o reutiliza por hash) y registra el espejo de url. No hace commit."""
+    sha = hashlib.sha256(data).hexdigest()
+
+    variantes = por_hash.get(sha)
+    if variantes is None:
+        cur.execute("""
+            SELECT variantes FROM imagenes_espejo
+            WHERE sha256_origen = %s AND estado = 'ok'
+            LIMIT 1
+        """, (sha,))
+        row = cur.fetchone()
+        variantes = row["variantes"] if row else None
+
+    reutilizada = variantes is not None
+    if variantes is None:
+        if imagenes.disponible():
+            procesadas = imagenes.procesar_imagen(data)  # ValueError si no es imagen
+        else:
+            ext = (mime.split("/")[-1] or "bin").replace("jpeg", "jpg")
+            procesadas = {"original": (mime, ext, data)}
+        variantes = imagenes.guardar_variantes(cur, procesadas)
+
+    cur.execute("""
+        INSERT INTO imagenes_espejo (url, estado, sha256_origen, bytes_origen, variantes, error, intentos, updated_at)
+        VALUES (%s, 'ok', %s, %s, %s::jsonb, NULL, 1, NOW())
+        ON CONFLICT (url) DO UPDATE SET
+            estado = 'ok', sha256_origen = EXCLUDED.sha256_origen, bytes_origen = EXCLUDED.bytes_origen,
+            variantes = EXCLUDED.variantes, error = NULL,
+            intentos = imagenes_espejo.intentos + 1, updated_at = NOW()
+    """, (url, sha, len(data), json.dumps(variantes)))
+    por_hash[sha] = variantes
+    return {"url": url, "ok": True, "reutilizada": reutilizada, "imagen": url_efectiva(variantes)}
+
+
+def _registrar_error(cur, url: str, error: str):
+    cur.execute("""
+        INSERT INTO imagenes_espejo (url, estado, error, intentos, updated_at)
+        VALUES (%s, 'error', %s, 1, NOW())
+        ON CONFLICT (url) DO UPDATE SET
+            estado = 'error', error = EXCLUDED.error,
+            intentos = imagenes_espejo.intentos + 1, updated_at = NOW()
+    """, (url, error[:500]))
+
+
+def _sin_progreso(**campos):
+    pass
+
+
+def _guardar_lote(descargas: list, por_hash: Dict[str, dict]) -> list:
+    """Guarda un lote ya descargado [(url, (mime, data) | Exception)] con una conexión propia."""
+    resultados = []
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        for url, res in descargas:
+            try:
+                if isinstance(res, Exception):
+                    raise res
+                mime, data = res
+                resultados.append(_guardar(cur, url, mime, data, por_hash))
+            except Exception as e:
+                conn.rollback()
+                _registrar_error(cur, url, str(e))
+                resultados.append({"url": url, "ok": False, "error": str(e)})
+            conn.commit()
+    finally:
+        conn.close()
+    return resultados
+
+
+def espejar(urls: List[str], progreso=None) -> dict:
+    """
+    Descarga en paralelo (pool acotado + rate limit por host) y guarda cada imagen.
+    Va por lotes: las descargas no retienen conexión; el procesado y las escrituras
+    de cada lote usan una conexión propia, con commit por imagen.
+    """
+    progreso = progreso or _sin_progreso
+    por_hash: Dict[str, dict] = {}
+    resultados = []
+
+    progreso(total=len(urls), procesados=0, forzar=True)
+    if not urls:
+        return {"ok": True, "total": 0, "ok_count": 0, "errores": 0, "reutilizadas": 0, "resultados": []}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(urls))), thread_name_prefix="espejo") as pool:
+        for i in range(0, len(urls), LOTE):
+            futuros = {pool.submit(_descargar, url): url for url in urls[i:i + LOTE]}
+            descargas = []
+            for fut in as_completed(futuros):
+                try:
+                    descargas.append((futuros[fut], fut.result()))
+                except Exception as e:
+                    descargas.append((futuros[fut], e))
+
+            resultados.extend(_guardar_lote(descargas, por_hash))
+            progreso(
+                procesados=len(resultados),
+                ok=sum(1 for r in resultados if r["ok"]),
+                errores=sum(1 for r in resultados if not r["ok"]),
+            )
+
+    return {
+        "ok": True,
+        "total": len(resultados),
+        "ok_count": sum(1 for r in resultados if r["ok"]),
+        "errores": sum(1 for r in resultados if not r["ok"]),
+        "reutilizadas": sum(1 for r in resultados if r.get("reutilizada")),
+        "resultados": resultados,
+    }
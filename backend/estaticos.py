@@ -0,0 +1,188 @@
+import hashlib
+import mimetypes
+import os
+import posixpath
+import threading
+import uuid
+from typing import Dict, Iterable, Optional
+
+from flask import request, send_file
+from werkzeug.security import safe_join
+
+from backend import compresion
+
+
+# Solo se sirve lo registrado (archivos y carpetas explícitos) y con estos tipos;
+# nunca "cualquier .json bajo la raíz" (pedidos.json tiene datos de clientes).
+EXTS_PERMITIDAS = {
+    ".html", ".css", ".js", ".json", ".svg", ".txt", ".xml",
+    ".png", ".jpg", ".jpeg", ".webp", ".gif", ".ico", ".woff", ".woff2",
+}
+
+# Tipos de texto: se precomprimen (las imágenes ya vienen comprimidas)
+EXTS_TEXTO = {".html", ".css", ".js", ".json", ".svg", ".txt", ".xml"}
+
+MIN_BYTES_COMPRIMIR = 1024
+
+UN_ANIO = 365 * 24 * 3600
+
+
+class AssetsEstaticos:
+    """
+    Capa de estáticos:
+    - huella (sha256) por archivo -> URL /assets/<huella>/<archivo> cacheable "immutable"
+    - variantes .br / .gz precomprimidas en disco (se sirven con sendfile, sin CPU por request)
+    - GET condicional (ETag / If-Modified-Since) vía send_file
+    Si un archivo cambia en disco se detecta por mtime/size y se vuelve a procesar.
+    Solo sirve `archivos` (rutas exactas) y lo que esté dentro de `carpetas`.
+    """
+
+    def __init__(self, root: str, cache_dir: str, archivos: Iterable[str], carpetas: Iterable[str] = ()):
+        self.root = root
+        self.cache_dir = cache_dir
+        self.archivos = frozenset(archivos)
+        self.carpetas = tuple(c.rstrip("/") + "/" for c in carpetas)
+        self._lock = threading.Lock()
+        self._entradas: Dict[str, dict] = {}
+
+    # ---------- registro ----------
+
+    def permitido(self, rel: str) -> bool:
+        # "img/../pedidos.json" no cuenta como img/: solo rutas ya normalizadas
+        if not rel or posixpath.normpath(rel) != rel or rel.startswith(("/", "..")):
+            return False
+        if os.path.splitext(rel)[1].lower() not in EXTS_PERMITIDAS:
+            return False
+        return rel in self.archivos or rel.startswith(self.carpetas)
+
+    def _ruta(self, rel: str) -> Optional[str]:
+        if not self.permitido(rel):
+            return None
+        path = safe_join(self.root, rel)
+        if not path or not os.path.isfile(path):
+            return None
+        return path
+
+    def _registrar(self, rel: str, path: str, st) -> dict:
+        h = hashlib.sha256()
+        with open(path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+                h.update(chunk)
+
+        entrada = {
+            "rel": rel,
+            "path": path,
+            "mtime": st.st_mtime,
+            "size": st.st_size,
+            "hash": h.hexdigest()[:16],
+            "mime": mimetypes.guess_type(rel)[0] or "application/octet-stream",
+            "variantes": {},
+        }
+        with self._lock:
+            self._entradas[rel] = entrada
+        return entrada
+
+    def _precomprimir(self, entrada: dict):
+        ext = os.path.splitext(entrada["rel"])[1].lower()
+        if ext not in EXTS_TEXTO or entrada["size"] < MIN_BYTES_COMPRIMIR:
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        base = os.path.join(self.cache_dir, f"{entrada['hash']}-{os.path.basename(entrada['rel'])}")
+
+        data = None
+        variantes = {}
+        for enc in compresion.encodings_soportados():
+            destino = base + compresion.EXT_ENCODING[enc]
+            if not os.path.exists(destino):
+                if data is None:
+                    with open(entrada["path"], "rb") as fh:
+                        data = fh.read()
+                comprimido = compresion.comprimir(data, enc, estatico=True)
+                if len(comprimido) >= entrada["size"]:
+                    continue
+                # nombre único: la precarga y un request pueden comprimir el mismo archivo a la vez
+                tmp = f"{destino}.{uuid.uuid4().hex}.tmp"
+                with open(tmp, "wb") as fh:
+                    fh.write(comprimido)
+                os.replace(tmp, destino)
+            variantes[enc] = destino
+
+        with self._lock:
+            entrada["variantes"] = variantes
+
+    def preparar(self, rels):
+        """Huella + precompresión de una lista de archivos (al arrancar)."""
+        for rel in rels:
+            try:
+                e = self.entrada(rel, precomprimir=False)
+                if e:
+                    self._precomprimir(e)
+            except Exception as ex:
+                print("WARN estaticos:", rel, ex)
+
+    def entrada(self, rel: str, precomprimir: bool = True) -> Optional[dict]:
+        path = self._ruta(rel)
+        if not path:
+            return None
+
+        st = os.stat(path)
+        e = self._entradas.get(rel)
+        if e and e["mtime"] == st.st_mtime and e["size"] == st.st_size:
+            return e
+
+        e = self._registrar(rel, path, st)
+        if precomprimir:
+            # comprimir al nivel máximo puede tardar: en segundo plano
+            threading.Thread(target=self._precomprimir, args=(e,), daemon=True).start()
+        return e
+
+    # ---------- URLs / respuestas ----------
+
+    def url(self, rel: str) -> Optional[str]:
+        e = self.entrada(rel)
+        if not e:
+            return None
+        return f"/assets/{e['hash']}/{rel}"
+
+    def manifest(self) -> Dict[str, str]:
+        with self._lock:
+            rels = list(self._entradas.keys())
+        return {rel: f"/assets/{self._entradas[rel]['hash']}/{rel}" for rel in rels}
+
+    def respuesta(self, rel: str, max_age: int = 0, inmutable: bool = False):
+        """Response para rel (o None si no existe), eligiendo variante .br/.gz según Accept-Encoding."""
+        e = self.entrada(rel)
+        if not e:
+            return None
+
+        enc = None
+        variantes = e.get("variantes") or {}
+        if variantes:
+            enc = compresion.elegir_encoding(request.headers.get("Accept-Encoding", ""))
+            if enc not in variantes:
+                enc = None
+
+        path = variantes[enc] if enc else e["path"]
+        etag = f"{e['hash']}-{enc}" if enc else e["hash"]
+
+        resp = send_file(
+            path,
+            mimetype=e["mime"],
+            conditional=True,
+            etag=etag,
+            last_modified=e["mtime"],
+            max_age=max_age,
+        )
+        if enc:
+            resp.headers["Content-Encoding"] = enc
+        if variantes:
+            resp.vary.add("Accept-Encoding")
+
+        if inmutable:
+            resp.headers["Cache-Control"] = f"public, max-age={UN_ANIO}, immutable"
+        elif max_age <= 0:
+            resp.headers["Cache-Control"] = "no-cache"
+        else:
+            resp.headers["Cache-Control"] = f"public, max-age={max_age}"
+        return resp
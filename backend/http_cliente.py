@@ -0,0 +1,221 @@
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Cliente HTTP compartido para TODAS las integraciones externas (Resend, Truper, logos, espejo):
+# - una sesión con pool keep-alive por host (sin handshake TLS por request)
+# - timeouts por defecto (connect, read)
+# - reintentos con presupuesto por host (los reintentos no pueden multiplicar la carga)
+# - circuit breaker por host (si está caído, fallamos al toque en vez de esperar el timeout)
+# - métricas de latencia por host
+
+TIMEOUT_DEFAULT = (5, 15)  # (connect, read) segundos
+POOL_HOSTS = 16
+POOL_POR_HOST = 10
+
+REINTENTO_STATUS = {429, 502, 503, 504}
+REINTENTO_ESPERA_S = 0.5
+
+# presupuesto: cada request deposita 0.2 fichas (máx 10); cada reintento gasta 1
+PRESUPUESTO_DEPOSITO = 0.2
+PRESUPUESTO_MAX = 10.0
+
+# circuito: se abre tras N fallas seguidas y deja pasar una prueba después de ABIERTO_S
+CIRCUITO_FALLAS = 5
+CIRCUITO_ABIERTO_S = 30.0
+
+MUESTRAS_LATENCIA = 200
+
+USER_AGENT = "FerroCentral/1.0 (+https://ferrocentral.com.bo)"
+
+
+class CircuitoAbierto(requests.exceptions.ConnectionError):
+    """El host viene fallando: no se intenta (se reintenta solo tras CIRCUITO_ABIERTO_S)."""
+
+
+class _EstadoHost:
+    def __init__(self, host: str):
+        self.host = host
+        self.lock = threading.Lock()
+        self.fichas = PRESUPUESTO_MAX
+        self.fallas_seguidas = 0
+        self.abierto_hasta = 0.0
+        self.prueba_en_curso = False
+        self.latencias = deque(maxlen=MUESTRAS_LATENCIA)
+        self.pedidos = 0
+        self.errores = 0
+        self.reintentos = 0
+        self.rechazados = 0
+
+    # ---- circuito ----
+    def permitir(self) -> bool:
+        with self.lock:
+            if self.fallas_seguidas < CIRCUITO_FALLAS:
+                return True
+            if time.monotonic() < self.abierto_hasta or self.prueba_en_curso:
+                self.rechazados += 1
+                return False
+            # semi-abierto: una sola prueba
+            self.prueba_en_curso = True
+            return True
+
+    def registrar(self, ok: bool, segundos: float):
+        with self.lock:
+            self.pedidos += 1
+            self.latencias.append(segundos)
+            self.fichas = min(PRESUPUESTO_MAX, self.fichas + PRESUPUESTO_DEPOSITO)
+            self.prueba_en_curso = False
+            if ok:
+                self.fallas_seguidas = 0
+                return
+            self.errores += 1
+            self.fallas_seguidas += 1
+            if self.fallas_seguidas >= CIRCUITO_FALLAS:
+                self.abierto_hasta = time.monotonic() + CIRCUITO_ABIERTO_S
+                if self.fallas_seguidas == CIRCUITO_FALLAS:
+                    print(f"HTTP WARN: circuito abierto para {self.host} ({CIRCUITO_FALLAS} fallas seguidas)")
+
+    def soltar_prueba(self):
+        """La prueba semi-abierta terminó sin resultado sobre el host (error local): otra puede pasar."""
+        with self.lock:
+            self.prueba_en_curso = False
+
+    # ---- presupuesto de reintentos ----
+    def gastar_ficha(self) -> bool:
+        with self.lock:
+            if self.fichas < 1.0:
+                return False
+            self.fichas -= 1.0
+            self.reintentos += 1
+            return True
+
+    def resumen(self) -> dict:
+        with self.lock:
+            lat = sorted(self.latencias)
+            abierto = self.fallas_seguidas >= CIRCUITO_FALLAS and time.monotonic() < self.abierto_hasta
+
+            def pct(p):
+                return round(lat[min(len(lat) - 1, int(len(lat) * p))] * 1000, 1) if lat else None
+
+            return {
+                "pedidos": self.pedidos,
+                "errores": self.errores,
+                "reintentos": self.reintentos,
+                "rechazados_circuito": self.rechazados,
+                "circuito": "abierto" if abierto else ("semi" if self.fallas_seguidas >= CIRCUITO_FALLAS else "cerrado"),
+                "fichas_reintento": round(self.fichas, 1),
+                "ms_p50": pct(0.50),
+                "ms_p95": pct(0.95),
+                "ms_max": round(lat[-1] * 1000, 1) if lat else None,
+            }
+
+
+_hosts_lock = threading.Lock()
+_hosts: Dict[str, _EstadoHost] = {}
+
+
+def _estado(host: str) -> _EstadoHost:
+    e = _hosts.get(host)
+    if e is None:
+        with _hosts_lock:
+            e = _hosts.setdefault(host, _EstadoHost(host))
+    return e
+
+
+def _nueva_sesion() -> requests.Session:
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_POR_HOST)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    s.headers["User-Agent"] = USER_AGENT
+    return s
+
+
+_sesion = _nueva_sesion()
+
+
+def pedir(metodo: str, url: str, timeout=None, reintentos: Optional[int] = None, **kwargs) -> requests.Response:
+    """
+    requests.request() sobre la sesión compartida.
+    reintentos: por defecto 2 para GET/HEAD y 0 para el resto (POST no es idempotente).
+    Solo se reintenta ante error de conexión/timeout o 429/502/503/504, y si el host tiene presupuesto.
+    Lanza CircuitoAbierto si el host viene fallando.
+    """
+    metodo = metodo.upper()
+    host = urlparse(url).netloc
+    estado = _estado(host)
+    if reintentos is None:
+        reintentos = 2 if metodo in ("GET", "HEAD") else 0
+
+    intento = 0
+    while True:
+        if not estado.permitir():
+            raise CircuitoAbierto(f"Circuito abierto para {host}")
+
+        t = time.perf_counter()
+        try:
+            resp = _sesion.request(metodo, url, timeout=timeout or TIMEOUT_DEFAULT, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            estado.registrar(False, time.perf_counter() - t)
+            if intento < reintentos and estado.gastar_ficha():
+                intento += 1
+                time.sleep(REINTENTO_ESPERA_S * intento)
+                continue
+            raise
+        except requests.exceptions.RequestException:
+            # ChunkedEncodingError, TooManyRedirects, InvalidURL...: cuenta como falla y
+            # sobre todo libera la prueba semi-abierta (si no, el host queda rechazado para siempre)
+            estado.registrar(False, time.perf_counter() - t)
+            raise
+        except BaseException:
+            estado.soltar_prueba()
+            raise
+
+        estado.registrar(resp.status_code < 500, time.perf_counter() - t)
+        if resp.status_code in REINTENTO_STATUS and intento < reintentos and estado.gastar_ficha():
+            resp.close()
+            intento += 1
+            time.sleep(REINTENTO_ESPERA_S * intento)
+            continue
+        return resp
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return pedir("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return pedir("POST", url, **kwargs)
+
+
+def liberar(resp: requests.Response, drenar_max: int = 128 * 1024):
+    """
+    Termina una respuesta stream=True leída a medias.
+    Si lo que falta es poco se drena (la conexión vuelve al pool); si no, se cierra.
+    """
+    drenada = False
+    try:
+        total = int(resp.headers.get("Content-Length") or -1)
+        leido = resp.raw.tell() if hasattr(resp.raw, "tell") else 0
+        if 0 <= total - leido <= drenar_max:
+            resp.raw.read(decode_content=False)
+            drenada = True
+    except Exception:
+        drenada = False
+
+    if drenada and hasattr(resp.raw, "release_conn"):
+        # leída completa: la conexión vuelve al pool (close() la cerraría)
+        resp.raw.release_conn()
+    else:
+        resp.close()
+
+
+def metricas() -> Dict[str, dict]:
+    with _hosts_lock:
+        hosts = list(_hosts.items())
+    return {host: e.resumen() for host, e in sorted(hosts)}
@@ -0,0 +1,121 @@
+import hashlib
+from io import BytesIO
+from typing import Dict, Tuple
+
+try:
+    from PIL import Image, ImageOps
+except Exception as e:
+    Image = None
+    ImageOps = None
+    print("WARN: Pillow no disponible, las imágenes se guardan sin procesar:", e)
+
+
+# Lado máximo de la imagen "normalizada" (las fotos del celular vienen a 4000px)
+MAX_LADO = 1600
+
+# Miniaturas para grillas de productos / checkout
+THUMB_SIZES = (160, 320, 640)
+
+WEBP_QUALITY = 82
+JPEG_QUALITY = 88
+
+
+def disponible() -> bool:
+    return Image is not None
+
+
+def clave_asset(data: bytes, ext: str) -> str:
+    """Clave por contenido: mismo archivo => misma clave (cache inmutable)."""
+    return f"{hashlib.sha256(data).hexdigest()[:24]}.{ext}"
+
+
+def _abrir(data: bytes):
+    try:
+        img = Image.open(BytesIO(data))
+        img.load()
+    except Exception:
+        raise ValueError("Imagen inválida")
+
+    # Fotos del celular: la rotación viene en EXIF, la aplicamos y la quitamos
+    img = ImageOps.exif_transpose(img)
+
+    tiene_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+    if tiene_alpha:
+        if img.mode != "RGBA":
+            img = img.convert("RGBA")
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+    return img
+
+
+def _reducir(img, lado: int):
+    if max(img.size) <= lado:
+        return img
+    copia = img.copy()
+    copia.thumbnail((lado, lado), Image.LANCZOS)
+    return copia
+
+
+def _a_webp(img) -> bytes:
+    out = BytesIO()
+    img.save(out, format="WEBP", quality=WEBP_QUALITY, method=4)
+    return out.getvalue()
+
+
+def _a_normalizada(img) -> Tuple[str, str, bytes]:
+    out = BytesIO()
+    if img.mode == "RGBA":
+        img.save(out, format="PNG", optimize=True)
+        return "image/png", "png", out.getvalue()
+    img.save(out, format="JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return "image/jpeg", "jpg", out.getvalue()
+
+
+def procesar_imagen(data: bytes) -> Dict[str, Tuple[str, str, bytes]]:
+    """
+    Normaliza una imagen subida y genera sus variantes.
+    Devuelve {variante: (mime, ext, bytes)} con:
+      - "original": orientada, sin metadatos, máx MAX_LADO px (PNG si tiene transparencia, si no JPEG)
+      - "webp": la misma en WebP
+      - "w160", "w320", "w640": miniaturas WebP
+    Lanza ValueError si los bytes no son una imagen.
+    """
+    if not disponible():
+        raise RuntimeError("Pillow no disponible")
+
+    img = _reducir(_abrir(data), MAX_LADO)
+
+    mime, ext, normal = _a_normalizada(img)
+    variantes = {
+        "original": (mime, ext, normal),
+        "webp": ("image/webp", "webp", _a_webp(img)),
+    }
+    for lado in THUMB_SIZES:
+        variantes[f"w{lado}"] = ("image/webp", "webp", _a_webp(_reducir(img, lado)))
+    return variantes
+
+
+def miniatura_webp(data: bytes, lado: int) -> bytes:
+    """Una sola miniatura WebP (para imágenes locales de img/)."""
+    if not disponible():
+        raise RuntimeError("Pillow no disponible")
+    return _a_webp(_reducir(_abrir(data), lado))
+
+
+def guardar_variantes(cur, variantes: Dict[str, Tuple[str, str, bytes]]) -> Dict[str, str]:
+    """
+    Guarda cada variante en app_assets bajo su clave por contenido.
+    Devuelve {variante: key}. No hace commit.
+    """
+    import psycopg2
+
+    claves = {}
+    for nombre, (mime, ext, data) in variantes.items():
+        key = clave_asset(data, ext)
+        cur.execute("""
+            INSERT INTO app_assets (key, mime, data, sha256, updated_at)
+            VALUES (%s, %s, %s, %s, NOW())
+            ON CONFLICT (key) DO NOTHING
+        """, (key, mime, psycopg2.Binary(data), hashlib.sha256(data).hexdigest()))
+        claves[nombre] = key
+    return claves
@@ -0,0 +1,286 @@
+import json
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, Optional
+
+from backend.database import get_connection
+
+
+# Mientras un job corre, un hilo aparte actualiza heartbeat_at cada LATIDO_S
+# (aunque el handler no reporte progreso). Un job "corriendo" sin latido por más
+# de HEARTBEAT_VENCIDO_MIN es huérfano (proceso muerto: deploy, OOM...); cada
+# worker lo revisa cada RECUPERAR_CADA_S, no solo al arrancar.
+LATIDO_S = 30
+HEARTBEAT_VENCIDO_MIN = 3
+RECUPERAR_CADA_S = 60
+
+# Progreso: no escribir en BD más de una vez por intervalo (salvo el final)
+PROGRESO_INTERVALO_S = 1.0
+
+_handlers: Dict[str, Callable] = {}
+_despertar = threading.Event()
+_worker: Optional[threading.Thread] = None
+_worker_lock = threading.Lock()
+
+
+class JobEnCurso(Exception):
+    """encolar(unico=True) con un job del mismo tipo ya pendiente/corriendo pero con otros params."""
+
+    def __init__(self, job_id: int):
+        super().__init__(f"Ya hay un job en curso (id {job_id}) con otros parámetros")
+        self.job_id = job_id
+
+
+def registrar(tipo: str):
+    """
+    Decorador: registra el handler de un tipo de job.
+    El handler recibe (params: dict, progreso: Progreso) y devuelve un dict (resultado).
+    Si el resultado trae ok=False, el job queda en estado 'error'.
+    """
+    def deco(fn):
+        _handlers[tipo] = fn
+        return fn
+    return deco
+
+
+class Progreso:
+    """Callback de progreso: progreso(filas_leidas=..., fase=...) -> merge en jobs.progreso."""
+
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+        self.estado: Dict[str, Any] = {}
+        self._ultimo = 0.0
+
+    def __call__(self, forzar: bool = False, **campos):
+        self.estado.update(campos)
+        ahora = time.monotonic()
+        if not forzar and (ahora - self._ultimo) < PROGRESO_INTERVALO_S:
+            return
+        self._ultimo = ahora
+        try:
+            conn = get_connection()
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE jobs
+                SET progreso = progreso || %s::jsonb, heartbeat_at = NOW()
+                WHERE id = %s
+            """, (json.dumps(self.estado, ensure_ascii=False, default=str), self.job_id))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            print("JOBS WARN: no se pudo guardar progreso:", e)
+
+
+def encolar(tipo: str, params: Optional[dict] = None, actor_role=None, actor_id=None, unico: bool = False) -> int:
+    """
+    Inserta un job 'pendiente' y despierta al worker.
+    unico=True: si ya hay uno pendiente/corriendo del mismo tipo y con los mismos
+    params, devuelve ese id; si los params difieren lanza JobEnCurso.
+    """
+    params_json = json.dumps(params or {}, ensure_ascii=False)
+    conn = get_connection()
+    cur = conn.cursor()
+
+    if unico:
+        # lock por tipo hasta el commit: dos encolar() simultáneos no insertan ambos
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('jobs'), hashtext(%s))", (tipo,))
+        cur.execute("""
+            SELECT id, params FROM jobs
+            WHERE tipo = %s AND estado IN ('pendiente', 'corriendo')
+            ORDER BY id
+            LIMIT 1
+        """, (tipo,))
+        row = cur.fetchone()
+        if row:
+            conn.rollback()
+            conn.close()
+            iniciar_worker()
+            if (row.get("params") or {}) != json.loads(params_json):
+                raise JobEnCurso(row["id"])
+            return row["id"]
+
+    cur.execute("""
+        INSERT INTO jobs (tipo, params, actor_role, actor_id)
+        VALUES (%s, %s::jsonb, %s, %s)
+        RETURNING id
+    """, (tipo, params_json, actor_role, actor_id))
+    job_id = cur.fetchone()["id"]
+    conn.commit()
+    conn.close()
+
+    iniciar_worker()
+    _despertar.set()
+    return job_id
+
+
+def _fila_a_dict(row, con_resultado: bool) -> dict:
+    out = {
+        "id": row["id"],
+        "tipo": row["tipo"],
+        "estado": row["estado"],
+        "params": row.get("params") or {},
+        "progreso": row.get("progreso") or {},
+        "error": row.get("error"),
+        "created_at": row["created_at"].isoformat() if row.get("created_at") else None,
+        "started_at": row["started_at"].isoformat() if row.get("started_at") else None,
+        "finished_at": row["finished_at"].isoformat() if row.get("finished_at") else None,
+    }
+    if con_resultado:
+        out["resultado"] = row.get("resultado")
+    return out
+
+
+def obtener(job_id: int, con_resultado: bool = False) -> Optional[dict]:
+    conn = get_connection()
+    cur = conn.cursor()
+    cols = "*" if con_resultado else "id, tipo, estado, params, progreso, error, created_at, started_at, finished_at"
+    cur.execute(f"SELECT {cols} FROM jobs WHERE id = %s", (job_id,))
+    row = cur.fetchone()
+    conn.close()
+    return _fila_a_dict(row, con_resultado) if row else None
+
+
+def listar(tipo: Optional[str] = None, limit: int = 20) -> list:
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, tipo, estado, params, progreso, error, created_at, started_at, finished_at
+        FROM jobs
+        WHERE (%s::text IS NULL OR tipo = %s)
+        ORDER BY id DESC
+        LIMIT %s
+    """, (tipo, tipo, limit))
+    rows = cur.fetchall() or []
+    conn.close()
+    return [_fila_a_dict(r, False) for r in rows]
+
+
+# ---------------- WORKER ----------------
+
+def _recuperar_huerfanos():
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE jobs
+        SET estado = 'error', error = 'Proceso reiniciado durante la ejecución', finished_at = NOW()
+        WHERE estado = 'corriendo'
+          AND COALESCE(heartbeat_at, started_at) < NOW() - (%s * INTERVAL '1 minute')
+    """, (HEARTBEAT_VENCIDO_MIN,))
+    conn.commit()
+    conn.close()
+
+
+def _tomar_siguiente():
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE jobs
+        SET estado = 'corriendo', started_at = NOW(), heartbeat_at = NOW()
+        WHERE id = (
+            SELECT id FROM jobs
+            WHERE estado = 'pendiente'
+            ORDER BY id
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING id, tipo, params
+    """)
+    row = cur.fetchone()
+    conn.commit()
+    conn.close()
+    return row
+
+
+def _terminar(job_id: int, estado: str, resultado=None, error: Optional[str] = None):
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE jobs
+        SET estado = %s, resultado = %s::jsonb, error = %s, finished_at = NOW()
+        WHERE id = %s
+    """, (
+        estado,
+        json.dumps(resultado, ensure_ascii=False, default=str) if resultado is not None else None,
+        error,
+        job_id,
+    ))
+    conn.commit()
+    conn.close()
+
+
+def _latir(job_id: int, fin: threading.Event):
+    """heartbeat_at al día mientras el job corre (los handlers no siempre reportan progreso)."""
+    while not fin.wait(LATIDO_S):
+        try:
+            conn = get_connection()
+            cur = conn.cursor()
+            cur.execute("UPDATE jobs SET heartbeat_at = NOW() WHERE id = %s AND estado = 'corriendo'", (job_id,))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            print("JOBS WARN: no se pudo registrar latido:", e)
+
+
+def _ejecutar(job):
+    job_id = job["id"]
+    fn = _handlers.get(job["tipo"])
+    if fn is None:
+        _terminar(job_id, "error", error=f"Tipo de job desconocido: {job['tipo']}")
+        return
+
+    progreso = Progreso(job_id)
+    fin = threading.Event()
+    threading.Thread(target=_latir, args=(job_id, fin), name=f"jobs-latido-{job_id}", daemon=True).start()
+    try:
+        resultado = fn(job.get("params") or {}, progreso)
+    except Exception as e:
+        print(f"JOBS ERROR job {job_id} ({job['tipo']}):\n", traceback.format_exc())
+        _terminar(job_id, "error", error=str(e))
+        return
+    finally:
+        fin.set()
+
+    progreso(forzar=True)
+    if isinstance(resultado, dict) and resultado.get("ok") is False:
+        _terminar(job_id, "error", resultado=resultado, error=str(resultado.get("error") or "Error"))
+    else:
+        _terminar(job_id, "ok", resultado=resultado)
+
+
+def _loop():
+    ultima_recuperacion = 0.0
+
+    while True:
+        if time.monotonic() - ultima_recuperacion >= RECUPERAR_CADA_S:
+            ultima_recuperacion = time.monotonic()
+            try:
+                _recuperar_huerfanos()
+            except Exception as e:
+                print("JOBS WARN: no se pudo recuperar huérfanos:", e)
+
+        # clear ANTES de consultar: un encolar() que llegue durante la consulta
+        # deja el evento puesto y el wait de abajo vuelve enseguida
+        _despertar.clear()
+        try:
+            job = _tomar_siguiente()
+        except Exception as e:
+            print("JOBS WARN: no se pudo tomar job:", e)
+            job = None
+            time.sleep(5)
+
+        if job is None:
+            _despertar.wait(timeout=min(30, RECUPERAR_CADA_S))
+            continue
+
+        _ejecutar(job)
+
+
+def iniciar_worker():
+    """Arranca (una vez por proceso) el hilo que ejecuta jobs pendientes."""
+    global _worker
+    with _worker_lock:
+        if _worker is not None and _worker.is_alive():
+            return
+        _worker = threading.Thread(target=_loop, name="jobs-worker", daemon=True)
+        _worker.start()
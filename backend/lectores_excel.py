@@ -0,0 +1,201 @@
+import csv
+import os
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+# Lectores de la lista de precios del proveedor.
+# Cada lector recibe la ruta y devuelve (descuento_celda, filas):
+#   - descuento_celda: valor crudo de G6 en "HOJA PEDIDO" (o None si el formato no lo tiene)
+#   - filas: iterador de tuplas (codigo, descripcion, usd_unit, marca) = columnas B, G, H, J
+#     de "NUEVA LISTA DE PRECIOS" desde la fila 3, sin convertir (el import normaliza).
+
+SHEET_PRECIOS = "NUEVA LISTA DE PRECIOS"
+SHEET_PEDIDO = "HOJA PEDIDO"
+
+FILA_INICIO = 3          # 1-based, como en Excel
+COL_MIN, COL_MAX = 2, 10  # B..J (1-based)
+
+# posiciones dentro del rango B..J (0-based)
+_I_CODIGO, _I_DESC, _I_USD, _I_MARCA = 0, 5, 6, 8
+
+Fila = Tuple[Any, Any, Any, Any]
+Lector = Callable[[str], Tuple[Any, Iterator[Fila]]]
+
+
+class HojaNoEncontrada(Exception):
+    def __init__(self, hoja: str, sheets):
+        super().__init__(f"No existe la hoja '{hoja}'")
+        self.hoja = hoja
+        self.sheets = list(sheets or [])
+
+
+def _columnas(r) -> Fila:
+    r = tuple(r) + (None,) * (COL_MAX - COL_MIN + 1 - len(r))
+    return r[_I_CODIGO], r[_I_DESC], r[_I_USD], r[_I_MARCA]
+
+
+# ---------------- openpyxl (xlsx / xlsm) ----------------
+
+def leer_openpyxl(path: str):
+    """Streaming (read_only) y solo columnas B..J: no materializa el resto de la hoja."""
+    from openpyxl import load_workbook
+
+    wb = load_workbook(path, data_only=True, read_only=True, keep_vba=False)
+
+    ws_header = wb[SHEET_PEDIDO] if SHEET_PEDIDO in wb.sheetnames else wb.active
+    descuento = ws_header["G6"].value
+
+    if SHEET_PRECIOS not in wb.sheetnames:
+        sheets = wb.sheetnames
+        wb.close()
+        raise HojaNoEncontrada(SHEET_PRECIOS, sheets)
+
+    ws = wb[SHEET_PRECIOS]
+
+    def filas():
+        try:
+            for r in ws.iter_rows(min_row=FILA_INICIO, min_col=COL_MIN, max_col=COL_MAX, values_only=True):
+                yield _columnas(r)
+        finally:
+            wb.close()
+
+    return descuento, filas()
+
+
+# ---------------- xlrd (.xls viejo) ----------------
+
+def leer_xlrd(path: str):
+    import xlrd
+
+    book = xlrd.open_workbook(path, on_demand=True)
+    nombres = book.sheet_names()
+
+    descuento = None
+    try:
+        sh = book.sheet_by_name(SHEET_PEDIDO) if SHEET_PEDIDO in nombres else book.sheet_by_index(0)
+        if sh.nrows > 5 and sh.ncols > 6:
+            descuento = sh.cell_value(5, 6)  # G6
+    except Exception:
+        descuento = None
+
+    if SHEET_PRECIOS not in nombres:
+        book.release_resources()
+        raise HojaNoEncontrada(SHEET_PRECIOS, nombres)
+
+    sh = book.sheet_by_name(SHEET_PRECIOS)
+
+    def filas():
+        try:
+            for i in range(FILA_INICIO - 1, sh.nrows):
+                r = sh.row_values(i, start_colx=COL_MIN - 1, end_colx=min(COL_MAX, sh.ncols))
+                # xlrd devuelve "" en celdas vacías
+                yield _columnas([None if v == "" else v for v in r])
+        finally:
+            book.release_resources()
+
+    return descuento, filas()
+
+
+# ---------------- CSV (export de la hoja de precios) ----------------
+
+def _num_csv(v):
+    # "12,50" (coma decimal, export en español) -> "12.50"
+    if isinstance(v, str) and "," in v and "." not in v:
+        return v.replace(",", ".")
+    return v
+
+
+def leer_csv(path: str):
+    """CSV exportado de NUEVA LISTA DE PRECIOS (mismas columnas, datos desde la fila 3)."""
+    fh = open(path, "r", encoding="utf-8-sig", newline="")
+    muestra = fh.read(4096)
+    fh.seek(0)
+    # Excel en español exporta con ";" (la coma es decimal): gana el separador más frecuente
+    delimitador = max((";", ",", "\t"), key=muestra.count)
+
+    def filas():
+        try:
+            for i, r in enumerate(csv.reader(fh, delimiter=delimitador), start=1):
+                if i < FILA_INICIO:
+                    continue
+                codigo, desc, usd, marca = _columnas([v if v != "" else None for v in r[COL_MIN - 1:COL_MAX]])
+                yield codigo, desc, _num_csv(usd), marca
+        finally:
+            fh.close()
+
+    return None, filas()
+
+
+# ---------------- calamine (opcional, Rust) ----------------
+
+def leer_calamine(path: str):
+    """Lector rápido (python-calamine). Carga la hoja completa, pero en Rust."""
+    from python_calamine import CalamineWorkbook
+
+    wb = CalamineWorkbook.from_path(path)
+    nombres = wb.sheet_names
+
+    descuento = None
+    try:
+        hoja = SHEET_PEDIDO if SHEET_PEDIDO in nombres else nombres[0]
+        datos = wb.get_sheet_by_name(hoja).to_python(skip_empty_area=False, nrows=6)
+        if len(datos) > 5 and len(datos[5]) > 6:
+            descuento = datos[5][6]
+    except Exception:
+        descuento = None
+
+    if SHEET_PRECIOS not in nombres:
+        raise HojaNoEncontrada(SHEET_PRECIOS, nombres)
+
+    datos = wb.get_sheet_by_name(SHEET_PRECIOS).to_python(skip_empty_area=False)
+
+    def filas():
+        for r in datos[FILA_INICIO - 1:]:
+            yield _columnas([None if v == "" else v for v in r[COL_MIN - 1:COL_MAX]])
+
+    return descuento, filas()
+
+
+# ---------------- registro ----------------
+
+LECTORES: Dict[str, Lector] = {
+    "openpyxl": leer_openpyxl,
+    "xlrd": leer_xlrd,
+    "csv": leer_csv,
+    "calamine": leer_calamine,
+}
+
+POR_EXTENSION: Dict[str, str] = {
+    ".xlsx": "openpyxl",
+    ".xlsm": "openpyxl",
+    ".xls": "xlrd",
+    ".csv": "csv",
+}
+
+
+def registrar_lector(nombre: str, fn: Lector, extensiones=()):
+    """Agrega (o reemplaza) un lector; opcionalmente lo usa por defecto para esas extensiones."""
+    LECTORES[nombre] = fn
+    for ext in extensiones:
+        POR_EXTENSION[ext.lower()] = nombre
+
+
+def lector_para(path: str, nombre: Optional[str] = None) -> Lector:
+    """
+    Lector a usar: el pedido por nombre, luego LECTOR_EXCEL (env, solo Excel) y si no, por extensión.
+    Lanza ValueError si no hay lector.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if not nombre and ext != ".csv":
+        nombre = os.environ.get("LECTOR_EXCEL") or None
+    if nombre and nombre not in LECTORES:
+        raise ValueError(f"Lector desconocido: {nombre}")
+    if not nombre:
+        nombre = POR_EXTENSION.get(ext)
+    if not nombre:
+        raise ValueError(f"Extensión no soportada: {ext}")
+    return LECTORES[nombre]
+
+
+def leer_lista(path: str, lector: Optional[str] = None):
+    """(descuento_celda, filas) usando el lector que corresponda."""
+    return lector_para(path, lector)(path)
@@ -0,0 +1,226 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+# Límite de intentos de login / reset de contraseña.
+#
+# 1) Cubos de tokens en memoria por IP y por usuario: una ráfaga se rechaza
+#    antes de abrir conexión a la BD o calcular un hash.
+# 2) Bloqueo por usuario tras N fallos seguidos (ventana que se duplica en cada
+#    bloqueo nuevo, con tope). El contador vive en memoria y en la tabla
+#    login_fallos, para que con varios workers el bloqueo sea compartido; la
+#    consulta compartida usa la MISMA conexión del login (sin conexión extra).
+
+MAX_CLAVES = 20000
+
+FALLOS_BLOQUEO = int(os.getenv("LOGIN_FALLOS_BLOQUEO", "5"))
+BLOQUEO_BASE_S = 15 * 60
+BLOQUEO_MAX_S = 24 * 3600
+VENTANA_FALLOS_S = 3600   # fallos más viejos que esto no suman
+
+# cuántos proxies (Render) agregan X-Forwarded-For delante de la app
+PROXIES_CONFIABLES = int(os.getenv("PROXIES_CONFIABLES", "1"))
+
+
+class CuboTokens:
+    """capacidad tokens por clave, se recargan a por_seg; sin memoria ilimitada (LRU)."""
+
+    def __init__(self, nombre: str, capacidad: float, por_seg: float):
+        self.nombre = nombre
+        self.capacidad = float(capacidad)
+        self.por_seg = float(por_seg)
+        self._lock = threading.Lock()
+        self._cubos: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self.permitidos = 0
+        self.rechazados = 0
+
+    def tomar(self, clave: str) -> Tuple[bool, float]:
+        """(permitido, segundos hasta el próximo token)."""
+        ahora = time.monotonic()
+        with self._lock:
+            tokens, t = self._cubos.get(clave, (self.capacidad, ahora))
+            tokens = min(self.capacidad, tokens + (ahora - t) * self.por_seg)
+            if tokens >= 1.0:
+                self._cubos[clave] = (tokens - 1.0, ahora)
+                self._cubos.move_to_end(clave)
+                while len(self._cubos) > MAX_CLAVES:
+                    self._cubos.popitem(last=False)
+                self.permitidos += 1
+                return True, 0.0
+            self._cubos[clave] = (tokens, ahora)
+            self._cubos.move_to_end(clave)
+            self.rechazados += 1
+            return False, (1.0 - tokens) / self.por_seg
+
+    def resumen(self) -> dict:
+        with self._lock:
+            return {
+                "capacidad": self.capacidad,
+                "por_min": round(self.por_seg * 60, 2),
+                "claves": len(self._cubos),
+                "permitidos": self.permitidos,
+                "rechazados": self.rechazados,
+            }
+
+
+# login: 10 por IP de golpe y luego 10/min; 5 por usuario de golpe y luego 5 cada 15 min
+LOGIN_IP = CuboTokens("login_ip", 10, 10 / 60)
+LOGIN_USUARIO = CuboTokens("login_usuario", 5, 5 / 900)
+# reset de contraseña (manda correo): más estricto
+RESET_IP = CuboTokens("reset_ip", 5, 5 / 600)
+RESET_USUARIO = CuboTokens("reset_usuario", 3, 3 / 3600)
+
+
+class Bloqueado(Exception):
+    def __init__(self, motivo: str, reintentar_s: float):
+        super().__init__(motivo)
+        self.motivo = motivo
+        self.reintentar_s = max(1, int(reintentar_s + 0.999))
+
+
+# ---------------- bloqueo por fallos ----------------
+
+_fallos_lock = threading.Lock()
+_fallos: "OrderedDict[str, Dict]" = OrderedDict()   # usuario -> {fallos, desde, bloqueado_hasta, bloqueos}
+
+_stats = {"bloqueos": 0, "rechazados_bloqueo": 0, "rechazados_bloqueo_compartido": 0, "fallos": 0}
+
+LIMPIEZA_CADA = 500   # cada N fallos se borran filas viejas de login_fallos
+
+
+def _clave_usuario(tipo: str, usuario: str) -> str:
+    return f"{tipo}:{(usuario or '').strip().lower()}"
+
+
+def ip_cliente(request) -> str:
+    """IP real detrás de PROXIES_CONFIABLES proxies (el resto de X-Forwarded-For lo pone el cliente)."""
+    xff = [p.strip() for p in (request.headers.get("X-Forwarded-For") or "").split(",") if p.strip()]
+    if PROXIES_CONFIABLES and len(xff) >= PROXIES_CONFIABLES:
+        return xff[-PROXIES_CONFIABLES]
+    return request.remote_addr or "?"
+
+
+def _duracion_bloqueo(bloqueos: int) -> float:
+    return min(BLOQUEO_MAX_S, BLOQUEO_BASE_S * (2 ** max(0, bloqueos - 1)))
+
+
+def verificar(ip: str, tipo: str, usuario: str, cubo_ip: CuboTokens = LOGIN_IP,
+              cubo_usuario: CuboTokens = LOGIN_USUARIO):
+    """Chequeo en memoria, antes de cualquier BD o hash. Lanza Bloqueado."""
+    clave = _clave_usuario(tipo, usuario)
+
+    with _fallos_lock:
+        f = _fallos.get(clave)
+        restante = (f["bloqueado_hasta"] - time.time()) if f else 0
+    if restante > 0:
+        _stats["rechazados_bloqueo"] += 1
+        raise Bloqueado("Cuenta bloqueada temporalmente por intentos fallidos", restante)
+
+    ok, espera = cubo_ip.tomar(ip)
+    if not ok:
+        raise Bloqueado("Demasiados intentos desde esta conexión", espera)
+    ok, espera = cubo_usuario.tomar(clave)
+    if not ok:
+        raise Bloqueado("Demasiados intentos para este usuario", espera)
+
+
+def verificar_compartido(cur, tipo: str, usuario: str):
+    """
+    Bloqueo registrado por cualquier worker (tabla login_fallos). Usa el cursor del login:
+    una consulta por PK sobre la conexión que ya está abierta. Lanza Bloqueado.
+    """
+    clave = _clave_usuario(tipo, usuario)
+    cur.execute("""
+        SELECT EXTRACT(EPOCH FROM bloqueado_hasta - NOW()) AS restante_s
+        FROM login_fallos
+        WHERE clave = %s AND bloqueado_hasta > NOW()
+    """, (clave,))
+    row = cur.fetchone()
+    if row:
+        restante = float(row["restante_s"])
+        with _fallos_lock:
+            f = _fallos.setdefault(clave, {"fallos": 0, "desde": time.time(), "bloqueado_hasta": 0.0, "bloqueos": 0})
+            f["bloqueado_hasta"] = time.time() + restante
+        _stats["rechazados_bloqueo_compartido"] += 1
+        raise Bloqueado("Cuenta bloqueada temporalmente por intentos fallidos", restante)
+
+
+def registrar_fallo(cur, tipo: str, usuario: str):
+    """Suma un fallo (memoria + BD). No hace commit."""
+    clave = _clave_usuario(tipo, usuario)
+    ahora = time.time()
+    with _fallos_lock:
+        f = _fallos.get(clave)
+        if f is None or ahora - f["desde"] > VENTANA_FALLOS_S:
+            f = {"fallos": 0, "desde": ahora, "bloqueado_hasta": 0.0, "bloqueos": f["bloqueos"] if f else 0}
+            _fallos[clave] = f
+        _fallos.move_to_end(clave)
+        while len(_fallos) > MAX_CLAVES:
+            _fallos.popitem(last=False)
+
+    _stats["fallos"] += 1
+    if _stats["fallos"] % LIMPIEZA_CADA == 0:
+        cur.execute("""
+            DELETE FROM login_fallos
+            WHERE updated_at < NOW() - INTERVAL '1 day'
+              AND (bloqueado_hasta IS NULL OR bloqueado_hasta < NOW())
+        """)
+
+    # el contador compartido manda (suma los fallos de todos los workers)
+    cur.execute("""
+        INSERT INTO login_fallos (clave, fallos, desde, bloqueos, updated_at)
+        VALUES (%s, 1, NOW(), 0, NOW())
+        ON CONFLICT (clave) DO UPDATE SET
+            fallos = CASE WHEN login_fallos.desde < NOW() - (%s * INTERVAL '1 second')
+                          THEN 1 ELSE login_fallos.fallos + 1 END,
+            desde = CASE WHEN login_fallos.desde < NOW() - (%s * INTERVAL '1 second')
+                         THEN NOW() ELSE login_fallos.desde END,
+            updated_at = NOW()
+        RETURNING fallos, bloqueos
+    """, (clave, VENTANA_FALLOS_S, VENTANA_FALLOS_S))
+    row = cur.fetchone()
+    fallos, bloqueos = int(row["fallos"]), int(row["bloqueos"])
+
+    if fallos >= FALLOS_BLOQUEO:
+        bloqueos += 1
+        dur = _duracion_bloqueo(bloqueos)
+        cur.execute("""
+            UPDATE login_fallos
+            SET fallos = 0, desde = NOW(), bloqueos = %s,
+                bloqueado_hasta = NOW() + (%s * INTERVAL '1 second')
+            WHERE clave = %s
+        """, (bloqueos, dur, clave))
+        with _fallos_lock:
+            f.update(fallos=0, desde=ahora, bloqueos=bloqueos, bloqueado_hasta=ahora + dur)
+        _stats["bloqueos"] += 1
+        print(f"WARN: login bloqueado {clave} por {int(dur)}s ({FALLOS_BLOQUEO} fallos)")
+    else:
+        with _fallos_lock:
+            f["fallos"] = fallos
+
+
+def registrar_exito(cur, tipo: str, usuario: str):
+    """
+    Login correcto: se olvidan los fallos. El DELETE va siempre (es por PK, en la conexión
+    corta que abre el login tras verificar): los fallos pudieron quedar en la BD desde otro
+    worker o antes de un reinicio.
+    """
+    clave = _clave_usuario(tipo, usuario)
+    with _fallos_lock:
+        _fallos.pop(clave, None)
+    cur.execute("DELETE FROM login_fallos WHERE clave = %s", (clave,))
+
+
+def metricas() -> dict:
+    with _fallos_lock:
+        ahora = time.time()
+        bloqueados = sum(1 for f in _fallos.values() if f["bloqueado_hasta"] > ahora)
+        con_fallos = len(_fallos)
+    return {
+        "cubos": {c.nombre: c.resumen() for c in (LOGIN_IP, LOGIN_USUARIO, RESET_IP, RESET_USUARIO)},
+        "usuarios_con_fallos": con_fallos,
+        "usuarios_bloqueados": bloqueados,
+        **_stats,
+    }
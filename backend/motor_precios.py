@@ -0,0 +1,178 @@
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Motor de precios: calcula TODO el catálogo en una pasada con NumPy.
+# Fórmula (la misma de siempre):
+#   costo_bs = usd * tipo_cambio * (1 - descuento_proveedor)
+#   margen   = el del primer tramo con costo_bs < hasta_bs (último tramo sin tope)
+#   web      = round(costo_bs * (1 + margen), 2)
+#   desc25   = round(web * 0.75, 2)
+# Tramos y tipo de cambio viven en la BD (precio_tramos / precio_parametros).
+
+TIPO_CAMBIO_DEFAULT = float(os.getenv("TIPO_CAMBIO", "6.96"))
+
+# (hasta_bs, margen); None = sin tope
+TRAMOS_DEFAULT: Tuple[Tuple[Optional[float], float], ...] = (
+    (30.0, 0.45),
+    (80.0, 0.35),
+    (200.0, 0.28),
+    (None, 0.20),
+)
+
+FACTOR_DESCUENTO25 = 0.75
+
+
+class ConfigPrecios:
+    """Tramos de margen + tipo de cambio (validados)."""
+
+    def __init__(self, tramos: Iterable, tipo_cambio: float):
+        tramos = [
+            (None if hasta is None else float(hasta), float(margen))
+            for hasta, margen in tramos
+        ]
+        if not tramos:
+            raise ValueError("Se necesita al menos un tramo de margen")
+        if tramos[-1][0] is not None or any(h is None for h, _ in tramos[:-1]):
+            raise ValueError("Solo el último tramo puede (y debe) no tener tope")
+        limites = [h for h, _ in tramos[:-1]]
+        if any(b <= a for a, b in zip(limites, limites[1:])):
+            raise ValueError("Los topes de los tramos deben ser crecientes")
+        if any(m < 0 or m > 10 for _, m in tramos):
+            raise ValueError("Margen fuera de rango (0 a 10)")
+
+        tipo_cambio = float(tipo_cambio)
+        if not (tipo_cambio > 0):
+            raise ValueError("El tipo de cambio debe ser mayor a 0")
+
+        self.tramos = tramos
+        self.tipo_cambio = tipo_cambio
+        self._limites = np.array(limites, dtype=np.float64)
+        self._margenes = np.array([m for _, m in tramos], dtype=np.float64)
+
+    def margen(self, costo_bs: float) -> float:
+        for hasta, margen in self.tramos:
+            if hasta is None or costo_bs < hasta:
+                return margen
+        return self.tramos[-1][1]
+
+    def con_cambios(self, tipo_cambio=None, tramos=None) -> "ConfigPrecios":
+        return ConfigPrecios(
+            self.tramos if tramos is None else tramos,
+            self.tipo_cambio if tipo_cambio is None else tipo_cambio,
+        )
+
+    def a_dict(self) -> dict:
+        return {
+            "tipo_cambio": self.tipo_cambio,
+            "tramos": [{"hasta_bs": h, "margen": m} for h, m in self.tramos],
+        }
+
+
+CONFIG_DEFAULT = ConfigPrecios(TRAMOS_DEFAULT, TIPO_CAMBIO_DEFAULT)
+
+
+def tramos_desde_json(data) -> List[Tuple[Optional[float], float]]:
+    """[{"hasta_bs": 30, "margen": 0.45}, ..., {"hasta_bs": null, "margen": 0.2}] -> [(30.0, 0.45), ...]"""
+    if not isinstance(data, list):
+        raise ValueError("tramos debe ser una lista")
+    out = []
+    for t in data:
+        if not isinstance(t, dict) or "margen" not in t:
+            raise ValueError("Cada tramo necesita 'margen' (y 'hasta_bs', null en el último)")
+        hasta = t.get("hasta_bs")
+        out.append((None if hasta in (None, "") else float(hasta), float(t["margen"])))
+    return out
+
+
+# ---------------- BD ----------------
+
+def cargar_config(cur) -> ConfigPrecios:
+    """Config vigente desde la BD (o la de siempre si las tablas aún no existen / están vacías)."""
+    cur.execute("SELECT to_regclass('precio_tramos') IS NOT NULL AS t, to_regclass('precio_parametros') IS NOT NULL AS p")
+    existe = cur.fetchone() or {}
+
+    tramos = None
+    if existe.get("t"):
+        cur.execute("SELECT hasta_bs, margen FROM precio_tramos ORDER BY hasta_bs ASC NULLS LAST, orden")
+        rows = cur.fetchall() or []
+        if rows:
+            tramos = [(r["hasta_bs"], r["margen"]) for r in rows]
+
+    tipo_cambio = None
+    if existe.get("p"):
+        cur.execute("SELECT valor FROM precio_parametros WHERE clave = 'tipo_cambio'")
+        row = cur.fetchone()
+        if row:
+            tipo_cambio = row["valor"]
+
+    return ConfigPrecios(
+        tramos if tramos is not None else TRAMOS_DEFAULT,
+        tipo_cambio if tipo_cambio is not None else TIPO_CAMBIO_DEFAULT,
+    )
+
+
+def guardar_config(cur, cfg: ConfigPrecios):
+    """Reemplaza tramos y tipo de cambio (dentro de la transacción del caller)."""
+    cur.execute("DELETE FROM precio_tramos")
+    for orden, (hasta, margen) in enumerate(cfg.tramos, start=1):
+        cur.execute(
+            "INSERT INTO precio_tramos (orden, hasta_bs, margen) VALUES (%s, %s, %s)",
+            (orden, hasta, margen),
+        )
+    cur.execute("""
+        INSERT INTO precio_parametros (clave, valor, updated_at)
+        VALUES ('tipo_cambio', %s, NOW())
+        ON CONFLICT (clave) DO UPDATE SET valor = EXCLUDED.valor, updated_at = NOW()
+    """, (cfg.tipo_cambio,))
+
+
+# ---------------- cálculo ----------------
+
+def _redondear2(x: np.ndarray) -> np.ndarray:
+    """
+    round(x, 2) de Python, vectorizado.
+    np.round (rint(x*100)/100) coincide salvo cuando x*100 cae casi justo en .5:
+    esos pocos casos (y valores enormes) se recalculan con round() para dar el mismo resultado.
+    """
+    r = np.round(x, 2)
+    x100 = x * 100.0
+    dudosos = np.flatnonzero((np.abs(x100 - np.floor(x100) - 0.5) < 1e-6) | (np.abs(x) >= 1e7))
+    for i in dudosos:
+        r[i] = round(float(x[i]), 2)
+    return r
+
+
+def calcular(usd, descuento, cfg: ConfigPrecios = CONFIG_DEFAULT) -> Dict[str, np.ndarray]:
+    """
+    usd: secuencia/array de USD unitarios; descuento: float o array del mismo largo.
+    Devuelve arrays float64: bs_price_proveedor, margen, bs_price_web, bs_price_descuento25.
+    """
+    usd = np.asarray(usd, dtype=np.float64)
+    descuento = np.asarray(descuento, dtype=np.float64)
+
+    # mismo orden de operaciones que el cálculo por fila (mismos bits)
+    costo_bs = usd * cfg.tipo_cambio * (1.0 - descuento)
+    margen = cfg._margenes[np.searchsorted(cfg._limites, costo_bs, side="right")]
+    bs_web = _redondear2(costo_bs * (1.0 + margen))
+
+    return {
+        "bs_price_proveedor": _redondear2(costo_bs),
+        "margen": margen,
+        "bs_price_web": bs_web,
+        "bs_price_descuento25": _redondear2(bs_web * FACTOR_DESCUENTO25),
+    }
+
+
+def calcular_uno(usd: float, descuento: float, cfg: ConfigPrecios = CONFIG_DEFAULT) -> Dict[str, float]:
+    """Versión escalar (referencia / un solo producto)."""
+    costo_bs = usd * cfg.tipo_cambio * (1.0 - float(descuento))
+    margen = cfg.margen(costo_bs)
+    bs_web = round(costo_bs * (1.0 + margen), 2)
+    return {
+        "bs_price_proveedor": round(costo_bs, 2),
+        "margen": float(margen),
+        "bs_price_web": float(bs_web),
+        "bs_price_descuento25": float(round(bs_web * FACTOR_DESCUENTO25, 2)),
+    }
@@ -0,0 +1,495 @@
+import copy
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from backend.database import get_connection
+
+# Sesiones del lado del servidor + principal cacheado.
+#
+# La cookie solo lleva un ID opaco; en la BD (tabla sesiones) se guarda su sha256,
+# los datos de la sesión y a qué principal pertenece (para revocar en bloque).
+# Delante hay un LRU en memoria: una sesión ya vista no toca la BD en el request.
+# last_seen se acumula en memoria y se escribe por lotes; las revocaciones hechas
+# por otros procesos llegan con un sondeo cada SYNC_S segundos.
+# Un ID desconocido/vencido/revocado también queda en el LRU (negativo, NEGATIVO_S)
+# y su cookie se borra: una cookie vieja o inventada no cuesta una consulta por request.
+
+LRU_MAX = 10000
+SYNC_S = float(os.getenv("SESIONES_SYNC_S", "10"))  # sondeo de revocaciones de otros procesos
+SYNC_SOLAPE_S = 60    # revocada_at es el inicio de SU transacción: puede commitear después del sondeo
+FLUSH_S = 30          # escritura por lotes de last_seen
+VISTO_MIN_S = 60      # no se re-anota last_seen más seguido que esto por sesión
+LIMPIEZA_S = 3600
+RETENCION_DIAS = 1    # filas vencidas/revocadas se borran pasado esto
+NEGATIVO_S = 300      # cuánto se recuerda que un ID no existe
+
+# ---------------- principal cacheado (versión por principal) ----------------
+# /api/auth/me se llama en cada carga de página: con esto no toca la BD mientras
+# el sello de versión de la sesión coincida con el del proceso.
+#
+# Sello = "<arranque>:<n>". <n> sube cada vez que algo cambia los datos del principal
+# (descuento, contraseña, activación); <arranque> cambia al reiniciar el proceso,
+# así que tras un deploy cada sesión recarga una vez desde la BD.
+
+_ARRANQUE = secrets.token_hex(4)
+
+_lock = threading.Lock()
+_versiones: Dict[Tuple[str, int], int] = {}
+
+_stats = {"hits": 0, "recargas": 0, "invalidaciones": 0}
+
+CLAVE_PRINCIPAL = "principal"
+CLAVE_VERSION = "pv"
+
+
+def _clave(role: str, principal_id) -> Tuple[str, int]:
+    # ADMIN y SUPER_ADMIN comparten tabla (admins): se invalidan por el mismo id
+    tipo = "EMPRESA" if role == "EMPRESA" else "ADMIN"
+    return tipo, int(principal_id or 0)
+
+
+def version(role: str, principal_id) -> str:
+    return f"{_ARRANQUE}:{_versiones.get(_clave(role, principal_id), 0)}"
+
+
+def invalidar(role: str, principal_id):
+    """Marca como viejo el principal cacheado en TODAS las sesiones de ese principal."""
+    k = _clave(role, principal_id)
+    with _lock:
+        _versiones[k] = _versiones.get(k, 0) + 1
+        _stats["invalidaciones"] += 1
+
+
+def guardar(sess, principal: dict):
+    """Guarda el principal en la sesión con el sello vigente."""
+    pid = principal.get("empresa_id") if principal.get("role") == "EMPRESA" else principal.get("admin_id")
+    sess[CLAVE_PRINCIPAL] = principal
+    sess[CLAVE_VERSION] = version(principal.get("role"), pid)
+
+
+def leer(sess) -> Optional[dict]:
+    """Principal cacheado si sigue vigente; None si hay que recargarlo de la BD."""
+    principal = sess.get(CLAVE_PRINCIPAL)
+    role = sess.get("role")
+    if not principal or principal.get("role") != role:
+        _stats["recargas"] += 1
+        return None
+    pid = sess.get("empresa_id") if role == "EMPRESA" else sess.get("admin_id")
+    if sess.get(CLAVE_VERSION) != version(role, pid):
+        _stats["recargas"] += 1
+        return None
+    _stats["hits"] += 1
+    return principal
+
+
+# ---------------- almacén de sesiones ----------------
+
+class _Entrada:
+    __slots__ = ("datos", "tipo", "principal_id", "expira", "visto")
+
+    def __init__(self, datos: Optional[dict], tipo: Optional[str], principal_id: Optional[int], expira: float):
+        self.datos = datos        # None = entrada negativa (ID inexistente) hasta `expira`
+        self.tipo = tipo
+        self.principal_id = principal_id
+        self.expira = expira      # epoch
+        self.visto = time.time()  # último last_seen anotado para escribir
+
+
+_lru_lock = threading.Lock()
+_lru: "OrderedDict[str, _Entrada]" = OrderedDict()
+
+_vistos_lock = threading.Lock()
+_vistos: Dict[str, Tuple[float, float]] = {}   # id_hash -> (visto, expira) pendiente de escribir
+
+_worker: Optional[threading.Thread] = None
+_worker_lock = threading.Lock()
+
+_stats_almacen = {
+    "lru_hits": 0, "lru_misses": 0, "negativos": 0, "escrituras": 0,
+    "vistos_escritos": 0, "revocadas": 0, "revocadas_remotas": 0, "revocadas_al_guardar": 0,
+}
+
+
+def _hash(sid: str) -> str:
+    return hashlib.sha256(sid.encode("utf-8")).hexdigest()
+
+
+def _principal_de(datos: dict) -> Tuple[Optional[str], Optional[int]]:
+    role = datos.get("role")
+    if not role:
+        return None, None
+    pid = datos.get("empresa_id") if role == "EMPRESA" else datos.get("admin_id")
+    if pid is None:
+        return None, None
+    return _clave(role, pid)
+
+
+def _lru_get(h: str) -> Optional[_Entrada]:
+    with _lru_lock:
+        e = _lru.get(h)
+        if e is not None:
+            _lru.move_to_end(h)
+        return e
+
+
+def _lru_put(h: str, e: _Entrada):
+    with _lru_lock:
+        _lru[h] = e
+        _lru.move_to_end(h)
+        while len(_lru) > LRU_MAX:
+            _lru.popitem(last=False)
+
+
+def _lru_negativo(h: str):
+    _lru_put(h, _Entrada(None, None, None, time.time() + NEGATIVO_S))
+    with _vistos_lock:
+        _vistos.pop(h, None)
+
+
+def _lru_quitar(hashes):
+    with _lru_lock:
+        for h in hashes:
+            _lru.pop(h, None)
+    with _vistos_lock:
+        for h in hashes:
+            _vistos.pop(h, None)
+
+
+def _cargar_bd(h: str) -> Optional[_Entrada]:
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT datos, principal_tipo, principal_id,
+               EXTRACT(EPOCH FROM expira_at) AS expira
+        FROM sesiones
+        WHERE id_hash = %s AND revocada_at IS NULL AND expira_at > NOW()
+    """, (h,))
+    row = cur.fetchone()
+    conn.close()
+    if not row:
+        return None
+    return _Entrada(row["datos"] or {}, row["principal_tipo"], row["principal_id"], float(row["expira"]))
+
+
+def _escribir_bd(h: str, e: _Entrada, reemplaza: Optional[str] = None) -> bool:
+    """Upsert de la sesión. False si ya estaba revocada (no se resucita)."""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO sesiones (id_hash, principal_tipo, principal_id, datos, created_at, last_seen_at, expira_at)
+        VALUES (%s, %s, %s, %s::jsonb, NOW(), NOW(), TO_TIMESTAMP(%s) AT TIME ZONE 'UTC')
+        ON CONFLICT (id_hash) DO UPDATE SET
+            principal_tipo = EXCLUDED.principal_tipo,
+            principal_id = EXCLUDED.principal_id,
+            datos = EXCLUDED.datos,
+            last_seen_at = NOW(),
+            expira_at = EXCLUDED.expira_at
+        WHERE sesiones.revocada_at IS NULL
+        RETURNING id_hash
+    """, (h, e.tipo, e.principal_id, json.dumps(e.datos, ensure_ascii=False), e.expira))
+    escrita = cur.fetchone() is not None
+    if reemplaza:
+        # rotación de ID al cambiar de principal (login): la sesión anterior queda muerta
+        cur.execute("UPDATE sesiones SET revocada_at = NOW() WHERE id_hash = %s AND revocada_at IS NULL", (reemplaza,))
+    conn.commit()
+    conn.close()
+    _stats_almacen["escrituras" if escrita else "revocadas_al_guardar"] += 1
+    return escrita
+
+
+def _borrar_bd(h: str):
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("UPDATE sesiones SET revocada_at = NOW() WHERE id_hash = %s AND revocada_at IS NULL", (h,))
+    conn.commit()
+    conn.close()
+
+
+def _anotar_visto(h: str, e: _Entrada, lifetime_s: float):
+    ahora = time.time()
+    e.expira = ahora + lifetime_s   # expiración deslizante (en BD se actualiza con el lote)
+    if ahora - e.visto < VISTO_MIN_S:
+        return
+    e.visto = ahora
+    with _vistos_lock:
+        _vistos[h] = (ahora, e.expira)
+    iniciar_worker()
+
+
+class SesionServidor(CallbackDict, SessionMixin):
+    modified = False
+    accessed = False
+
+    def __init__(self, initial=None, sid: Optional[str] = None, principal=(None, None),
+                 cookie_invalida: bool = False):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = sid is None
+        self.cookie_invalida = cookie_invalida  # trajo un ID que no existe: se borra la cookie
+        self.principal_abierto = principal  # (tipo, id) con el que se abrió: si cambia, se rota el ID
+
+    # como SecureCookieSession: leer también cuenta como acceso (Vary: Cookie)
+    def __getitem__(self, key):
+        self.accessed = True
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed = True
+        return super().get(key, default)
+
+    def setdefault(self, key, default=None):
+        self.accessed = True
+        return super().setdefault(key, default)
+
+
+class AlmacenSesiones(SessionInterface):
+    """SessionInterface de Flask sobre la tabla sesiones con LRU en memoria."""
+
+    session_class = SesionServidor
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid:
+            return self.session_class()
+
+        h = _hash(sid)
+        e = _lru_get(h)
+        if e is not None and e.datos is None and e.expira < time.time():
+            e = None   # negativo vencido: se vuelve a consultar
+        if e is None:
+            _stats_almacen["lru_misses"] += 1
+            try:
+                e = _cargar_bd(h)
+            except Exception as ex:
+                # error de BD: sesión vacía pero sin borrar la cookie (puede ser válida)
+                print("SESIONES WARN: no se pudo leer la sesión:", ex)
+                return self.session_class()
+            if e is None:
+                _lru_negativo(h)
+                return self.session_class(cookie_invalida=True)
+            _lru_put(h, e)
+        elif e.datos is None:
+            _stats_almacen["negativos"] += 1
+            return self.session_class(cookie_invalida=True)
+        else:
+            _stats_almacen["lru_hits"] += 1
+
+        if e.expira < time.time():
+            _lru_negativo(h)
+            return self.session_class(cookie_invalida=True)
+
+        _anotar_visto(h, e, app.permanent_session_lifetime.total_seconds())
+        return self.session_class(copy.deepcopy(e.datos), sid=sid, principal=(e.tipo, e.principal_id))
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if not session:
+            # logout (session.clear()): se revoca en BD y se borra la cookie
+            if session.sid:
+                h = _hash(session.sid)
+                _lru_quitar([h])
+                try:
+                    _borrar_bd(h)
+                except Exception as ex:
+                    print("SESIONES WARN: no se pudo revocar la sesión:", ex)
+            if session.sid or session.cookie_invalida:
+                response.delete_cookie(name, domain=domain, path=path, secure=secure,
+                                       samesite=samesite, httponly=httponly)
+            return
+
+        sid = session.sid
+        if session.modified or sid is None:
+            datos = dict(session)
+            tipo, principal_id = _principal_de(datos)
+            expira = time.time() + app.permanent_session_lifetime.total_seconds()
+
+            anterior = None
+            if sid is not None and session.principal_abierto != (tipo, principal_id):
+                anterior = _hash(sid)
+                sid = None
+            if sid is None:
+                sid = secrets.token_urlsafe(32)
+
+            h = _hash(sid)
+            e = _Entrada(datos, tipo, principal_id, expira)
+            escrita = _escribir_bd(h, e, reemplaza=anterior)
+            if anterior:
+                _lru_quitar([anterior])
+            if not escrita:
+                # revocada mientras corría el request: no vuelve al LRU y se borra la cookie
+                _lru_negativo(h)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure,
+                                       samesite=samesite, httponly=httponly)
+                return
+            _lru_put(h, e)
+            session.sid = sid
+        elif not self.should_set_cookie(app, session):
+            return
+
+        response.set_cookie(
+            name, sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=httponly, domain=domain, path=path,
+            secure=secure, samesite=samesite,
+        )
+
+
+def revocar_principal(role: str, principal_id) -> int:
+    """Revoca todas las sesiones de un principal (admin desactivado, reset de contraseña)."""
+    tipo, pid = _clave(role, principal_id)
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE sesiones SET revocada_at = NOW()
+        WHERE principal_tipo = %s AND principal_id = %s AND revocada_at IS NULL
+        RETURNING id_hash
+    """, (tipo, pid))
+    hashes = [r["id_hash"] for r in (cur.fetchall() or [])]
+    conn.commit()
+    conn.close()
+
+    _lru_quitar(hashes)
+    _stats_almacen["revocadas"] += len(hashes)
+    return len(hashes)
+
+
+# ---------------- worker: last_seen por lotes + revocaciones remotas ----------------
+
+def _flush_vistos():
+    with _vistos_lock:
+        lote = dict(_vistos)
+        _vistos.clear()
+    if not lote:
+        return
+    hashes = list(lote.keys())
+    vistos = [datetime.utcfromtimestamp(v) for v, _ in lote.values()]
+    expiras = [datetime.utcfromtimestamp(x) for _, x in lote.values()]
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE sesiones s
+        SET last_seen_at = v.visto, expira_at = v.expira
+        FROM unnest(%s::text[], %s::timestamp[], %s::timestamp[]) AS v(id_hash, visto, expira)
+        WHERE s.id_hash = v.id_hash AND s.revocada_at IS NULL
+    """, (hashes, vistos, expiras))
+    conn.commit()
+    conn.close()
+    _stats_almacen["vistos_escritos"] += len(hashes)
+
+
+def _sync_revocadas(desde):
+    """
+    Saca del LRU lo revocado (por cualquier proceso) desde la última consulta.
+    revocada_at = NOW() de la transacción que revocó, que puede haber empezado antes del
+    sondeo anterior y commiteado después: se relee con SYNC_SOLAPE_S de solape.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT NOW() AS ahora")
+    ahora = cur.fetchone()["ahora"]
+    hashes = []
+    if desde is not None:
+        cur.execute(
+            "SELECT id_hash FROM sesiones WHERE revocada_at >= %s - (%s * INTERVAL '1 second')",
+            (desde, SYNC_SOLAPE_S),
+        )
+        hashes = [r["id_hash"] for r in (cur.fetchall() or [])]
+    conn.close()
+    if hashes:
+        with _lru_lock:
+            presentes = [h for h in hashes if h in _lru and _lru[h].datos is not None]
+        _lru_quitar(presentes)
+        _stats_almacen["revocadas_remotas"] += len(presentes)
+    return ahora
+
+
+def _limpiar():
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        DELETE FROM sesiones
+        WHERE expira_at < NOW() - (%s * INTERVAL '1 day')
+           OR revocada_at < NOW() - (%s * INTERVAL '1 day')
+    """, (RETENCION_DIAS, RETENCION_DIAS))
+    n = cur.rowcount
+    conn.commit()
+    conn.close()
+    if n:
+        print(f"INFO: sesiones: {n} vencidas/revocadas borradas")
+
+
+def _loop():
+    desde = None
+    ultimo_flush = time.monotonic()
+    ultima_limpieza = 0.0
+    while True:
+        try:
+            desde = _sync_revocadas(desde)
+            ahora = time.monotonic()
+            if ahora - ultimo_flush >= FLUSH_S:
+                ultimo_flush = ahora
+                _flush_vistos()
+            if ahora - ultima_limpieza >= LIMPIEZA_S:
+                ultima_limpieza = ahora
+                _limpiar()
+        except Exception:
+            print("SESIONES ERROR:\n", traceback.format_exc())
+        time.sleep(SYNC_S)
+
+
+def iniciar_worker():
+    """Arranca (una vez por proceso) el hilo de last_seen / revocaciones / limpieza."""
+    global _worker
+    if _worker is not None and _worker.is_alive():
+        return
+    with _worker_lock:
+        if _worker is not None and _worker.is_alive():
+            return
+        _worker = threading.Thread(target=_loop, name="sesiones-worker", daemon=True)
+        _worker.start()
+
+
+def metricas() -> dict:
+    total = _stats["hits"] + _stats["recargas"]
+    with _lru_lock:
+        en_lru = len(_lru)
+    with _vistos_lock:
+        pendientes = len(_vistos)
+    return {
+        "principal": {
+            **_stats,
+            "tasa_hit": round(_stats["hits"] / total, 3) if total else None,
+            "principales_invalidados": len(_versiones),
+        },
+        "almacen": {
+            **_stats_almacen,
+            "en_lru": en_lru,
+            "lru_max": LRU_MAX,
+            "vistos_pendientes": pendientes,
+            "worker_vivo": bool(_worker is not None and _worker.is_alive()),
+        },
+    }
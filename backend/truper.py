@@ -0,0 +1,373 @@
+import codecs
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import quote, urlparse
+
+from backend import http_cliente
+from backend.database import get_connection
+
+# Búsqueda de imágenes de producto en truper.com por código.
+# - pool acotado de hilos (no más de MAX_WORKERS pedidos en vuelo)
+# - límite de pedidos por segundo POR HOST (no martillar a Truper)
+# - cache persistente código -> imagen en BD, con aciertos Y "no encontrado" (TTL distinto)
+# - fuentes (resolvers) y parsers enchufables, con métricas de acierto por fuente
+
+MAX_WORKERS = int(os.getenv("TRUPER_WORKERS", "6"))
+PEDIDOS_POR_SEG = float(os.getenv("TRUPER_RPS", "4"))
+TIMEOUT_S = 12
+
+TTL_ENCONTRADO_DIAS = int(os.getenv("TRUPER_CACHE_TTL_DIAS", "30"))
+TTL_NO_ENCONTRADO_DIAS = int(os.getenv("TRUPER_CACHE_TTL_NEG_DIAS", "7"))
+
+USER_AGENT = "Mozilla/5.0 (compatible; FerroCentralBot/1.0)"
+
+
+# ---------------- rate limit por host ----------------
+
+class LimitadorHost:
+    """Espacia los pedidos a un mismo host: como mucho `por_seg` inicios por segundo."""
+
+    def __init__(self, por_seg: float):
+        self.intervalo = 1.0 / por_seg if por_seg > 0 else 0.0
+        self._lock = threading.Lock()
+        self._proximo: Dict[str, float] = {}
+
+    def esperar(self, host: str):
+        if not self.intervalo:
+            return
+        with self._lock:
+            ahora = time.monotonic()
+            turno = max(ahora, self._proximo.get(host, 0.0))
+            self._proximo[host] = turno + self.intervalo
+        if turno > ahora:
+            time.sleep(turno - ahora)
+
+
+_limitador = LimitadorHost(PEDIDOS_POR_SEG)
+
+
+# ---------------- parsers (escaneo en streaming) ----------------
+# Un parser = (nombre, regex con un grupo = URL candidata). El HTML se lee por bloques
+# y se corta la descarga en el PRIMER candidato válido (galería/og:image del producto).
+# Nunca se acepta "cualquier <img>": así salía el logo del sitio.
+
+BLOQUE_BYTES = 16 * 1024
+MAX_BYTES_HTML = 1536 * 1024
+SOLAPE_CHARS = 2048  # una etiqueta partida entre dos bloques igual se encuentra
+
+_URL_PRODUCTO = r'((?:https?:)?//[^"\'\s<>]+/media/catalog/product/[^"\'\s<>]+?\.(?:jpe?g|png|webp|gif))'
+
+PARSERS = [
+    ("og_image", re.compile(
+        r'<meta[^>]+property=["\']og:image["\'][^>]*content=["\']([^"\']+)["\']', re.IGNORECASE)),
+    ("galeria", re.compile(
+        r'<img[^>]+class=["\'][^"\']*product-image-photo[^"\']*["\'][^>]*?(?:data-src|src)=["\']([^"\']+)["\']',
+        re.IGNORECASE)),
+    ("media_catalogo", re.compile(_URL_PRODUCTO, re.IGNORECASE)),
+]
+
+_NO_PRODUCTO = ("placeholder", "logo", "/static/", "/images/", "blank", "spacer")
+
+
+def _normalizar_url(url: str) -> str:
+    url = (url or "").strip().replace("&amp;", "&")
+    if url.startswith("//"):
+        url = "https:" + url
+    elif url.startswith("/"):
+        url = "https://www.truper.com" + url
+    return url
+
+
+def es_imagen_producto(url: str) -> bool:
+    """Solo fotos del catálogo Magento (media/catalog/product), nunca logos/placeholders."""
+    u = (url or "").lower()
+    if "/media/catalog/product/" not in u:
+        return False
+    return not any(x in u for x in _NO_PRODUCTO)
+
+
+def escanear_html(fh, parsers=None):
+    """
+    Lee fh por bloques hasta el primer match válido.
+    fh: archivo binario (se lee de a BLOQUE_BYTES) o un iterable de bloques bytes.
+    -> (url|None, nombre_parser|None, bytes_leidos)
+    """
+    parsers = parsers or PARSERS
+    bloques = iter(lambda: fh.read(BLOQUE_BYTES), b"") if hasattr(fh, "read") else iter(fh)
+    dec = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    buf = ""
+    leidos = 0
+    while True:
+        data = next(bloques, b"")
+        leidos += len(data)
+        buf += dec.decode(data, final=not data)
+
+        for nombre, patron in parsers:
+            for m in patron.finditer(buf):
+                url = _normalizar_url(m.group(1))
+                if es_imagen_producto(url):
+                    return url, nombre, leidos
+
+        if not data or leidos >= MAX_BYTES_HTML:
+            return None, None, leidos
+        buf = buf[-SOLAPE_CHARS:]
+
+
+# ---------------- resolvers (fuentes) ----------------
+# Un resolver recibe el código y devuelve (url|None, parser|None, bytes_leidos).
+# Se prueban en orden; el primero que encuentra gana. registrar_resolver() agrega otros.
+
+def _abrir(url: str):
+    _limitador.esperar(urlparse(url).netloc)
+    resp = http_cliente.get(
+        url,
+        stream=True,
+        timeout=(5, TIMEOUT_S),
+        headers={
+            "User-Agent": USER_AGENT,
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+        },
+    )
+    if resp.status_code != 200:
+        http_cliente.liberar(resp)
+        if resp.status_code >= 500:
+            # error del sitio, no "no encontrado": no se cachea
+            raise RuntimeError(f"Truper HTTP {resp.status_code}")
+        return None
+    return resp
+
+
+def resolver_busqueda(code: str):
+    """Página de búsqueda de Truper (si hay un solo resultado Magento redirige al producto)."""
+    resp = _abrir(f"https://www.truper.com/catalogsearch/result/?q={quote(code)}")
+    if resp is None:
+        return None, None, 0
+    try:
+        return escanear_html(resp.iter_content(chunk_size=BLOQUE_BYTES))
+    finally:
+        http_cliente.liberar(resp)
+
+
+RESOLVERS: List[Tuple[str, Callable]] = [
+    ("busqueda", resolver_busqueda),
+]
+
+
+def registrar_resolver(nombre: str, fn: Callable, primero: bool = False):
+    """Agrega (o reemplaza) una fuente de imágenes."""
+    global RESOLVERS
+    resto = [(n, f) for n, f in RESOLVERS if n != nombre]
+    RESOLVERS = [(nombre, fn)] + resto if primero else resto + [(nombre, fn)]
+
+
+# ---------------- métricas por fuente (desde que arrancó el proceso) ----------------
+
+_metricas_lock = threading.Lock()
+_metricas: Dict[str, Dict[str, float]] = {}
+
+
+def _registrar_metrica(fuente: str, resultado: str, bytes_leidos: int, segundos: float,
+                       parser: Optional[str] = None):
+    with _metricas_lock:
+        m = _metricas.setdefault(fuente, {
+            "intentos": 0, "aciertos": 0, "no_encontrado": 0, "errores": 0,
+            "bytes": 0, "segundos": 0.0, "por_parser": {},
+        })
+        m["intentos"] += 1
+        m[resultado] += 1
+        m["bytes"] += bytes_leidos
+        m["segundos"] += segundos
+        if parser:
+            m["por_parser"][parser] = m["por_parser"].get(parser, 0) + 1
+
+
+def metricas() -> Dict[str, dict]:
+    """{fuente: {intentos, aciertos, ..., tasa_acierto, bytes_promedio, ms_promedio}}"""
+    out = {}
+    with _metricas_lock:
+        for fuente, m in _metricas.items():
+            n = m["intentos"] or 1
+            out[fuente] = dict(
+                m,
+                por_parser=dict(m["por_parser"]),
+                segundos=round(m["segundos"], 3),
+                tasa_acierto=round(m["aciertos"] / n, 3),
+                bytes_promedio=int(m["bytes"] / n),
+                ms_promedio=round(m["segundos"] * 1000.0 / n, 1),
+            )
+    return out
+
+
+# ---------------- búsqueda de UN código ----------------
+
+def buscar_imagen_detalle(code: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    -> (url|None, fuente) con fuente = "<resolver>:<parser>" del que encontró.
+    Si TODAS las fuentes fallan por red, relanza el último error (no se cachea como "no encontrado").
+    """
+    code = str(code).strip()
+    if not code:
+        return None, None
+
+    ultimo_error = None
+    alguna_ok = False
+    for nombre, fn in RESOLVERS:
+        t = time.perf_counter()
+        try:
+            url, parser, leidos = fn(code)
+        except Exception as e:
+            _registrar_metrica(nombre, "errores", 0, time.perf_counter() - t)
+            ultimo_error = e
+            continue
+
+        alguna_ok = True
+        if url:
+            _registrar_metrica(nombre, "aciertos", leidos, time.perf_counter() - t, parser)
+            return url, f"{nombre}:{parser}"
+        _registrar_metrica(nombre, "no_encontrado", leidos, time.perf_counter() - t)
+
+    if not alguna_ok and ultimo_error is not None:
+        raise ultimo_error
+    return None, None
+
+
+def buscar_imagen(code: str) -> Optional[str]:
+    """Busca una imagen en Truper por código. Devuelve una URL de imagen o None."""
+    return buscar_imagen_detalle(code)[0]
+
+
+# ---------------- cache persistente ----------------
+
+def _leer_cache(codes) -> Dict[str, dict]:
+    """
+    Entradas vigentes (según TTL) para esos códigos.
+    Aciertos que no pasan es_imagen_producto (logos guardados por la búsqueda vieja) se ignoran.
+    """
+    if not codes:
+        return {}
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT code, imagen, fuente
+        FROM truper_imagen_cache
+        WHERE code = ANY(%s)
+          AND consultado_at > NOW() - (
+                CASE WHEN imagen IS NULL THEN %s ELSE %s END * INTERVAL '1 day'
+              )
+    """, (list(codes), TTL_NO_ENCONTRADO_DIAS, TTL_ENCONTRADO_DIAS))
+    rows = cur.fetchall() or []
+    conn.close()
+    return {
+        r["code"]: {"imagen": r["imagen"], "origen": r.get("fuente")}
+        for r in rows
+        if r["imagen"] is None or es_imagen_producto(r["imagen"])
+    }
+
+
+def _guardar_cache(resultados: Dict[str, Tuple[Optional[str], Optional[str]]]):
+    """resultados: {code: (imagen|None, fuente|None)}"""
+    if not resultados:
+        return
+    codes = list(resultados.keys())
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO truper_imagen_cache (code, imagen, fuente, consultado_at)
+        SELECT c, i, f, NOW() FROM unnest(%s::text[], %s::text[], %s::text[]) AS t(c, i, f)
+        ON CONFLICT (code) DO UPDATE SET
+            imagen = EXCLUDED.imagen,
+            fuente = EXCLUDED.fuente,
+            consultado_at = EXCLUDED.consultado_at
+    """, (codes, [resultados[c][0] for c in codes], [resultados[c][1] for c in codes]))
+    conn.commit()
+    conn.close()
+
+
+# ---------------- lote concurrente ----------------
+
+def _sin_progreso(**campos):
+    pass
+
+
+def buscar_imagenes(codes: Iterable[str], progreso=None, usar_cache: bool = True,
+                    al_lote: Optional[Callable[[Dict[str, dict]], None]] = None) -> Dict[str, dict]:
+    """
+    Resuelve muchos códigos a la vez.
+    -> {code: {"imagen": url|None, "fuente": "cache"|"truper", "origen": "<resolver>:<parser>",
+               "error": str (solo si falló la red)}}
+    Los resultados (aciertos y no encontrados) se guardan en el cache a medida que llegan.
+    al_lote(resultados) se llama con cada tanda ya resuelta (incluye los errores),
+    para que el llamador guarde sin esperar al final.
+    """
+    progreso = progreso or _sin_progreso
+    al_lote = al_lote or (lambda lote: None)
+    codes = list(dict.fromkeys(str(c).strip() for c in codes if str(c).strip()))
+
+    out: Dict[str, dict] = {}
+    if usar_cache:
+        for code, hit in _leer_cache(codes).items():
+            out[code] = {"imagen": hit["imagen"], "fuente": "cache", "origen": hit["origen"]}
+
+    pendientes = [c for c in codes if c not in out]
+    progreso(total=len(codes), desde_cache=len(out), procesados=len(out), forzar=True)
+    if out:
+        al_lote(dict(out))
+    if not pendientes:
+        return out
+
+    por_guardar: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+    lote: Dict[str, dict] = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(pendientes))),
+                            thread_name_prefix="truper") as pool:
+        futuros = {pool.submit(buscar_imagen_detalle, code): code for code in pendientes}
+        for fut in as_completed(futuros):
+            code = futuros[fut]
+            try:
+                img, origen = fut.result()
+                out[code] = {"imagen": img, "fuente": "truper", "origen": origen}
+                por_guardar[code] = (img, origen)
+            except Exception as e:
+                out[code] = {"imagen": None, "fuente": "truper", "error": str(e)}
+            lote[code] = out[code]
+
+            # cache por tandas: si el job muere a mitad, lo ya consultado no se repite
+            if len(por_guardar) >= 25:
+                _guardar_cache(por_guardar)
+                por_guardar = {}
+            if len(lote) >= 25:
+                al_lote(lote)
+                lote = {}
+            progreso(
+                procesados=len(out),
+                con_imagen=sum(1 for r in out.values() if r.get("imagen")),
+                errores=sum(1 for r in out.values() if r.get("error")),
+            )
+
+    _guardar_cache(por_guardar)
+    if lote:
+        al_lote(lote)
+    return out
+
+
+def metricas_cache() -> List[dict]:
+    """Aciertos guardados por fuente (persistente, sobrevive reinicios)."""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT COALESCE(fuente, CASE WHEN imagen IS NULL THEN 'no_encontrado' ELSE 'desconocida' END) AS fuente,
+               COUNT(*) AS codigos,
+               MAX(consultado_at) AS ultimo
+        FROM truper_imagen_cache
+        GROUP BY 1
+        ORDER BY 2 DESC
+    """)
+    rows = cur.fetchall() or []
+    conn.close()
+    return [
+        {"fuente": r["fuente"], "codigos": int(r["codigos"]), "ultimo": r["ultimo"].isoformat() if r["ultimo"] else None}
+        for r in rows
+    ]
@@ -0,0 +1,94 @@
+"""
+Benchmark de hash de contraseñas (backend/contrasenas.py) para elegir el costo.
+
+Uso:
+    python bench_contrasenas.py                       # scrypt log2 N = 13..17
+    python bench_contrasenas.py --presupuesto-ms 150  # presupuesto de latencia del login
+    python bench_contrasenas.py --concurrencia 2      # como gunicorn --threads 2
+
+Por cada costo mide el p50/p95 de un hash y cuánto tarda una ráfaga de
+`concurrencia` logins simultáneos. Recomienda el costo más alto cuyo p95 bajo
+concurrencia entra en el presupuesto. Se configura con PASSWORD_SCRYPT_LOG2_N
+(o PASSWORD_ARGON2_* si se usa argon2).
+"""
+import argparse
+import hashlib
+import os
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backend import contrasenas
+
+
+def _medir(fn, repeticiones: int, concurrencia: int):
+    def uno(_):
+        t = time.perf_counter()
+        fn()
+        return time.perf_counter() - t
+
+    with ThreadPoolExecutor(max_workers=concurrencia) as pool:
+        tiempos = sorted(pool.map(uno, range(repeticiones * concurrencia)))
+    p50 = tiempos[len(tiempos) // 2] * 1000
+    p95 = tiempos[min(len(tiempos) - 1, int(len(tiempos) * 0.95))] * 1000
+    return p50, p95
+
+
+def bench_scrypt(log2_ns, r: int, p: int, repeticiones: int, concurrencia: int):
+    sal = secrets.token_bytes(contrasenas.SAL_BYTES)
+    filas = []
+    for log2_n in log2_ns:
+        p50, p95 = _medir(lambda: contrasenas._scrypt("Clave-De-Prueba-123", sal, log2_n, r, p),
+                          repeticiones, concurrencia)
+        mem_mb = 128 * (1 << log2_n) * r / (1024 * 1024)
+        filas.append((f"scrypt log2N={log2_n} r={r} p={p}", mem_mb, p50, p95, log2_n))
+    return filas
+
+
+def bench_argon2(tiempos, memoria_kb: int, repeticiones: int, concurrencia: int):
+    if contrasenas.PasswordHasher is None:
+        print("argon2-cffi no instalado: se omite argon2\n")
+        return []
+    filas = []
+    for t in tiempos:
+        ph = contrasenas.PasswordHasher(time_cost=t, memory_cost=memoria_kb)
+        p50, p95 = _medir(lambda: ph.hash("Clave-De-Prueba-123"), repeticiones, concurrencia)
+        filas.append((f"argon2id t={t} m={memoria_kb}KB", memoria_kb / 1024, p50, p95, None))
+    return filas
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--presupuesto-ms", type=float, default=float(os.getenv("LOGIN_PRESUPUESTO_MS", "150")))
+    ap.add_argument("--concurrencia", type=int, default=2)
+    ap.add_argument("--repeticiones", type=int, default=5)
+    ap.add_argument("--log2n", type=int, nargs="+", default=[13, 14, 15, 16, 17])
+    args = ap.parse_args()
+
+    t = time.perf_counter()
+    for _ in range(1000):
+        hashlib.sha256(b"Clave-De-Prueba-123").hexdigest()
+    ms_sha = (time.perf_counter() - t) * 1000 / 1000
+    print(f"referencia sha256 legado: {ms_sha:.4f} ms por hash (sin sal ni costo)\n")
+
+    filas = bench_scrypt(args.log2n, contrasenas.SCRYPT_R, contrasenas.SCRYPT_P, args.repeticiones, args.concurrencia)
+    filas += bench_argon2([1, 2, 3], contrasenas.ARGON2_MEMORIA_KB, args.repeticiones, args.concurrencia)
+
+    print(f"{'parámetros':<32} {'RAM MB':>7} {'p50 ms':>8} {'p95 ms':>8}   (concurrencia {args.concurrencia})")
+    recomendado = None
+    for nombre, mem, p50, p95, log2_n in filas:
+        entra = p95 <= args.presupuesto_ms
+        print(f"{nombre:<32} {mem:>7.0f} {p50:>8.1f} {p95:>8.1f}   {'OK' if entra else 'excede'}")
+        if entra and log2_n is not None:
+            recomendado = log2_n
+
+    print()
+    if recomendado is None:
+        print(f"Ningún costo scrypt entra en {args.presupuesto_ms:.0f} ms: subir el presupuesto o bajar concurrencia.")
+    else:
+        print(f"Recomendado: PASSWORD_SCRYPT_LOG2_N={recomendado} (presupuesto {args.presupuesto_ms:.0f} ms, "
+              f"actual {contrasenas.SCRYPT_LOG2_N})")
+
+
+if __name__ == "__main__":
+    main()
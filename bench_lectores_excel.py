@@ -0,0 +1,165 @@
+"""
+Benchmark de lectores de la lista de precios (backend/lectores_excel.py).
+
+Uso:
+    python bench_lectores_excel.py                 # genera una lista sintética de 10k filas
+    python bench_lectores_excel.py proveedor.xlsm  # mide con un archivo real
+    python bench_lectores_excel.py --filas 20000 --repeticiones 5
+
+Muestra, por lector disponible, el mejor tiempo de N lecturas completas.
+"""
+import argparse
+import csv
+import os
+import random
+import tempfile
+import time
+
+from backend import lectores_excel
+from backend.lectores_excel import FILA_INICIO, SHEET_PEDIDO, SHEET_PRECIOS
+
+# columnas A..P: la hoja real trae más columnas de las que usamos (B, G, H, J)
+N_COLUMNAS = 16
+
+
+def _fila_sintetica(i: int):
+    r = [None] * N_COLUMNAS
+    r[0] = i
+    r[1] = 10000 + i                                   # B: código
+    r[2] = f"REF-{i}"
+    r[3] = random.randint(1, 50)
+    r[4] = "PZA"
+    r[5] = random.randint(1, 12)
+    r[6] = f"Producto de prueba número {i} acero"      # G: descripción
+    r[7] = round(random.uniform(0.5, 250.0), 2)        # H: USD unitario
+    r[8] = round(r[7] * r[5], 2)
+    r[9] = random.choice(["TRUPER", "PRETUL", "FOSET", "HERMEX"])  # J: marca
+    for j in range(10, N_COLUMNAS):
+        r[j] = random.random()
+    return r
+
+
+def generar_xlsx(path: str, filas: int):
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    hp = wb.create_sheet(SHEET_PEDIDO)
+    for _ in range(5):
+        hp.append([])
+    hp.append([None] * 6 + ["20%"])  # G6
+
+    ws = wb.create_sheet(SHEET_PRECIOS)
+    ws.append(["LISTA DE PRECIOS"])
+    ws.append([f"COL{j}" for j in range(N_COLUMNAS)])
+    for i in range(filas):
+        ws.append(_fila_sintetica(i))
+    wb.save(path)
+
+
+def generar_csv(path: str, filas: int):
+    with open(path, "w", encoding="utf-8", newline="") as fh:
+        w = csv.writer(fh, delimiter=";")
+        w.writerow(["LISTA DE PRECIOS"])
+        w.writerow([f"COL{j}" for j in range(N_COLUMNAS)])
+        for i in range(filas):
+            w.writerow(["" if v is None else v for v in _fila_sintetica(i)])
+
+
+def generar_xls(path: str, filas: int) -> bool:
+    try:
+        import xlwt
+    except ImportError:
+        return False
+
+    wb = xlwt.Workbook()
+    hp = wb.add_sheet(SHEET_PEDIDO)
+    hp.write(5, 6, "20%")
+    ws = wb.add_sheet(SHEET_PRECIOS)
+    for i in range(filas):
+        for j, v in enumerate(_fila_sintetica(i)):
+            if v is not None:
+                ws.write(i + FILA_INICIO - 1, j, v)
+    wb.save(path)
+    return True
+
+
+def _leer_openpyxl_todas(path: str):
+    """Referencia: como leía antes actualizar_precios() (todas las columnas de cada fila)."""
+    from openpyxl import load_workbook
+
+    wb = load_workbook(path, data_only=True, read_only=True, keep_vba=False)
+    ws = wb[SHEET_PRECIOS]
+
+    def filas():
+        for r in ws.iter_rows(min_row=FILA_INICIO, values_only=True):
+            yield r[1], r[6], r[7], r[9]
+        wb.close()
+
+    return None, filas()
+
+
+REFERENCIAS = {"openpyxl_todas": _leer_openpyxl_todas}
+
+
+def medir(nombre: str, path: str, repeticiones: int):
+    fn = REFERENCIAS.get(nombre) or lectores_excel.LECTORES[nombre]
+    mejor = None
+    n = 0
+    for _ in range(repeticiones):
+        t = time.perf_counter()
+        _, filas = fn(path)
+        n = sum(1 for _ in filas)
+        dt = time.perf_counter() - t
+        mejor = dt if mejor is None else min(mejor, dt)
+    return mejor, n
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("archivo", nargs="?")
+    ap.add_argument("--filas", type=int, default=10000)
+    ap.add_argument("--repeticiones", type=int, default=3)
+    args = ap.parse_args()
+
+    random.seed(1)
+    tmp = tempfile.mkdtemp(prefix="bench_lectores_")
+
+    archivos = []
+    if args.archivo:
+        archivos.append(args.archivo)
+    else:
+        print(f"Generando lista sintética de {args.filas} filas en {tmp} ...")
+        xlsx = os.path.join(tmp, "proveedor.xlsx")
+        try:
+            generar_xlsx(xlsx, args.filas)
+            archivos.append(xlsx)
+        except ImportError:
+            print("openpyxl no instalado: se omite .xlsx")
+
+        c = os.path.join(tmp, "proveedor.csv")
+        generar_csv(c, args.filas)
+        archivos.append(c)
+
+        xls = os.path.join(tmp, "proveedor.xls")
+        if generar_xls(xls, min(args.filas, 65000)):
+            archivos.append(xls)
+
+    print(f"{'archivo':<18} {'lector':<15} {'filas':>7} {'mejor (s)':>10} {'filas/s':>10}")
+    for path in archivos:
+        ext = os.path.splitext(path)[1].lower()
+        candidatos = {lectores_excel.POR_EXTENSION.get(ext)}
+        if ext in (".xlsx", ".xlsm", ".xls"):
+            candidatos.add("calamine")
+        if ext in (".xlsx", ".xlsm"):
+            candidatos.add("openpyxl_todas")
+        for nombre in sorted(c for c in candidatos if c):
+            try:
+                dt, n = medir(nombre, path, args.repeticiones)
+            except ImportError as e:
+                print(f"{os.path.basename(path):<18} {nombre:<15} {'-':>7} {'no instalado':>10}  ({e.name})")
+                continue
+            print(f"{os.path.basename(path):<18} {nombre:<15} {n:>7} {dt:>10.3f} {n / dt if dt else 0:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Corre los parsers de imágenes Truper (backend/truper.py) contra el corpus local
+fixtures/truper/*.html y compara con fixtures/truper/esperados.json.
+
+Uso:
+    python probar_resolvers_truper.py                 # corpus local (sin red)
+    python probar_resolvers_truper.py --vivo 19985 14127   # contra truper.com + métricas por fuente
+
+Cada fixture se escanea con el bloque normal y con bloques diminutos
+(para que las etiquetas queden partidas entre lecturas). Sale con código 1 si algo no coincide.
+"""
+import argparse
+import json
+import os
+import sys
+
+from backend import truper
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "truper")
+
+BLOQUES = (truper.BLOQUE_BYTES, 97, 7)
+
+
+def probar_corpus() -> int:
+    with open(os.path.join(FIXTURES_DIR, "esperados.json"), "r", encoding="utf-8") as fh:
+        esperados = json.load(fh)
+
+    bloque_original = truper.BLOQUE_BYTES
+    fallas = 0
+    print(f"{'fixture':<24} {'bloque':>6} {'leídos':>8} {'tamaño':>8} {'parser':<15} resultado")
+    try:
+        for archivo, esp in sorted(esperados.items()):
+            path = os.path.join(FIXTURES_DIR, archivo)
+            tam = os.path.getsize(path)
+            for bloque in BLOQUES:
+                truper.BLOQUE_BYTES = bloque
+                with open(path, "rb") as fh:
+                    url, parser, leidos = truper.escanear_html(fh)
+
+                ok = url == esp.get("imagen") and parser == esp.get("parser")
+                fallas += 0 if ok else 1
+                detalle = "OK" if ok else f"FALLA  ({url!r}, esperado {esp.get('imagen')!r})"
+                print(f"{archivo:<24} {bloque:>6} {leidos:>8} {tam:>8} {str(parser):<15} {detalle}")
+    finally:
+        truper.BLOQUE_BYTES = bloque_original
+
+    print(f"\n{len(esperados) * len(BLOQUES) - fallas}/{len(esperados) * len(BLOQUES)} OK")
+    return fallas
+
+
+def probar_vivo(codes):
+    for code in codes:
+        try:
+            url, fuente = truper.buscar_imagen_detalle(code)
+            print(f"{code:<12} {str(fuente):<24} {url}")
+        except Exception as e:
+            print(f"{code:<12} {'ERROR':<24} {e}")
+    print()
+    print(json.dumps(truper.metricas(), indent=2, ensure_ascii=False))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--vivo", nargs="+", metavar="CODIGO", help="consultar truper.com con estos códigos")
+    args = ap.parse_args()
+
+    if args.vivo:
+        probar_vivo(args.vivo)
+        return
+
+    sys.exit(1 if probar_corpus() else 0)
+
+
+if __name__ == "__main__":
+    main()